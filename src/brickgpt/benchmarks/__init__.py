@@ -0,0 +1,3 @@
+from .tiny_llama import build_tiny_llama
+from .generation import run_generation_benchmark
+from .codecs import random_bricks_txts, run_codec_benchmark
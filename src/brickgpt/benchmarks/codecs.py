@@ -0,0 +1,114 @@
+import json
+import time
+from dataclasses import dataclass, field
+
+import numpy as np
+from transformers import HfArgumentParser
+
+from brickgpt.data import Brick, BrickStructure
+from brickgpt.data.brick_library import brick_id_to_dimensions, brick_library
+
+
+@dataclass
+class CodecBenchmarkConfig:
+    input_path: str | None = field(
+        default=None,
+        metadata={'help': 'A brick structure dataset whose "bricks" field holds structures in txt format, '
+                          'e.g. AvaLovelace/StableText2Brick. If not given, random structures are generated.'},
+    )
+    n_structures: int = field(
+        default=1000,
+        metadata={'help': 'The number of structures to benchmark on.'},
+    )
+    n_bricks: int = field(
+        default=100,
+        metadata={'help': 'The number of bricks in each randomly generated structure.'},
+    )
+    output_file: str | None = field(
+        default=None,
+        metadata={'help': 'A JSON file to save the benchmark results to.'},
+    )
+
+
+def random_bricks_txts(n_structures: int, n_bricks: int, world_dim: int = 20, seed: int = 0) -> list[str]:
+    """
+    Generates random brick structures in txt format. The bricks are in the brick library and in bounds,
+    but may collide or float, which does not matter for parsing and formatting.
+    """
+    rng = np.random.default_rng(seed)
+    dimensions = [brick_id_to_dimensions(int(brick_id)) for brick_id in brick_library]
+    dimensions += [(w, h) for h, w in dimensions]
+    result = []
+    for _ in range(n_structures):
+        bricks = []
+        for h, w in (dimensions[i] for i in rng.integers(len(dimensions), size=n_bricks)):
+            x, y, z = rng.integers(world_dim - h + 1), rng.integers(world_dim - w + 1), rng.integers(world_dim)
+            bricks.append(Brick(h=h, w=w, x=int(x), y=int(y), z=int(z)).to_txt())
+        result.append('2x2 (0,0,0)\n' + ''.join(bricks))  # Start at ground level
+    return result
+
+
+def run_codec_benchmark(bricks_txts: list[str]) -> dict:
+    """
+    Measures the time to parse and format the given brick structures with the bulk codecs of BrickStructure,
+    and with the per-brick codecs of Brick. Checks that both produce identical output.
+    :param bricks_txts: Brick structures in txt format.
+    :return: The benchmark results.
+    """
+    results = {'n_structures': len(bricks_txts), 'n_bricks': sum(map(len, map(BrickStructure.from_txt, bricks_txts)))}
+
+    def measure(name: str, fn, inputs: list) -> list:
+        start_time = time.perf_counter()
+        outputs = [fn(x) for x in inputs]
+        results[f'{name}_time'] = time.perf_counter() - start_time
+        return outputs
+
+    def parse_txt_per_brick(bricks_txt: str) -> BrickStructure:
+        return BrickStructure([Brick.from_txt(b) for b in bricks_txt.split('\n') if b.strip()])
+
+    def parse_ldr_per_brick(bricks_ldr: str) -> BrickStructure:
+        return BrickStructure([Brick.from_ldr(b) for b in bricks_ldr.split('0 STEP') if b.strip()])
+
+    structures = measure('parse_txt_per_brick', parse_txt_per_brick, bricks_txts)
+    bulk_structures = measure('parse_txt_bulk', BrickStructure.from_txt, bricks_txts)
+    assert structures == bulk_structures
+
+    txts = measure('format_txt_per_brick', lambda s: ''.join(b.to_txt() for b in s.bricks), structures)
+    bulk_txts = measure('format_txt_bulk', BrickStructure.to_txt, bulk_structures)
+    assert txts == bulk_txts == bricks_txts
+
+    ldrs = measure('format_ldr_per_brick', lambda s: ''.join(b.to_ldr() for b in s.bricks), structures)
+    bulk_ldrs = measure('format_ldr_bulk', BrickStructure.to_ldr, bulk_structures)
+    assert ldrs == bulk_ldrs
+
+    structures = measure('parse_ldr_per_brick', parse_ldr_per_brick, ldrs)
+    bulk_structures = measure('parse_ldr_bulk', BrickStructure.from_ldr, ldrs)
+    assert structures == bulk_structures
+
+    for codec in ['parse_txt', 'format_txt', 'format_ldr', 'parse_ldr']:
+        results[f'{codec}_speedup'] = results[f'{codec}_per_brick_time'] / results[f'{codec}_bulk_time']
+    return results
+
+
+def main():
+    parser = HfArgumentParser(CodecBenchmarkConfig)
+    (cfg,) = parser.parse_args_into_dataclasses()
+
+    if cfg.input_path:
+        from datasets import load_dataset
+        bricks_txts = load_dataset(cfg.input_path, split='train')['bricks'][:cfg.n_structures]
+    else:
+        bricks_txts = random_bricks_txts(cfg.n_structures, cfg.n_bricks)
+    results = run_codec_benchmark(bricks_txts)
+
+    print('--------------------')
+    for name, value in results.items():
+        print(f'{name}: {value:.3f}' if isinstance(value, float) else f'{name}: {value}')
+    print('--------------------')
+    if cfg.output_file:
+        with open(cfg.output_file, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+import json
+import resource
+import sys
+import tempfile
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+
+import transformers
+from transformers import HfArgumentParser
+
+from brickgpt.models import BrickGPT, BrickGPTConfig
+from .tiny_llama import build_tiny_llama
+
+DEFAULT_CAPTIONS = [
+    'A basic chair with four legs.',
+    'A small table with a flat top.',
+    'A tall, narrow tower.',
+    'A simple car with four wheels.',
+    'A boat with a pointed bow.',
+]
+
+
+@dataclass
+class GenerationBenchmarkConfig:
+    n_seeds: int = field(
+        default=1,
+        metadata={'help': 'The number of seeds to generate each caption with. Seeds are 0, 1, ..., n_seeds - 1.'},
+    )
+    captions: list[str] = field(
+        default_factory=lambda: list(DEFAULT_CAPTIONS),
+        metadata={'help': 'The captions to generate brick structures for.'},
+    )
+    tiny_model: bool = field(
+        default=True,
+        metadata={'help': 'Whether to benchmark a small, randomly initialized Llama model that is built locally, '
+                          'instead of the model given by model_name_or_path. Needs no network access.'},
+    )
+    tiny_model_hidden_size: int = field(
+        default=64,
+        metadata={'help': 'The hidden size of the tiny model.'},
+    )
+    tiny_model_layers: int = field(
+        default=2,
+        metadata={'help': 'The number of layers of the tiny model.'},
+    )
+    output_file: str | None = field(
+        default=None,
+        metadata={'help': 'A JSON file to save the benchmark results to.'},
+    )
+
+
+def run_generation_benchmark(brickgpt: BrickGPT, captions: list[str], seeds: list[int]) -> dict:
+    """
+    Generates a brick structure for each caption and seed, and measures the throughput of generation.
+    A warmup generation is run first and not measured.
+    :param brickgpt: The model to benchmark. It must be built with profile=True, which counts the generated tokens.
+    :return: The benchmark results.
+    """
+    if not brickgpt.profiler.enabled:
+        raise ValueError('run_generation_benchmark requires profile=True')
+    transformers.set_seed(0)
+    brickgpt(captions[0])
+    brickgpt.stability_cache.clear()
+
+    n_bricks = 0
+    n_tokens = 0
+    n_regenerations = 0
+    rejection_reasons = Counter()
+    start_time = time.perf_counter()
+    for caption in captions:
+        for seed in seeds:
+            transformers.set_seed(seed)
+            output = brickgpt(caption)
+            n_bricks += len(output['bricks'])
+            n_tokens += output['timings']['tokens_generated']
+            n_regenerations += output['n_regenerations']
+            rejection_reasons.update(output['rejection_reasons'])
+    total_time = time.perf_counter() - start_time
+
+    n_generations = len(captions) * len(seeds)
+    return {
+        'n_generations': n_generations,
+        'total_time': total_time,
+        'bricks_per_sec': n_bricks / total_time,
+        'tokens_per_sec': n_tokens / total_time,
+        'bricks_per_generation': n_bricks / n_generations,
+        'rejections_per_brick': rejection_reasons.total() / max(n_bricks, 1),
+        'rejection_reasons': dict(rejection_reasons),
+        'regenerations_per_generation': n_regenerations / n_generations,
+        'stability_cache': brickgpt.stability_cache.stats(),
+        'peak_rss_mb': _peak_rss_mb(),
+    }
+
+
+def _peak_rss_mb() -> float:
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / 2 ** 20 if sys.platform == 'darwin' else peak_rss / 2 ** 10  # Bytes on macOS, KiB on Linux
+
+
+def main():
+    parser = HfArgumentParser((GenerationBenchmarkConfig, BrickGPTConfig))
+    parser.set_defaults(device='cpu', use_gurobi=False, max_bricks=20, max_regenerations=2, profile=True)
+    benchmark_cfg, brickgpt_cfg = parser.parse_args_into_dataclasses()
+
+    with tempfile.TemporaryDirectory() as tiny_model_dir:
+        if benchmark_cfg.tiny_model:
+            build_tiny_llama(tiny_model_dir, benchmark_cfg.tiny_model_hidden_size, benchmark_cfg.tiny_model_layers)
+            brickgpt_cfg.model_name_or_path = tiny_model_dir
+        brickgpt = BrickGPT(brickgpt_cfg)
+        results = run_generation_benchmark(brickgpt, benchmark_cfg.captions, list(range(benchmark_cfg.n_seeds)))
+
+    print('--------------------')
+    for name, value in results.items():
+        print(f'{name}: {value:.3f}' if isinstance(value, float) else f'{name}: {value}')
+    print('--------------------')
+    if benchmark_cfg.output_file:
+        with open(benchmark_cfg.output_file, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
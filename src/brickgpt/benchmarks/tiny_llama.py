@@ -0,0 +1,96 @@
+import string
+from pathlib import Path
+
+import torch
+from tokenizers import Regex, Tokenizer, decoders, models, pre_tokenizers
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+# The vocabulary size and special token IDs of the Llama 3 tokenizer, which the BrickGPT model uses
+LLAMA3_VOCAB_SIZE = 128256
+LLAMA3_SPECIAL_TOKENS = {
+    '<|begin_of_text|>': 128000,
+    '<|end_of_text|>': 128001,
+    '<|finetune_right_pad_id|>': 128004,
+    '<|start_header_id|>': 128006,
+    '<|end_header_id|>': 128007,
+    '<|eot_id|>': 128009,
+}
+
+# A simplified Llama 3 chat template, supporting continue_final_message
+LLAMA3_CHAT_TEMPLATE = (
+    "{{ bos_token }}{% for message in messages %}"
+    "<|start_header_id|>{{ message['role'] }}<|end_header_id|>\n\n{{ message['content'] | trim }}"
+    "{% if not (continue_final_message and loop.last) %}<|eot_id|>{% endif %}{% endfor %}"
+    "{% if add_generation_prompt %}<|start_header_id|>assistant<|end_header_id|>\n\n{% endif %}"
+)
+
+
+def build_tiny_llama_tokenizer() -> PreTrainedTokenizerFast:
+    """
+    Builds a word-level tokenizer with the same vocabulary layout as the Llama 3 tokenizer where it matters for brick
+    generation: every number from 0 to 999, " (" and ")\\n" are single tokens, the special tokens have their real IDs,
+    and the vocabulary has the real size. The rest of the vocabulary is made of single characters and filler tokens.
+    """
+    vocab = {}
+    for token in [str(i) for i in range(1000)] + [' (', ')\n'] + list(string.printable) + ['<unk>']:
+        vocab.setdefault(token, len(vocab))
+    reserved_ids = set(LLAMA3_SPECIAL_TOKENS.values())
+    for token_id in range(len(vocab), LLAMA3_VOCAB_SIZE):
+        if token_id not in reserved_ids:
+            vocab[f'<|filler_{token_id}|>'] = token_id
+    vocab.update(LLAMA3_SPECIAL_TOKENS)
+
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token='<unk>'))
+    tokenizer.pre_tokenizer = pre_tokenizers.Split(Regex(r'\d{1,3}| \(|\)\n|[\s\S]'), behavior='isolated')
+    tokenizer.decoder = decoders.Fuse()
+    tokenizer.add_special_tokens(list(LLAMA3_SPECIAL_TOKENS))
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        bos_token='<|begin_of_text|>',
+        eos_token='<|eot_id|>',
+        pad_token='<|finetune_right_pad_id|>',
+        chat_template=LLAMA3_CHAT_TEMPLATE,
+    )
+
+
+def build_tiny_llama(
+        path: str | Path,
+        hidden_size: int = 64,
+        num_hidden_layers: int = 2,
+        eos_logit_bias: float = -0.6,
+        seed: int = 0,
+) -> None:
+    """
+    Builds a small, randomly initialized Llama model and its tokenizer, and saves them to the given directory,
+    so that BrickGPT can be run without network access or the gated BrickGPT weights.
+    :param path: The directory to save the model and tokenizer to.
+    :param hidden_size: The hidden size of the model.
+    :param num_hidden_layers: The number of layers of the model.
+    :param eos_logit_bias: The bias added to the EOS logit. A random model would otherwise end structures
+                           after only a few bricks.
+    :param seed: The random seed used to initialize the model weights.
+    """
+    tokenizer = build_tiny_llama_tokenizer()
+    tokenizer.save_pretrained(path)
+
+    config = LlamaConfig(
+        vocab_size=LLAMA3_VOCAB_SIZE,
+        hidden_size=hidden_size,
+        intermediate_size=2 * hidden_size,
+        num_hidden_layers=num_hidden_layers,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=8192,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+    )
+    torch.manual_seed(seed)
+    model = LlamaForCausalLM(config)
+
+    # Llama has no output bias, so emulate one with a hidden dimension that is constant for every token
+    with torch.no_grad():
+        model.model.embed_tokens.weight[:, 0] = 1.0
+        model.lm_head.weight[:, 0] = 0.0
+        model.lm_head.weight[tokenizer.eos_token_id, 0] = eos_logit_bias
+    model.save_pretrained(path)
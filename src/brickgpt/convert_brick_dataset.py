@@ -0,0 +1,49 @@
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from datasets import load_dataset
+from transformers import HfArgumentParser
+
+from brickgpt.data import BrickDataset
+
+
+@dataclass
+class ConvertDatasetArguments:
+    input_path: str = field(
+        default='AvaLovelace/StableText2Brick',
+        metadata={'help': 'Path to the brick structure dataset to be converted. '
+                          'This dataset should contain the fields "captions" (list[string]) and "bricks" (string).'},
+    )
+    output_path: str = field(
+        default='datasets',
+        metadata={'help': 'Path to the directory in which to save the converted dataset. Each split is saved as a '
+                          'binary brick dataset file named "<split>.bricks", which can be opened with BrickDataset.'},
+    )
+    world_dim: int = field(
+        default=20,
+        metadata={'help': 'The world dimension of the brick structures.'},
+    )
+
+
+def main():
+    """
+    This script converts a brick structure dataset with bricks in txt format into binary brick dataset files,
+    so that loading the structures does not require parsing them.
+    """
+    parser = HfArgumentParser(ConvertDatasetArguments)
+    (cfg,) = parser.parse_args_into_dataclasses()
+
+    input_dataset = load_dataset(cfg.input_path)
+
+    os.makedirs(cfg.output_path, exist_ok=True)
+    for split_name, split in input_dataset.items():
+        output_file = Path(cfg.output_path) / f'{split_name}.bricks'
+        dataset = BrickDataset.from_txts(output_file, split['bricks'], split['captions'], world_dim=cfg.world_dim)
+        print(f'Converted dataset split "{split_name}": {len(dataset)} structures, {dataset.n_bricks} bricks')
+
+    print(f'Converted dataset saved to {os.path.abspath(cfg.output_path)}')
+
+
+if __name__ == '__main__':
+    main()
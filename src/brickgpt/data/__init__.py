@@ -1,2 +1,5 @@
-from .brick_structure import Brick, BrickStructure
+from .brick_structure import (Brick, BrickStructure, brick_dtype,
+                              bricks_txt_to_array, bricks_txt_to_arrays, bricks_ldr_to_array)
 from .brick_library import brick_library, max_brick_dimension, dimensions_to_brick_id, brick_id_to_part_id
+from .brick_dataset import BrickDataset
+from .stability_cache import StabilityCache
@@ -0,0 +1,188 @@
+import json
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+
+import numpy as np
+
+from .brick_structure import BrickStructure, brick_dtype, bricks_ldr_to_array, bricks_txt_to_arrays
+
+_MAGIC = b'BRICKDS\0'
+_VERSION = 1
+_ALIGNMENT = 64
+
+
+class BrickDataset:
+    """
+    A read-only collection of brick structures, stored in a single binary file that is memory-mapped on load.
+
+    The file holds one flat brick array with fields (h, w, x, y, z), the offset of each structure in it,
+    and the captions of each structure. Structure i is a zero-copy view of the brick array, slicing the dataset
+    gives another dataset that shares the same memory map, and worker processes that open or unpickle the same file
+    share its pages.
+    """
+
+    def __init__(self, path: str | Path):
+        """
+        :param path: The dataset file, as written by BrickDataset.write.
+        """
+        self.path = Path(path)
+        data = np.memmap(self.path, dtype=np.uint8, mode='r')
+        if bytes(data[:len(_MAGIC)]) != _MAGIC:
+            raise ValueError(f'Not a brick dataset file: {self.path}')
+        header_size = int(data[len(_MAGIC):len(_MAGIC) + 8].view(np.uint64)[0])
+        header_start = len(_MAGIC) + 8
+        header = json.loads(bytes(data[header_start:header_start + header_size]))
+        if header['version'] != _VERSION:
+            raise ValueError(f'Unsupported brick dataset version {header["version"]}: {self.path}')
+
+        arrays = {}
+        for name, spec in header['arrays'].items():
+            dtype = np.dtype([tuple(field) for field in spec['dtype']]) if isinstance(spec['dtype'], list) \
+                else np.dtype(spec['dtype'])
+            array = data[spec['offset']:spec['offset'] + spec['length'] * dtype.itemsize].view(dtype)
+            arrays[name] = array
+        self.world_dim = header['world_dim']
+        self._bricks = arrays['bricks']
+        self._offsets = arrays['offsets']
+        self._caption_bytes = arrays['caption_bytes']
+        self._caption_offsets = arrays['caption_offsets']
+        self._structure_caption_offsets = arrays['structure_caption_offsets']
+        self._start, self._stop = 0, len(self._offsets) - 1
+
+    def __len__(self) -> int:
+        return self._stop - self._start
+
+    def __getitem__(self, key: int | slice):
+        """
+        Returns the bricks of structure i as a read-only view of the memory map, or a dataset of the given structures.
+        """
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                raise ValueError('Brick datasets can only be sliced with step 1.')
+            result = object.__new__(BrickDataset)
+            result.__dict__.update(self.__dict__)
+            result._start, result._stop = self._start + start, self._start + max(start, stop)
+            return result
+
+        i = self._index(key)
+        return self._bricks[self._offsets[i]:self._offsets[i + 1]]
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        offsets = self._offsets[self._start:self._stop + 1].tolist()
+        bricks = self._bricks
+        for start, stop in zip(offsets[:-1], offsets[1:]):
+            yield bricks[start:stop]
+
+    def __getstate__(self) -> dict:
+        # Reopen the memory map when unpickled, instead of copying the data to the other process
+        return {'path': self.path, 'start': self._start, 'stop': self._stop}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state['path'])
+        self._start, self._stop = state['start'], state['stop']
+
+    @property
+    def n_bricks(self) -> int:
+        return int(self._offsets[self._stop] - self._offsets[self._start])
+
+    def captions(self, i: int) -> list[str]:
+        """
+        Returns the captions of structure i.
+        """
+        i = self._index(i)
+        caption_offsets = self._caption_offsets[
+                          self._structure_caption_offsets[i]:self._structure_caption_offsets[i + 1] + 1].tolist()
+        return [bytes(self._caption_bytes[start:stop]).decode()
+                for start, stop in zip(caption_offsets[:-1], caption_offsets[1:])]
+
+    def structure(self, i: int) -> BrickStructure:
+        """
+        Returns structure i as a BrickStructure.
+        """
+        return BrickStructure.from_array(self[i], self.world_dim)
+
+    def _index(self, i: int) -> int:
+        if not -len(self) <= i < len(self):
+            raise IndexError(f'Structure index {i} out of range for dataset of length {len(self)}.')
+        return self._start + i % len(self)
+
+    @classmethod
+    def write(
+            cls,
+            path: str | Path,
+            structures: Iterable[np.ndarray | BrickStructure],
+            captions: Iterable[list[str]] | None = None,
+            world_dim: int = 20,
+    ):
+        """
+        Writes brick structures and their captions to a dataset file, and opens it.
+        :param path: The file to write.
+        :param structures: The brick structures, as brick arrays or BrickStructures.
+        :param captions: The captions of each structure. If not given, structures have no captions.
+        :param world_dim: The world dimension of the structures.
+        :return: The opened dataset.
+        """
+        structures = [s.array if isinstance(s, BrickStructure) else np.asarray(s, dtype=brick_dtype)
+                      for s in structures]
+        captions = [[]] * len(structures) if captions is None else [list(c) for c in captions]
+        if len(captions) != len(structures):
+            raise ValueError(f'Got {len(captions)} caption lists for {len(structures)} structures.')
+
+        encoded_captions = [caption.encode() for structure_captions in captions for caption in structure_captions]
+        arrays = {
+            'bricks': np.concatenate([np.zeros(0, dtype=brick_dtype), *structures]),
+            'offsets': np.cumsum([0] + [len(s) for s in structures], dtype=np.int64),
+            'caption_bytes': np.frombuffer(b''.join(encoded_captions), dtype=np.uint8),
+            'caption_offsets': np.cumsum([0] + [len(c) for c in encoded_captions], dtype=np.int64),
+            'structure_caption_offsets': np.cumsum([0] + [len(c) for c in captions], dtype=np.int64),
+        }
+
+        # Lay out the arrays after the header, each aligned to a multiple of _ALIGNMENT bytes
+        specs = {name: {'dtype': array.dtype.descr if array.dtype.names else array.dtype.str, 'length': len(array)}
+                 for name, array in arrays.items()}
+        header = {'version': _VERSION, 'world_dim': world_dim, 'arrays': specs}
+        header_size = len(json.dumps(header).encode()) + 64 * len(arrays)  # Leave room for the offsets
+        offset = len(_MAGIC) + 8 + header_size
+        for name, array in arrays.items():
+            offset += -offset % _ALIGNMENT
+            specs[name]['offset'] = offset
+            offset += array.nbytes
+        header_bytes = json.dumps(header).encode().ljust(header_size)
+
+        with open(path, 'wb') as f:
+            f.write(_MAGIC)
+            f.write(np.uint64(header_size).tobytes())
+            f.write(header_bytes)
+            for name, array in arrays.items():
+                f.write(b'\0' * (specs[name]['offset'] - f.tell()))
+                f.write(array.tobytes())
+        return cls(path)
+
+    @classmethod
+    def from_txts(cls, path: str | Path, bricks_txts: list[str], captions: Iterable[list[str]] | None = None,
+                  world_dim: int = 20):
+        """
+        Converts brick structures in txt format to a dataset file, and opens it.
+        """
+        return cls.write(path, bricks_txt_to_arrays(bricks_txts), captions, world_dim)
+
+    @classmethod
+    def from_ldrs(cls, path: str | Path, bricks_ldrs: list[str], captions: Iterable[list[str]] | None = None,
+                  world_dim: int = 20):
+        """
+        Converts brick structures in LDR format to a dataset file, and opens it.
+        """
+        return cls.write(path, map(bricks_ldr_to_array, bricks_ldrs), captions, world_dim)
+
+    def to_txts(self) -> list[str]:
+        """
+        Converts every structure to txt format.
+        """
+        return [self.structure(i).to_txt() for i in range(len(self))]
+
+    def to_ldrs(self) -> list[str]:
+        """
+        Converts every structure to LDR format.
+        """
+        return [self.structure(i).to_ldr() for i in range(len(self))]
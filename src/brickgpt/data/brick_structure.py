@@ -1,11 +1,14 @@
+import functools
 import re
 import warnings
 from dataclasses import dataclass
 
 import numpy as np
 
-from brickgpt.stability_analysis import stability_score, StabilityConfig, connectivity_score
-from .brick_library import (brick_library,
+from brickgpt.stability_analysis import (stability_score, StabilityConfig, connectivity_score, longest_connected_prefix,
+                                         GroundConnectivity, IncrementalStabilityModel, StaticScreen,
+                                         static_stability_screen)
+from .brick_library import (brick_library, brick_library_tables,
                            dimensions_to_brick_id, brick_id_to_dimensions,
                            brick_id_to_part_id, part_id_to_brick_id)
 
@@ -114,9 +117,30 @@ class Brick:
                 raise ValueError(f"LDR format is ill-formatted: {brick_ldr}")
 
 
+# The columns of a BrickStructure's brick array
+brick_dtype = np.dtype([('h', np.int16), ('w', np.int16), ('x', np.int16), ('y', np.int16), ('z', np.int16)])
+_INT16_MIN, _INT16_MAX = np.iinfo(np.int16).min, np.iinfo(np.int16).max
+
+_LDR_MATRICES = np.array(['0 0 1 0 1 0 -1 0 0', '-1 0 0 0 1 0 0 0 -1'], dtype=object)
+
+
+@functools.cache
+def _footprint_mask(h: int, w: int, world_dim: int) -> int:
+    """
+    Returns the bitmask of an h x w footprint at the origin of a layer, where bit x * world_dim + y is voxel (x, y).
+    """
+    return sum(((1 << w) - 1) << (i * world_dim) for i in range(h))
+
+
 class BrickStructure:
     """
     Represents a brick structure in the form of a list of bricks.
+
+    Bricks are stored column-wise in a structured numpy array with an append cursor, so that truncating the structure
+    to a prefix and copying it are cheap. The list of Brick objects is built on demand.
+
+    Besides the voxel occupancy counts, each layer is kept as an integer bitboard whose bit x * world_dim + y is set
+    if voxel (x, y) is occupied, so that collision and support checks are a few integer operations.
     """
 
     def __init__(self, bricks: list[Brick], world_dim: int = 20):
@@ -128,13 +152,17 @@ class BrickStructure:
             warnings.warn('Brick structure does not start at ground level z=0.')
 
         # Build structure from bricks
-        self.bricks = []
-        self.voxel_occupancy = np.zeros((world_dim, world_dim, world_dim), dtype=int)
+        self._array = np.zeros(max(len(bricks), 16), dtype=brick_dtype)
+        self._n_bricks = 0
+        self._bricks = []
+        self.voxel_occupancy = np.zeros((world_dim, world_dim, world_dim), dtype=np.uint8)
+        self._layers = [0] * world_dim
+        self._connectivity = None  # Built on the first call to is_grounded
         for brick in bricks:
             self.add_brick(brick)
 
     def __len__(self):
-        return len(self.bricks)
+        return self._n_bricks
 
     def __repr__(self):
         return self.to_txt()
@@ -142,38 +170,195 @@ class BrickStructure:
     def __eq__(self, other) -> bool:
         if not isinstance(other, BrickStructure):
             return NotImplemented
-        return self.bricks == other.bricks
+        return np.array_equal(self.array, other.array)
+
+    def __copy__(self):
+        return self.copy()
+
+    def __deepcopy__(self, memo):
+        return self.copy()
+
+    def copy(self):
+        """
+        Returns a copy of this structure. Only the used part of the brick array and the occupancy grid are copied.
+        """
+        result = object.__new__(type(self))
+        result.world_dim = self.world_dim
+        result._array = self.array.copy()
+        result._n_bricks = self._n_bricks
+        result._bricks = None if self._bricks is None else self._bricks.copy()
+        result.voxel_occupancy = self.voxel_occupancy.copy()
+        result._layers = self._layers.copy()
+        result._connectivity = None if self._connectivity is None else self._connectivity.copy()
+        return result
+
+    @property
+    def array(self) -> np.ndarray:
+        """
+        A read-only view of the bricks as a structured array with fields (h, w, x, y, z).
+        """
+        array = self._array[:self._n_bricks]
+        array.flags.writeable = False
+        return array
+
+    @property
+    def bricks(self) -> list[Brick]:
+        if self._bricks is None:
+            self._bricks = [Brick(h=h, w=w, x=x, y=y, z=z) for h, w, x, y, z in self.array.tolist()]
+        return self._bricks
 
     def to_json(self) -> dict:
-        return {str(i + 1): brick.to_json() for i, brick in enumerate(self.bricks)}
+        array = self.array
+        brick_ids = self._brick_ids().tolist()
+        oris = (array['h'] > array['w']).astype(int).tolist()
+        return {str(i + 1): {'brick_id': brick_id, 'x': x, 'y': y, 'z': z, 'ori': ori}
+                for i, (brick_id, x, y, z, ori)
+                in enumerate(zip(brick_ids, array['x'].tolist(), array['y'].tolist(), array['z'].tolist(), oris))}
 
     def to_txt(self) -> str:
-        return ''.join([brick.to_txt() for brick in self.bricks])
+        return ('%dx%d (%d,%d,%d)\n' * self._n_bricks) % tuple(self.array.view((np.int16, 5)).ravel().tolist())
 
     def to_ldr(self) -> str:
-        return ''.join([brick.to_ldr() for brick in self.bricks])
+        array = self.array
+        x = ((array['x'] + array['h'] * 0.5) * 20).tolist()
+        z = ((array['y'] + array['w'] * 0.5) * 20).tolist()
+        y = (array['z'].astype(int) * -24).tolist()
+        matrices = _LDR_MATRICES[(array['h'] > array['w']).astype(int)].tolist()
+        part_ids = brick_library_tables.part_ids[self._brick_ids()].tolist()
+        return ('1 115 %r %r %r %s %s\n0 STEP\n' * self._n_bricks) \
+            % tuple(value for line in zip(x, y, z, matrices, part_ids) for value in line)
+
+    def _brick_ids(self) -> np.ndarray:
+        """
+        Returns the brick ID of every brick.
+        """
+        array = self.array
+        h, w = array['h'], array['w']
+        table = brick_library_tables.dimensions_to_brick_id
+        in_table = (h >= 0) & (h < len(table)) & (w >= 0) & (w < len(table))
+        brick_ids = np.where(in_table, table[h.clip(0, len(table) - 1), w.clip(0, len(table) - 1)], -1)
+        if np.any(brick_ids < 0):
+            i = np.argmax(brick_ids < 0)
+            raise ValueError(f'No brick ID for brick of dimensions: {h[i]}x{w[i]}')
+        return brick_ids
 
     def add_brick(self, brick: Brick) -> None:
-        self.bricks.append(brick)
-        self.voxel_occupancy[brick.slice] += 1
+        if not all(_INT16_MIN <= n <= _INT16_MAX for n in (brick.h, brick.w, brick.x, brick.y, brick.z)):
+            _check_brick_numbers(np.array([brick.h, brick.w, brick.x, brick.y, brick.z]))
+        if self._n_bricks == len(self._array):
+            self._array = np.resize(self._array, max(2 * len(self._array), 16))
+        self._array[self._n_bricks] = (brick.h, brick.w, brick.x, brick.y, brick.z)
+        self._n_bricks += 1
+        if self._bricks is not None:
+            self._bricks.append(brick)
+        self._occupy(brick.h, brick.w, brick.x, brick.y, brick.z)
+        if self._connectivity is not None:
+            self._connectivity.add(brick.h, brick.w, brick.x, brick.y, brick.z)
+
+    def _occupy(self, h: int, w: int, x: int, y: int, z: int) -> None:
+        """
+        Adds a brick to the voxel occupancy and the layer bitboards.
+        """
+        world_dim = self.world_dim
+        self.voxel_occupancy[x:x + h, y:y + w, z] += 1
+        if 0 <= x and x + h <= world_dim and 0 <= y and y + w <= world_dim and 0 <= z < world_dim:
+            self._layers[z] |= _footprint_mask(h, w, world_dim) << (x * world_dim + y)
+        else:
+            self._update_layer(z)
 
     def undo_add_brick(self) -> None:
-        brick = self.bricks[-1]
-        self.voxel_occupancy[brick.slice] -= 1
-        self.bricks.pop()
+        self.truncate(self._n_bricks - 1)
+
+    def truncate(self, n_bricks: int) -> None:
+        """
+        Removes all bricks after the first n_bricks bricks. The brick array is truncated in O(1) time,
+        and only the removed bricks are cleared from the occupancy grid.
+        """
+        if not 0 <= n_bricks <= self._n_bricks:
+            raise ValueError(f'Cannot truncate a structure of {self._n_bricks} bricks to {n_bricks} bricks.')
+        removed_layers = set()
+        for h, w, x, y, z in self._array[n_bricks:self._n_bricks].tolist():
+            self.voxel_occupancy[x:x + h, y:y + w, z] -= 1
+            removed_layers.add(z)
+        for z in removed_layers:  # Voxels of removed bricks may still be occupied by colliding bricks
+            self._update_layer(z)
+        if self._connectivity is not None:
+            for _ in range(self._n_bricks - n_bricks):
+                self._connectivity.undo_add()
+        self._n_bricks = n_bricks
+        if self._bricks is not None:
+            del self._bricks[n_bricks:]
+
+    def _update_layer(self, z: int) -> None:
+        """
+        Rebuilds the bitboard of layer z from the voxel occupancy.
+        """
+        occupied = (self.voxel_occupancy[:, :, z] > 0).ravel()
+        self._layers[z] = int.from_bytes(np.packbits(occupied, bitorder='little').tobytes(), 'little')
 
     def has_out_of_bounds_bricks(self) -> bool:
-        return any(not self.brick_in_bounds(brick) for brick in self.bricks)
+        return not np.all(_in_bounds_mask(self.array, self.world_dim))
 
     def brick_in_bounds(self, brick: Brick) -> bool:
-        return (all(slice_.start >= 0 and slice_.stop <= self.world_dim for slice_ in brick.slice_2d)
+        return (0 <= brick.x and brick.x + brick.h <= self.world_dim
+                and 0 <= brick.y and brick.y + brick.w <= self.world_dim
                 and 0 <= brick.z < self.world_dim)
 
     def has_collisions(self) -> bool:
         return np.any(self.voxel_occupancy > 1)
 
     def brick_collides(self, brick: Brick) -> bool:
-        return np.any(self.voxel_occupancy[brick.slice])
+        if not self.brick_in_bounds(brick):
+            return np.any(self.voxel_occupancy[brick.slice])
+        return self._overlaps_layer(brick, brick.z)
+
+    def _overlaps_layer(self, brick: Brick, z: int) -> bool:
+        """
+        Returns whether the footprint of an in-bounds brick overlaps any occupied voxel in layer z.
+        """
+        return self._layers[z] & self._footprint(brick) != 0
+
+    def _footprint(self, brick: Brick) -> int:
+        return _footprint_mask(brick.h, brick.w, self.world_dim) << (brick.x * self.world_dim + brick.y)
+
+    def free_positions(self, h: int, w: int, z: int) -> np.ndarray:
+        """
+        Returns a boolean array indexed by (x, y) that is True where a brick of dimensions h x w can be placed
+        in layer z without being out of bounds or colliding with another brick.
+        """
+        world_dim = self.world_dim
+        if h > world_dim or w > world_dim:
+            return np.zeros((world_dim, world_dim), dtype=bool)
+
+        # Set the bit of every position whose footprint covers an occupied voxel, by spreading each occupied voxel
+        # to the positions w - 1 voxels before it along y, then h - 1 voxels before it along x
+        blocked = 0
+        for j in range(w):
+            blocked |= self._layers[z] >> j
+        blocked_2d = 0
+        for i in range(h):
+            blocked_2d |= blocked >> (i * world_dim)
+        free = ~blocked_2d & _footprint_mask(world_dim - h + 1, world_dim - w + 1, world_dim)
+
+        n_bits = world_dim * world_dim
+        free_bytes = np.frombuffer(free.to_bytes((n_bits + 7) // 8, 'little'), dtype=np.uint8)
+        return np.unpackbits(free_bytes, bitorder='little')[:n_bits].reshape(world_dim, world_dim).astype(bool)
+
+    def feasible_positions(self, h: int, w: int) -> np.ndarray:
+        """
+        Returns a boolean array indexed by (x, y, z) that is True where a brick of dimensions h x w can be placed
+        without being out of bounds or colliding with another brick.
+        """
+        feasible = np.zeros_like(self.voxel_occupancy, dtype=bool)
+        if h > self.world_dim or w > self.world_dim:
+            return feasible
+
+        # Count occupied voxels under every h x w window of each layer at once, using a summed-area table
+        sat = np.zeros((self.world_dim + 1, self.world_dim + 1, self.world_dim), dtype=int)
+        sat[1:, 1:] = (self.voxel_occupancy > 0).cumsum(axis=0).cumsum(axis=1)
+        n_occupied = sat[h:, w:] - sat[:-h, w:] - sat[h:, :-w] + sat[:-h, :-w]
+        feasible[:self.world_dim - h + 1, :self.world_dim - w + 1] = n_occupied == 0
+        return feasible
 
     def has_floating_bricks(self) -> bool:
         return any(self.brick_floats(brick) for brick in self.bricks)
@@ -181,24 +366,61 @@ class BrickStructure:
     def brick_floats(self, brick: Brick) -> bool:
         if brick.z == 0:
             return False  # Supported by ground
+        if self.brick_in_bounds(brick):
+            return not (self._overlaps_layer(brick, brick.z - 1)  # Supported from below
+                        or brick.z != self.world_dim - 1 and self._overlaps_layer(brick, brick.z + 1))  # From above
         if np.any(self.voxel_occupancy[brick.slice_2d[0], brick.slice_2d[1], brick.z - 1]):
             return False  # Supported from below
         if brick.z != self.world_dim - 1 and np.any(self.voxel_occupancy[brick.slice_2d[0], brick.slice_2d[1], brick.z + 1]):
             return False  # Supported from above
         return True
 
-    def is_stable(self) -> bool:
+    def is_stable(self, solver: str = 'gurobi', static_screen: bool = False) -> bool:
+        """
+        :param solver: The solver for the stability analysis, 'gurobi' or 'highs'. See StabilityConfig.
+        :param static_screen: Whether to skip the stability analysis if the static screen decides the stability.
+        """
         if self.has_floating_bricks() or self.has_collisions():
             return False
-        return self.stability_scores().max() < 1
-
-    def stability_scores(self) -> np.ndarray:
+        if static_screen:  # The screen never contradicts the stability analysis
+            is_stable = self.static_screen().is_stable
+            if is_stable is not None:
+                return is_stable
+        return self.stability_scores(solver).max() < 1
+
+    def static_screen(self) -> StaticScreen:
+        """
+        Returns which bricks are certainly stable or unstable, from a quick check of the loads on each brick.
+        See static_stability_screen.
+        """
+        if self.has_collisions():
+            raise ValueError('Cannot screen stability - structure has colliding bricks.')
+        if self.has_out_of_bounds_bricks():
+            raise ValueError('Cannot screen stability - structure has out of bounds bricks.')
+        return static_stability_screen(self.to_json(), brick_library,
+                                       StabilityConfig(world_dimension=(self.world_dim,) * 3))
+
+    def stability_scores(self, solver: str = 'gurobi', incremental_model: IncrementalStabilityModel | None = None,
+                         component_workers: int = 0) -> np.ndarray:
+        """
+        :param solver: The solver for the stability analysis, 'gurobi' or 'highs'. See StabilityConfig.
+        :param incremental_model: If given, a Gurobi stability model that is updated to this structure and solved,
+                                  instead of building a new model. The solver and component_workers are ignored.
+        :param component_workers: If positive, each group of bricks in contact is analyzed with a separate model,
+                                  on this many threads.
+        """
         if self.has_collisions():
             raise ValueError('Cannot compute stability scores - structure has colliding bricks.')
         if self.has_out_of_bounds_bricks():
             raise ValueError('Cannot compute stability scores - structure has out of bounds bricks.')
+        if incremental_model is not None:
+            if incremental_model.cfg.world_dimension != (self.world_dim,) * 3:
+                raise ValueError('Cannot compute stability scores - the incremental model has a different world size.')
+            scores, _, _, _, _ = incremental_model.stability_score(self.to_json())
+            return scores
         scores, _, _, _, _ = stability_score(self.to_json(), brick_library,
-                                             StabilityConfig(world_dimension=(self.world_dim,) * 3))
+                                             StabilityConfig(world_dimension=(self.world_dim,) * 3, solver=solver,
+                                                             component_workers=component_workers))
         return scores
 
     def is_connected(self) -> bool:
@@ -206,6 +428,20 @@ class BrickStructure:
             return False
         return self.connectivity_scores().max() < 1
 
+    def is_grounded(self) -> bool:
+        """
+        Returns whether every brick is connected to the ground, and no brick collides or is out of bounds.
+        For structures without colliding or out-of-bounds bricks, this is the same as is_connected.
+
+        The connectivity is tracked incrementally once this has been called, so that calling it after every
+        add_brick or undo_add_brick takes O(log n) time.
+        """
+        if self._connectivity is None:
+            self._connectivity = GroundConnectivity(self.world_dim)
+            for brick in self.array.tolist():
+                self._connectivity.add(*brick)
+        return self._connectivity.is_grounded()
+
     def connectivity_scores(self) -> np.ndarray:
         if self.has_collisions():
             raise ValueError('Cannot compute connectivity scores - structure has colliding bricks.')
@@ -214,6 +450,31 @@ class BrickStructure:
         scores = connectivity_score(self)
         return scores
 
+    def longest_connected_prefix(self) -> int:
+        """
+        Returns the largest n such that the first n bricks form a connected structure.
+
+        Adding a brick never disconnects another brick from the ground. So if the first unconnected brick of the
+        structure is brick i, no prefix of more than i bricks is connected either, and repeatedly removing all bricks
+        starting from the first unconnected brick ends at this prefix.
+        """
+        if self.has_collisions():
+            raise ValueError('Cannot compute connected prefix - structure has colliding bricks.')
+        if self.has_out_of_bounds_bricks():
+            raise ValueError('Cannot compute connected prefix - structure has out of bounds bricks.')
+        return longest_connected_prefix(self)
+
+    def voxel_brick_indices(self) -> np.ndarray:
+        """
+        Returns an int array indexed by (x, y, z) that holds the index of the brick occupying each voxel,
+        or -1 for empty voxels. Where bricks collide, the voxel holds one of their indices.
+        Out-of-bounds bricks are left out.
+        """
+        _, brick_indices, voxels = _in_bounds_voxels(self.array, self.world_dim)
+        result = np.full(self.world_dim ** 3, -1, dtype=np.int32)
+        result[voxels] = brick_indices
+        return result.reshape((self.world_dim,) * 3)
+
     @classmethod
     def from_json(cls, bricks_json: dict):
         bricks = [Brick.from_json(v) for k, v in bricks_json.items() if k.isdigit()]
@@ -221,14 +482,148 @@ class BrickStructure:
 
     @classmethod
     def from_txt(cls, bricks_txt: str):
-        bricks_txt = bricks_txt.split('\n')
-        bricks_txt = [b for b in bricks_txt if b.strip()]  # Remove blank lines
-        bricks = [Brick.from_txt(brick) for brick in bricks_txt]
-        return cls(bricks)
+        return cls.from_array(bricks_txt_to_array(bricks_txt))
 
     @classmethod
     def from_ldr(cls, bricks_ldr: str):
-        bricks_ldr = bricks_ldr.split('0 STEP')  # Split on step lines
-        bricks_ldr = [b for b in bricks_ldr if b.strip()]  # Remove blank or whitespace-only lines
-        bricks = [Brick.from_ldr(brick) for brick in bricks_ldr]
-        return cls(bricks)
+        return cls.from_array(bricks_ldr_to_array(bricks_ldr))
+
+    @classmethod
+    def from_array(cls, array: np.ndarray, world_dim: int = 20):
+        """
+        Builds a brick structure from a brick array with fields (h, w, x, y, z), without creating Brick objects.
+        """
+        if len(array) and array['z'].min() != 0:
+            warnings.warn('Brick structure does not start at ground level z=0.')
+
+        if array.dtype != brick_dtype:
+            _check_brick_numbers(np.stack([array[name] for name in brick_dtype.names], axis=-1))
+
+        result = cls([], world_dim)
+        result._array = np.array(array, dtype=brick_dtype)
+        result._n_bricks = len(array)
+        result._bricks = None
+
+        # Count the voxels of all in-bounds bricks at once. Out-of-bounds bricks are added one at a time,
+        # so that they are clipped the same way as in add_brick.
+        in_bounds, _, voxels = _in_bounds_voxels(result._array, world_dim)
+        n_bricks_per_voxel = np.bincount(voxels, minlength=world_dim ** 3)
+        result.voxel_occupancy += n_bricks_per_voxel.astype(np.uint8).reshape((world_dim,) * 3)
+        occupied = (result.voxel_occupancy > 0).transpose(2, 0, 1).reshape(world_dim, -1)
+        result._layers = [int.from_bytes(layer.tobytes(), 'little')
+                          for layer in np.packbits(occupied, axis=1, bitorder='little')]
+        for brick in result._array[~in_bounds].tolist():
+            result._occupy(*brick)
+        return result
+
+
+def _in_bounds_mask(array: np.ndarray, world_dim: int) -> np.ndarray:
+    h, w, x, y, z = (array[name].astype(int) for name in brick_dtype.names)
+    return (x >= 0) & (x + h <= world_dim) & (y >= 0) & (y + w <= world_dim) & (z >= 0) & (z < world_dim)
+
+
+def _in_bounds_voxels(array: np.ndarray, world_dim: int) -> (np.ndarray, np.ndarray, np.ndarray):
+    """
+    Lists the voxels of all in-bounds bricks in a brick array at once.
+    :return: A mask of the in-bounds bricks, and the brick index and flat voxel index of every voxel they occupy.
+    """
+    h, w, x, y, z = (array[name].astype(int) for name in brick_dtype.names)
+    in_bounds = _in_bounds_mask(array, world_dim)
+    brick_indices = np.flatnonzero(in_bounds)
+    h, w, x, y, z = (column[in_bounds] for column in (h, w, x, y, z))
+    brick_idx = np.repeat(np.arange(len(h)), h * w)
+    voxel_idx = np.arange(len(brick_idx)) - np.repeat(np.cumsum(h * w) - h * w, h * w)  # Index within brick
+    voxels = np.ravel_multi_index((x[brick_idx] + voxel_idx // w[brick_idx],
+                                   y[brick_idx] + voxel_idx % w[brick_idx], z[brick_idx]), (world_dim,) * 3)
+    return in_bounds, brick_indices[brick_idx], voxels
+
+
+_BRICKS_TXT_PATTERN = re.compile(r'(?:\d+x\d+ \(\d+,\d+,\d+\)\n)*')
+_BRICK_TXT_SEPARATORS = str.maketrans('x(),', '    ')
+
+
+def bricks_txt_to_array(bricks_txt: str) -> np.ndarray:
+    """
+    Parses bricks in txt format, one per line, into a brick array. The text is checked with one regex
+    and converted to numbers in one pass, without creating Brick objects. Blank lines are ignored.
+    :param bricks_txt: The bricks in txt format.
+    :return: A brick array with fields (h, w, x, y, z).
+    """
+    return bricks_txt_to_arrays([bricks_txt])[0]
+
+
+def bricks_txt_to_arrays(bricks_txts: list[str]) -> list[np.ndarray]:
+    """
+    Parses several brick structures in txt format into brick arrays, with a single pass over all of them.
+    :param bricks_txts: The brick structures in txt format.
+    :return: A brick array with fields (h, w, x, y, z) for each brick structure.
+    """
+    lines = [[line.strip() for line in bricks_txt.split('\n')] for bricks_txt in bricks_txts]
+    lines = [[line for line in structure_lines if line] for structure_lines in lines]  # Remove blank lines
+    text = ''.join(line + '\n' for structure_lines in lines for line in structure_lines)
+    if not (text.isascii() and _BRICKS_TXT_PATTERN.fullmatch(text)):
+        return [_parse_bricks(structure_lines, Brick.from_txt) for structure_lines in lines]
+
+    numbers = np.fromstring(text.translate(_BRICK_TXT_SEPARATORS), dtype=np.int64, sep=' ').reshape(-1, 5)
+    split_indices = np.cumsum([len(structure_lines) for structure_lines in lines])[:-1]
+    return np.split(_numbers_to_brick_array(numbers), split_indices)
+
+
+_LDR_MATRIX_ORIS = {tuple(matrix.split()): ori for ori, matrix in enumerate(_LDR_MATRICES)}
+
+
+def bricks_ldr_to_array(bricks_ldr: str) -> np.ndarray:
+    """
+    Parses bricks in LDR format, each followed by a step line, into a brick array.
+    All bricks are converted to positions at once, without creating Brick objects.
+    :param bricks_ldr: The bricks in LDR format.
+    :return: A brick array with fields (h, w, x, y, z).
+    """
+    bricks_ldr = bricks_ldr.split('0 STEP')  # Split on step lines
+    bricks_ldr = [b for b in bricks_ldr if b.strip()]  # Remove blank or whitespace-only lines
+    if not bricks_ldr:
+        return np.zeros(0, dtype=brick_dtype)
+
+    components = [b.split() for b in bricks_ldr]
+    part_id_to_brick_id_dict = brick_library_tables.part_id_to_brick_id
+    if not all(len(c) == 15 and c[0] == '1' and tuple(c[5:14]) in _LDR_MATRIX_ORIS
+               and c[14] in part_id_to_brick_id_dict for c in components):
+        return _parse_bricks(bricks_ldr, Brick.from_ldr)
+    try:
+        x0, y0, z0 = np.array([c[2:5] for c in components], dtype=float).T
+    except ValueError:
+        return _parse_bricks(bricks_ldr, Brick.from_ldr)
+
+    oris = np.array([_LDR_MATRIX_ORIS[tuple(c[5:14])] for c in components])
+    brick_ids = np.array([part_id_to_brick_id_dict[c[14]] for c in components])
+    h, w = brick_library_tables.dimensions[brick_ids].T
+    h, w = np.where(oris == 1, w, h), np.where(oris == 1, h, w)
+    x = np.trunc(x0 / 20 - h * 0.5)
+    y = np.trunc(z0 / 20 - w * 0.5)
+    z = np.trunc(-y0 / 24)
+    return _numbers_to_brick_array(np.stack([h, w, x, y, z], axis=1).astype(np.int64))
+
+
+def _numbers_to_brick_array(numbers: np.ndarray) -> np.ndarray:
+    """
+    Converts an (n, 5) integer array of (h, w, x, y, z) rows to a brick array.
+    """
+    _check_brick_numbers(numbers)
+    return np.ascontiguousarray(numbers.astype(np.int16)).view(brick_dtype).reshape(-1)
+
+
+def _check_brick_numbers(numbers: np.ndarray) -> None:
+    """
+    Raises a ValueError if brick dimensions or positions do not fit in a brick array.
+    """
+    if np.any((numbers < _INT16_MIN) | (numbers > _INT16_MAX)):
+        raise ValueError(f'Brick dimensions and positions must be between {_INT16_MIN} and {_INT16_MAX}.')
+
+
+def _parse_bricks(bricks: list[str], parse_brick) -> np.ndarray:
+    """
+    Parses bricks one at a time. Used as the fallback of the bulk parsers, which raises the same error
+    as the per-brick parser on the first ill-formatted brick.
+    """
+    numbers = np.array([(b.h, b.w, b.x, b.y, b.z) for b in map(parse_brick, bricks)], dtype=np.int64)
+    return _numbers_to_brick_array(numbers.reshape(-1, 5))
@@ -0,0 +1,195 @@
+import hashlib
+import os
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Literal
+
+import numpy as np
+
+from brickgpt.stability_analysis import IncrementalStabilityModel
+from .brick_structure import BrickStructure
+
+StabilityMethod = Literal['gurobi', 'highs', 'connectivity']
+
+
+@dataclass
+class _StabilityResult:
+    is_stable: bool
+    scores: np.ndarray | None  # None if is_stable was decided without computing the scores
+
+
+class StabilityCache:
+    """
+    Caches the stability of brick structures, so that each unique structure is only analyzed once.
+
+    Structures are keyed by a hash of their sorted brick array, so structures with the same bricks in a different order
+    share an entry. Entries are kept in memory up to a maximum number, evicting the least recently used entry first,
+    and can additionally be saved to a directory that persists between runs.
+    """
+
+    def __init__(self, max_size: int = 1024, cache_dir: str | Path | None = None,
+                 incremental_model: IncrementalStabilityModel | None = None, component_workers: int = 0,
+                 static_screen: bool = False):
+        """
+        :param max_size: The maximum number of structures kept in memory. Set to 0 to disable the in-memory cache.
+        :param cache_dir: If given, the directory in which the stability of every analyzed structure is saved,
+                          and from which it is loaded on in-memory cache misses.
+        :param incremental_model: If given, the Gurobi stability model that is updated and solved on cache misses
+                                  of the 'gurobi' method, instead of building a new model for each structure.
+        :param component_workers: If positive, each group of bricks in contact is analyzed with a separate model,
+                                  on this many threads.
+        :param static_screen: Whether to skip the stability analysis of the 'gurobi' and 'highs' methods for structures
+                              whose stability the static screen decides. Screened stable structures get all-zero
+                              scores. See BrickStructure.static_screen.
+        """
+        self.max_size = max_size
+        self.incremental_model = incremental_model
+        self.component_workers = component_workers
+        self.static_screen = static_screen
+        self.cache_dir = None if cache_dir is None else Path(cache_dir)
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+        self._entries = OrderedDict()  # Maps structure keys to results, in least recently used order
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.solves = 0  # Misses that needed the stability scores to be computed
+        self.screened = 0  # Misses that the static screen decided without computing the stability scores
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict[str, int]:
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses, 'solves': self.solves,
+                'screened': self.screened, 'size': len(self)}
+
+    def clear(self) -> None:
+        """
+        Clears the in-memory cache and resets the counters. Saved entries are kept.
+        """
+        self._entries.clear()
+        self.hits = self.disk_hits = self.misses = self.solves = self.screened = 0
+
+    def is_stable(self, bricks: BrickStructure, method: StabilityMethod = 'gurobi') -> bool:
+        """
+        Returns whether the structure is stable, as BrickStructure.is_stable or BrickStructure.is_connected.
+        """
+        key = self.key(bricks, method)
+        result = self._get(key)
+        if result is not None:
+            self.hits += 1
+            return result.is_stable
+
+        self.misses += 1
+        if bricks.has_floating_bricks() or bricks.has_collisions():
+            result = _StabilityResult(False, None)
+        else:
+            is_stable = self._screen(bricks, method)
+            if is_stable is not None:
+                self.screened += 1
+                result = _StabilityResult(is_stable, self._stable_scores(bricks) if is_stable else None)
+            else:
+                scores = self._compute_scores(bricks, method)
+                result = _StabilityResult(bool(scores.max() < 1), scores)
+        self._put(key, result)
+        return result.is_stable
+
+    def stability_scores(self, bricks: BrickStructure, method: StabilityMethod = 'gurobi') -> np.ndarray:
+        """
+        Returns the stability scores of the structure, as BrickStructure.stability_scores or
+        BrickStructure.connectivity_scores. The returned array must not be modified.
+        """
+        key = self.key(bricks, method)
+        result = self._get(key)
+        if result is not None and result.scores is not None:
+            self.hits += 1
+            return result.scores
+
+        self.misses += 1
+        if result is None and self._screen(bricks, method):
+            self.screened += 1  # The analysis scores every voxel of a certainly stable structure 0
+            scores = self._stable_scores(bricks)
+        else:
+            scores = self._compute_scores(bricks, method)
+        if result is None:
+            is_stable = not (bricks.has_floating_bricks() or bricks.has_collisions()) and bool(scores.max() < 1)
+            result = _StabilityResult(is_stable, scores)
+        else:
+            result = _StabilityResult(result.is_stable, scores)
+        self._put(key, result)
+        return scores
+
+    @staticmethod
+    def key(bricks: BrickStructure, method: StabilityMethod = 'gurobi') -> str:
+        """
+        Returns the cache key of a structure, which is the same for every order of the same bricks.
+        """
+        digest = hashlib.blake2b(np.sort(bricks.array).tobytes(), digest_size=16).hexdigest()
+        return f'{method}-{bricks.world_dim}-{digest}'
+
+    def _compute_scores(self, bricks: BrickStructure, method: StabilityMethod) -> np.ndarray:
+        self.solves += 1
+        if method == 'gurobi':
+            return bricks.stability_scores(method, self.incremental_model, self.component_workers)
+        if method == 'highs':
+            return bricks.stability_scores(method, component_workers=self.component_workers)
+        if method == 'connectivity':
+            return bricks.connectivity_scores()
+        raise ValueError(f'Unknown stability method: {method}')
+
+    def _screen(self, bricks: BrickStructure, method: StabilityMethod) -> bool | None:
+        """
+        Returns whether the structure is certainly stable or unstable under a physics-based method, or None.
+        """
+        if not self.static_screen or method == 'connectivity':
+            return None
+        return bricks.static_screen().is_stable
+
+    @staticmethod
+    def _stable_scores(bricks: BrickStructure) -> np.ndarray:
+        return np.zeros((bricks.world_dim,) * 3)
+
+    def _get(self, key: str) -> _StabilityResult | None:
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        result = self._load(key)
+        if result is not None:
+            self.disk_hits += 1
+            self._remember(key, result)
+        return result
+
+    def _put(self, key: str, result: _StabilityResult) -> None:
+        if result.scores is not None:
+            result.scores.flags.writeable = False
+            self._save(key, result)
+        self._remember(key, result)
+
+    def _remember(self, key: str, result: _StabilityResult) -> None:
+        if self.max_size <= 0:
+            return
+        self._entries[key] = result
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _load(self, key: str) -> _StabilityResult | None:
+        if self.cache_dir is None:
+            return None
+        path = self.cache_dir / f'{key}.npz'
+        if not path.exists():
+            return None
+        with np.load(path) as data:
+            scores = data['scores']
+            scores.flags.writeable = False
+            return _StabilityResult(bool(data['is_stable']), scores)
+
+    def _save(self, key: str, result: _StabilityResult) -> None:
+        if self.cache_dir is None:
+            return
+        # Write to a temporary file first, so that concurrent readers never see a partially written entry
+        tmp_path = self.cache_dir / f'{key}.{os.getpid()}.tmp.npz'
+        np.savez_compressed(tmp_path, is_stable=result.is_stable, scores=result.scores)
+        os.replace(tmp_path, self.cache_dir / f'{key}.npz')
+
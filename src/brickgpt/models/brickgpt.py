@@ -1,18 +1,21 @@
+import contextlib
 import copy
 import functools
 import json
 import warnings
-from collections import Counter
+from collections import Counter, deque
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Callable, Literal
+from typing import Literal
 
 import numpy as np
 import torch
-from transformers.generation.logits_process import PrefixConstrainedLogitsProcessor, LogitsProcessorList
 
-from brickgpt.data import max_brick_dimension, BrickStructure, Brick
-from .llm import LLM
+from brickgpt.data import (max_brick_dimension, dimensions_to_brick_id, BrickStructure, Brick, StabilityCache,
+                           brick_library)
+from brickgpt.stability_analysis import IncrementalStabilityModel, StabilityConfig
+from .llm import LLM, LLMBatch, AllowedTokensMask, RejectionTrie, resolve_mask
+from .profiler import Profiler
 
 
 @dataclass
@@ -38,6 +41,22 @@ class BrickGPTConfig:
         metadata={'help': 'The maximum number of rejections per generated brick during rejection sampling. '
                           'Set to 0 if you want to disable rejection sampling.'},
     )
+    rejection_sampling_batch_size: int = field(
+        default=1,
+        kw_only=True,
+        metadata={'help': 'The number of candidate bricks to sample in parallel from the same prefix '
+                          'during rejection sampling. The first valid candidate in sampling order is accepted. '
+                          'Set to 1 to sample candidates one at a time. '
+                          'Has no effect if use_logit_masking=False.'},
+    )
+    prefix_cache_size: int = field(
+        default=8,
+        kw_only=True,
+        metadata={'help': 'The maximum number of prompt prefixes whose KV cache is kept between generations, '
+                          'such as the system message and instruction shared by all captions, '
+                          'and the full instruction of recently used captions. '
+                          'The least recently used prefix is evicted first. Set to 0 to disable.'},
+    )
     use_logit_masking: bool = field(
         default=True,
         kw_only=True,
@@ -45,6 +64,21 @@ class BrickGPTConfig:
                           'to enforce compliance with the brick syntax. '
                           'If False, the brick will be checked for validity after generation.'},
     )
+    use_occupancy_masking: bool = field(
+        default=False,
+        kw_only=True,
+        metadata={'help': 'Whether to also mask out tokens that would make the brick collide with the structure, '
+                          'be out of bounds, or have dimensions that are not in the brick library. '
+                          'The allowed tokens for each part of the brick are computed from the bricks placed so far, '
+                          'so these rejections never happen. Has no effect if use_logit_masking=False.'},
+    )
+    ban_rejected_bricks: bool = field(
+        default=True,
+        kw_only=True,
+        metadata={'help': 'Whether to mask out tokens that would complete an already rejected brick '
+                          'during rejection sampling, so that rejected bricks are never generated again. '
+                          'Has no effect if use_logit_masking=False.'},
+    )
     max_regenerations: int = field(
         default=100,
         kw_only=True,
@@ -59,6 +93,52 @@ class BrickGPTConfig:
                           'If False, will default to a simpler, but less accurate connectivity-based stability check. '
                           'This option is useful if you do not have a Gurobi licence.'},
     )
+    stability_solver: Literal['gurobi', 'highs'] = field(
+        default='gurobi',
+        kw_only=True,
+        metadata={'help': 'The solver for physics-based stability analysis, used if use_gurobi is True. '
+                          '"highs" uses the open-source HiGHS solver, which does not need a Gurobi licence.'},
+    )
+    incremental_stability: bool = field(
+        default=False,
+        kw_only=True,
+        metadata={'help': 'Whether to keep one Gurobi stability model alive during generation and update it as bricks '
+                          'are added and removed, instead of building a new model for every stability check. '
+                          'Only applies if use_gurobi is True and stability_solver is "gurobi".'},
+    )
+    stability_workers: int = field(
+        default=0,
+        kw_only=True,
+        metadata={'help': 'If positive, the stability of each group of bricks in contact is analyzed with a separate '
+                          'model, on this many threads. Does not apply with incremental_stability.'},
+    )
+    stability_screen: bool = field(
+        default=False,
+        kw_only=True,
+        metadata={'help': 'Whether to skip the physics-based stability analysis for brick structures that a quick '
+                          'static check of the loads on each brick finds certainly stable or certainly unstable. '
+                          'Screened stable structures get all-zero stability scores, which can change the output.'},
+    )
+    stop_when_disconnected: bool = field(
+        default=False,
+        kw_only=True,
+        metadata={'help': 'Whether to stop generating a brick structure as soon as a brick is added that is not '
+                          'connected to the ground, and roll back and regenerate from there, instead of finishing '
+                          'the structure first. Only applies while regenerations remain.'},
+    )
+    stability_cache_size: int = field(
+        default=1024,
+        kw_only=True,
+        metadata={'help': 'The maximum number of brick structures whose stability is kept in memory between checks, '
+                          'so that each unique structure is only analyzed once. '
+                          'The least recently used structure is evicted first. Set to 0 to disable.'},
+    )
+    stability_cache_dir: str | None = field(
+        default=None,
+        kw_only=True,
+        metadata={'help': 'If given, the directory in which the stability of every analyzed brick structure is saved, '
+                          'so that it can be reused between runs.'},
+    )
     temperature: float = field(
         default=0.6,
         kw_only=True,
@@ -68,7 +148,8 @@ class BrickGPTConfig:
         default=0.01,
         kw_only=True,
         metadata={'help': 'The amount by which to increase the temperature '
-                          'after each "already_rejected" brick during rejection sampling.'},
+                          'after each "already_rejected" brick during rejection sampling. Set to 0 to disable. '
+                          'Rarely needed if ban_rejected_bricks=True, which prevents most "already_rejected" bricks.'},
     )
     max_temperature: float = field(
         default=2.0,
@@ -87,6 +168,14 @@ class BrickGPTConfig:
         metadata={'help': 'The cumulative probability threshold for nucleus sampling. '
                           'Has no effect if use_logit_masking=True.'},
     )
+    profile: bool = field(
+        default=False,
+        kw_only=True,
+        metadata={'help': 'Whether to record the wall time and number of calls of each stage of generation '
+                          '(prefill, decode, checkpoint, validation, stability, truncation), '
+                          'the number of generated tokens, and the peak KV cache size in bytes. '
+                          'If True, these are returned under the "timings" key of the result.'},
+    )
     instruction_format: Literal['brickgpt', 'few_shot', 'zero_shot'] = field(
         default='brickgpt',
         kw_only=True,
@@ -107,14 +196,49 @@ def get_device() -> str:
         return 'cuda' if torch.cuda.is_available() else 'cpu'
 
 
+@dataclass
+class _BatchSequence:
+    """
+    The generation state of one brick structure in BrickGPT.generate_batch.
+    """
+    caption: str
+    generator: torch.Generator | None = None
+    bricks: BrickStructure = field(default_factory=lambda: BrickStructure([]))
+    rejection_reasons: Counter = field(default_factory=Counter)
+    regeneration_num: int = 0
+    n_new_bricks: int = 0
+    brick_offsets: list[int] = field(default_factory=list)  # The token offset at which each brick starts
+
+    # State of the brick currently being generated
+    brick_ids: list[int] = field(default_factory=list)
+    brick_masks: tuple = ()
+    rejected_bricks_trie: RejectionTrie | None = None
+    brick_start: int = 0
+    brick_rejection_reasons: Counter = field(default_factory=Counter)
+    rejected_bricks: set[str] = field(default_factory=set)
+    generation_num: int = 0
+    temperature: float = 0.0
+
+
 class BrickGPT:
     def __init__(self, cfg: BrickGPTConfig):
         self.world_dim = cfg.world_dim
         self.max_bricks = cfg.max_bricks
         self.max_brick_rejections = cfg.max_brick_rejections
+        self.rejection_sampling_batch_size = cfg.rejection_sampling_batch_size
         self.use_logit_masking = cfg.use_logit_masking
+        self.use_occupancy_masking = cfg.use_occupancy_masking
+        self.ban_rejected_bricks = cfg.ban_rejected_bricks
         self.max_regenerations = cfg.max_regenerations
         self.use_gurobi = cfg.use_gurobi
+        self.stability_solver = cfg.stability_solver
+        self.stop_when_disconnected = cfg.stop_when_disconnected
+        incremental_model = None
+        if cfg.incremental_stability and self.use_gurobi and self.stability_solver == 'gurobi':
+            incremental_model = IncrementalStabilityModel(
+                brick_library, StabilityConfig(world_dimension=(self.world_dim,) * 3))
+        self.stability_cache = StabilityCache(cfg.stability_cache_size, cfg.stability_cache_dir, incremental_model,
+                                              cfg.stability_workers, cfg.stability_screen)
         self.temperature = cfg.temperature
         self.temperature_increase = cfg.temperature_increase
         self.max_temperature = cfg.max_temperature
@@ -129,45 +253,299 @@ class BrickGPT:
         }
         self.instruction_fn = instruction_fns[cfg.instruction_format]
 
-        self.llm = LLM(cfg.model_name_or_path, self.device)
+        self.llm = LLM(cfg.model_name_or_path, self.device, prefix_cache_size=cfg.prefix_cache_size)
+        self.profiler = Profiler(cfg.profile, self.device)
+        self.llm.profiler = self.profiler
+        self._static_prompt_prefix = None
 
     def __call__(self, caption: str) -> dict:
         bricks = None
         starting_bricks = BrickStructure([])
         rejection_reasons = Counter()
         regeneration_num = None
-
-        # Generate brick structure. If it is unstable, remove all bricks after the first unstable brick and regenerate.
-        for regeneration_num in range(self.max_regenerations + 1):
-            bricks, this_rejection_reasons = self._generate_structure(caption, starting_bricks=starting_bricks)
-            rejection_reasons.update(this_rejection_reasons)
-            if self.max_regenerations == 0 or self._is_stable(bricks):
-                break
-            if regeneration_num == self.max_regenerations:
-                warnings.warn(f'Failed to generate a stable structure after {regeneration_num + 1} attempts.\n')
-                break
-            starting_bricks = self._remove_all_bricks_after_first_unstable_brick(bricks)
-
-        return {
+        brick_offsets = []
+        self.profiler.reset()
+
+        with self.profiler.stage('total'):
+            self._cache_prompt_prefixes(caption)
+
+            # Generate brick structure.
+            # If it is unstable, remove all bricks after the first unstable brick and regenerate.
+            for regeneration_num in range(self.max_regenerations + 1):
+                stop_when_disconnected = self._stop_when_disconnected(regeneration_num)
+                if regeneration_num == 0:
+                    bricks, this_rejection_reasons = self._generate_structure(
+                        caption, starting_bricks, brick_offsets, stop_when_disconnected)
+                else:
+                    bricks, this_rejection_reasons = self._continue_structure(
+                        starting_bricks, brick_offsets, stop_when_disconnected)
+                rejection_reasons.update(this_rejection_reasons)
+                if self.max_regenerations == 0 or self._is_stable(bricks):
+                    break
+                if regeneration_num == self.max_regenerations:
+                    warnings.warn(f'Failed to generate a stable structure after {regeneration_num + 1} attempts.\n')
+                    break
+                starting_bricks = self._remove_all_bricks_after_first_unstable_brick(bricks)
+
+        result = {
             'bricks': bricks,
             'rejection_reasons': rejection_reasons,
             'n_regenerations': regeneration_num,
         }
+        if self.profiler.enabled:
+            result['timings'] = self.profiler.results()
+        return result
+
+    def generate_batch(self, captions: list[str], seeds: list[int] | None = None, batch_size: int = 8) -> list[dict]:
+        """
+        Generates one brick structure per caption, decoding up to `batch_size` structures together.
+        Each structure goes through its own rejection sampling and regeneration, as in __call__.
+        When a structure is finished, it leaves the batch and the next queued caption takes its place.
+        :param captions: The captions of the brick structures to be generated.
+        :param seeds: One random seed per caption. If None, sampling uses the global random state.
+        :param batch_size: The maximum number of brick structures to decode at once.
+        :return: One result per caption, in the same format as the result of __call__, but without timings.
+                 If profiling is enabled, the timings of the whole batch are available from self.profiler.results().
+        """
+        if not self.use_logit_masking:
+            raise ValueError('generate_batch requires use_logit_masking=True')
+        if seeds is not None and len(seeds) != len(captions):
+            raise ValueError(f'Got {len(seeds)} seeds for {len(captions)} captions')
+
+        self.profiler.reset()
+        n_brick_tokens = len(self._build_brick_syntax_masks())
+        eos_token_id = self.llm.tokenizer.eos_token_id
+        batch = LLMBatch(self.llm)
+        queue = deque(range(len(captions)))
+        sequences = {}
+        results = [None] * len(captions)
+
+        while queue or sequences:
+            # Replace finished structures with queued captions
+            while queue and len(sequences) < batch_size:
+                idx = queue.popleft()
+                generator = torch.Generator(self.device).manual_seed(seeds[idx]) if seeds is not None else None
+                sequences[idx] = _BatchSequence(caption=captions[idx], generator=generator)
+                self._cache_prompt_prefixes(captions[idx])
+                self._start_batch_structure(batch, idx, sequences[idx], BrickStructure([]))
+
+            next_tokens = batch.step(
+                {idx: resolve_mask(seq.brick_masks[len(seq.brick_ids)], seq.brick_ids)
+                 for idx, seq in sequences.items()},
+                {idx: seq.temperature for idx, seq in sequences.items()},
+                {idx: seq.generator for idx, seq in sequences.items()} if seeds is not None else None,
+            )
+            for idx, token_id in next_tokens.items():
+                seq = sequences[idx]
+                seq.brick_ids.append(token_id)
+                if token_id != eos_token_id and len(seq.brick_ids) < n_brick_tokens:
+                    continue  # Brick is not finished yet
+                if not self._finish_batch_brick(batch, idx, seq):
+                    continue  # Structure is not finished yet
+                if not self._finish_batch_structure(batch, idx, seq):
+                    continue  # Structure is being regenerated
+                results[idx] = {
+                    'bricks': seq.bricks,
+                    'rejection_reasons': seq.rejection_reasons,
+                    'n_regenerations': seq.regeneration_num,
+                }
+                batch.remove(idx)
+                sequences.pop(idx)
+
+        return results
+
+    def _start_batch_structure(
+            self,
+            batch: LLMBatch,
+            idx: int,
+            seq: '_BatchSequence',
+            starting_bricks: BrickStructure,
+    ) -> None:
+        """
+        Starts generating a brick structure in the batch, starting with a partial brick structure.
+        """
+        seq.bricks = copy.deepcopy(starting_bricks)
+        seq.n_new_bricks = 0
+        batch.add(idx, self._build_prompt(seq.caption, seq.bricks))
+        self._reset_batch_brick(batch, idx, seq)
+
+    def _reset_batch_brick(self, batch: LLMBatch, idx: int, seq: '_BatchSequence') -> None:
+        """
+        Resets the rejection sampling state of a sequence in the batch before it starts generating a new brick.
+        """
+        seq.brick_ids = []
+        seq.rejected_bricks_trie = self._build_rejected_bricks_trie(seq.bricks)
+        seq.brick_masks = self._build_brick_masks(seq.bricks) if seq.rejected_bricks_trie is None \
+            else seq.rejected_bricks_trie.masks()
+        seq.brick_start = batch.length(idx)
+        seq.brick_rejection_reasons = Counter()
+        seq.rejected_bricks = set()
+        seq.generation_num = 0
+        seq.temperature = self.temperature
+
+    def _finish_batch_brick(self, batch: LLMBatch, idx: int, seq: '_BatchSequence') -> bool:
+        """
+        Handles a fully generated brick of a sequence in the batch, as in generate_brick_with_rejection_sampling.
+        Valid bricks are added to the structure; invalid ones are rolled back so they can be resampled.
+        :return: Whether the brick structure is finished.
+        """
+        brick_ids = seq.brick_ids
+        brick = self.llm.tokenizer.decode(brick_ids, skip_special_tokens=True)
+        seq.brick_ids = []
+        if not brick:  # EOS token was generated
+            return True
+
+        if self.max_brick_rejections > 0:
+            with self.profiler.stage('validation'):
+                add_brick_result = self._try_adding_brick(brick, seq.bricks, seq.rejected_bricks)
+            if add_brick_result != 'success' and seq.generation_num < self.max_brick_rejections:
+                # Reset if brick is invalid
+                batch.rollback(idx, seq.brick_start)
+                seq.brick_rejection_reasons.update([add_brick_result])
+                seq.rejected_bricks.add(brick)
+                if seq.rejected_bricks_trie is not None:
+                    seq.rejected_bricks_trie.add(brick_ids)
+                seq.generation_num += 1
+                if add_brick_result == 'already_rejected':
+                    seq.temperature = min(self.max_temperature, seq.temperature + self.temperature_increase)
+                return False
+            if add_brick_result != 'success':
+                warnings.warn(f'Failed to generate a valid brick after {seq.generation_num + 1} attempts.\n'
+                              f'Last generated brick: {brick}\n'
+                              f'Reasons for rejection: {seq.brick_rejection_reasons}\n'
+                              f'Brick structure: {seq.bricks.to_txt()}\n')
+
+        seq.rejection_reasons.update(seq.brick_rejection_reasons)
+        seq.bricks.add_brick(Brick.from_txt(brick))
+        seq.brick_offsets.append(seq.brick_start)
+        seq.n_new_bricks += 1
+        self._reset_batch_brick(batch, idx, seq)
+        if self._stop_when_disconnected(seq.regeneration_num) and not seq.bricks.is_grounded():
+            return True
+        return seq.n_new_bricks == self.max_bricks
+
+    def _stop_when_disconnected(self, regeneration_num: int) -> bool:
+        """
+        Returns whether to stop generating a structure at the first brick that is not connected to the ground.
+        The last attempt is always finished, since it can no longer be regenerated.
+        """
+        return self.stop_when_disconnected and regeneration_num < self.max_regenerations
+
+    def _finish_batch_structure(self, batch: LLMBatch, idx: int, seq: '_BatchSequence') -> bool:
+        """
+        Handles a fully generated brick structure of a sequence in the batch, as in __call__.
+        If the structure is unstable, rolls the sequence back to the start of the first removed brick and continues
+        generating from there.
+        :return: Whether the brick structure is final.
+        """
+        if self.max_regenerations == 0 or self._is_stable(seq.bricks):
+            return True
+        if seq.regeneration_num == self.max_regenerations:
+            warnings.warn(f'Failed to generate a stable structure after {seq.regeneration_num + 1} attempts.\n')
+            return True
+        seq.regeneration_num += 1
+        seq.bricks = self._remove_all_bricks_after_first_unstable_brick(seq.bricks)
+        n_kept = len(seq.bricks)
+        batch.rollback(idx, seq.brick_offsets[n_kept])
+        del seq.brick_offsets[n_kept:]
+        seq.n_new_bricks = 0
+        self._reset_batch_brick(batch, idx, seq)
+        return False
 
     def _generate_structure(
             self,
             caption: str,
             starting_bricks: BrickStructure = BrickStructure([]),
+            brick_offsets: list[int] | None = None,
+            stop_when_disconnected: bool = False,
     ) -> (BrickStructure, Counter):
         """
         Generates a brick structure based on the given caption, starting with a partial brick structure.
         :param caption: A caption for the brick structure to be generated.
         :param starting_bricks: A partial brick structure to which the generated bricks will be added.
+        :param brick_offsets: If given, the token offset at which each generated brick starts is appended to this list.
+        :param stop_when_disconnected: Whether to stop at the first brick that is not connected to the ground.
         :return: A tuple containing the generated brick structure and a brick rejection reasons.
         """
         starting_bricks = copy.deepcopy(starting_bricks)
+        prompt = self._build_prompt(caption, starting_bricks)
+        return self._generate_bricks(prompt, starting_bricks, brick_offsets, stop_when_disconnected)
 
-        # Construct prompt
+    def _continue_structure(
+            self,
+            starting_bricks: BrickStructure,
+            brick_offsets: list[int],
+            stop_when_disconnected: bool = False,
+    ) -> (BrickStructure, Counter):
+        """
+        Regenerates the rest of the last generated brick structure, keeping only its first few bricks.
+        Instead of building a new prompt, rolls the KV cache back to the start of the first removed brick,
+        so no prefill is needed.
+        :param starting_bricks: The first bricks of the last generated brick structure, which are kept.
+        :param brick_offsets: The token offset of each brick of the last generated brick structure.
+                              Offsets of the removed bricks are deleted, and those of new bricks are appended.
+        :param stop_when_disconnected: Whether to stop at the first brick that is not connected to the ground.
+        :return: A tuple containing the generated brick structure and a brick rejection reasons.
+        """
+        n_kept = len(starting_bricks)
+        self.llm.truncate(brick_offsets[n_kept])
+        del brick_offsets[n_kept:]
+        return self._generate_bricks(None, copy.deepcopy(starting_bricks), brick_offsets, stop_when_disconnected)
+
+    def _generate_bricks(
+            self,
+            prompt: torch.Tensor | None,
+            bricks: BrickStructure,
+            brick_offsets: list[int] | None = None,
+            stop_when_disconnected: bool = False,
+    ) -> (BrickStructure, Counter):
+        """
+        Generates up to max_bricks bricks with rejection sampling and adds them to the given brick structure.
+        :param prompt: The prompt to start generation from, or None to continue from the previously generated tokens.
+        :param stop_when_disconnected: Whether to stop at the first brick that is not connected to the ground,
+                                       which is checked incrementally after each brick.
+        """
+        rejection_reasons = Counter()
+        for brick_num in range(self.max_bricks):
+            brick_offset = prompt.shape[1] if prompt is not None else self.llm.input_ids_cache.shape[1]
+            brick, rejection_reasons_brick = self.generate_brick_with_rejection_sampling(prompt, bricks=bricks)
+            prompt = None
+            if not brick:  # EOS token was generated
+                break
+            rejection_reasons.update(rejection_reasons_brick)
+            bricks.add_brick(Brick.from_txt(brick))
+            if brick_offsets is not None:
+                brick_offsets.append(brick_offset)
+            if stop_when_disconnected and not bricks.is_grounded():
+                break
+
+        return bricks, rejection_reasons
+
+    def _cache_prompt_prefixes(self, caption: str) -> None:
+        """
+        Caches the KV cache of the prompt prefix shared by all captions, and of the prompt prefix for the given caption
+        shared by all of its regenerations, so that prefill only runs over the rest of each prompt.
+        """
+        if self.llm.prefix_cache_size <= 0:
+            return
+        if self._static_prompt_prefix is None:
+            # The static prefix is everything before the first token where prompts for different captions differ
+            prompt_a = self._build_prompt('a', BrickStructure([]))[0]
+            prompt_b = self._build_prompt('b', BrickStructure([]))[0]
+            n = min(len(prompt_a), len(prompt_b))
+            differences = (prompt_a[:n] != prompt_b[:n]).nonzero()
+            prefix_length = int(differences[0]) if len(differences) else n
+            self._static_prompt_prefix = prompt_a[None, :prefix_length]
+        if self._static_prompt_prefix.shape[1] > 0:
+            self.llm.cache_prefix(self._static_prompt_prefix)
+
+        # Leave out the last token, which may merge with the starting bricks when continuing a partial structure
+        self.llm.cache_prefix(self._build_prompt(caption, BrickStructure([]))[:, :-1])
+
+    def _build_prompt(self, caption: str, starting_bricks: BrickStructure) -> torch.Tensor:
+        """
+        Builds the prompt token IDs for generating a brick structure, starting with a partial brick structure.
+        """
         starting_bricks_txt = starting_bricks.to_txt()
         messages = [
             {'role': 'system', 'content': 'You are a helpful assistant.'},
@@ -175,22 +553,9 @@ class BrickGPT:
         ]
         if starting_bricks_txt:  # Continue generation from a partial structure
             messages.append({'role': 'assistant', 'content': starting_bricks_txt})
-            prompt = self.llm.tokenizer.apply_chat_template(messages, continue_final_message=True, return_tensors='pt')
+            return self.llm.tokenizer.apply_chat_template(messages, continue_final_message=True, return_tensors='pt')
         else:
-            prompt = self.llm.tokenizer.apply_chat_template(messages, add_generation_prompt=True, return_tensors='pt')
-
-        # Generate bricks with rejection sampling
-        rejection_reasons = Counter()
-        for brick_num in range(self.max_bricks):
-            brick, rejection_reasons_brick = self.generate_brick_with_rejection_sampling(
-                prompt if brick_num == 0 else None, bricks=starting_bricks
-            )
-            if not brick:  # EOS token was generated
-                break
-            rejection_reasons.update(rejection_reasons_brick)
-            starting_bricks.add_brick(Brick.from_txt(brick))
-
-        return starting_bricks, rejection_reasons
+            return self.llm.tokenizer.apply_chat_template(messages, add_generation_prompt=True, return_tensors='pt')
 
     def generate_brick_with_rejection_sampling(
             self,
@@ -200,21 +565,31 @@ class BrickGPT:
         """
         Generates a brick to add to the brick structure, using rejection sampling to ensure the brick is valid.
         """
+        if self.use_logit_masking and self.rejection_sampling_batch_size > 1 and self.max_brick_rejections > 0:
+            return self._generate_brick_with_batched_rejection_sampling(prompt, bricks)
+
         rejection_reasons = Counter()
         rejected_bricks = set()
+        rejected_bricks_trie = self._build_rejected_bricks_trie(bricks)
+        # The brick structure does not change between attempts, so the masks are built once
+        masks = None
+        if self.use_logit_masking:
+            masks = self._build_brick_masks(bricks) if rejected_bricks_trie is None else rejected_bricks_trie.masks()
 
         brick = ''
         temperature = self.temperature
         for generation_num in range(self.max_brick_rejections + 1):
             self.llm.save_state()
-            brick = self.generate_brick(prompt, temperature=temperature)
+            brick_ids = self._generate_brick_ids(prompt, temperature=temperature, brick_masks=masks)
+            brick = self.llm.tokenizer.decode(brick_ids, skip_special_tokens=True)
             if not brick:  # EOS token was generated
                 break
             if self.max_brick_rejections == 0:
                 break
 
             # Check if the generated brick is valid
-            add_brick_result = self._try_adding_brick(brick, bricks, rejected_bricks)
+            with self.profiler.stage('validation'):
+                add_brick_result = self._try_adding_brick(brick, bricks, rejected_bricks)
             if add_brick_result == 'success':
                 break
             if generation_num == self.max_brick_rejections:
@@ -228,12 +603,84 @@ class BrickGPT:
             self.llm.rollback_to_saved_state()
             rejection_reasons.update([add_brick_result])
             rejected_bricks.add(brick)
+            if rejected_bricks_trie is not None:
+                rejected_bricks_trie.add(brick_ids)
 
             if add_brick_result == 'already_rejected':  # Increase temperature if brick has already been generated and rejected
                 temperature = min(self.max_temperature, temperature + self.temperature_increase)
 
         return brick, rejection_reasons
 
+    def _generate_brick_with_batched_rejection_sampling(
+            self,
+            prompt: str | None = None,
+            bricks: BrickStructure = BrickStructure([]),
+    ) -> (str, Counter):
+        """
+        Like generate_brick_with_rejection_sampling, but decodes a batch of candidate bricks from the shared prefix
+        in one pass. Candidates are checked in sampling order and the first valid one is accepted.
+
+        All candidates of a batch are sampled with the rejected bricks banned as of the start of the batch. Candidates
+        that an earlier candidate of the same batch has since banned are skipped, without using up an attempt or
+        raising the temperature, as sequential sampling could not have drawn them. A temperature increase applies from
+        the next batch.
+        """
+        rejection_reasons = Counter()
+        rejected_bricks = set()
+        rejected_bricks_trie = self._build_rejected_bricks_trie(bricks)
+        masks = self._build_brick_masks(bricks) if rejected_bricks_trie is None else rejected_bricks_trie.masks()
+
+        brick = ''
+        temperature = self.temperature
+        generation_num = 0
+        while True:
+            n_candidates = min(self.rejection_sampling_batch_size, self.max_brick_rejections + 1 - generation_num)
+            candidates = self.llm.generate_constrained_candidates(
+                prompt,
+                masks,
+                n_candidates,
+                temperature=temperature,
+                stop_token_ids=(self.llm.tokenizer.eos_token_id,),
+            )
+            prompt = None  # The prompt is in the KV cache now; continue from it for the next batch
+
+            accepted_idx = None
+            for idx, result_ids in enumerate(candidates):
+                if rejected_bricks_trie is not None and rejected_bricks_trie.bans(result_ids):
+                    continue  # Rejected earlier in this batch
+                brick = self.llm.tokenizer.decode(result_ids, skip_special_tokens=True)
+                if not brick:  # EOS token was generated
+                    accepted_idx = idx
+                    break
+
+                # Check if the generated brick is valid
+                with self.profiler.stage('validation'):
+                    add_brick_result = self._try_adding_brick(brick, bricks, rejected_bricks)
+                if add_brick_result == 'success':
+                    accepted_idx = idx
+                    break
+                if generation_num == self.max_brick_rejections:
+                    warnings.warn(f'Failed to generate a valid brick after {generation_num + 1} attempts.\n'
+                                  f'Last generated brick: {brick}\n'
+                                  f'Reasons for rejection: {rejection_reasons}\n'
+                                  f'Brick structure: {bricks.to_txt()}\n')
+                    accepted_idx = idx
+                    break
+
+                rejection_reasons.update([add_brick_result])
+                rejected_bricks.add(brick)
+                if rejected_bricks_trie is not None:
+                    rejected_bricks_trie.add(result_ids)
+                generation_num += 1
+
+                if add_brick_result == 'already_rejected':  # Increase temperature for the next batch
+                    temperature = min(self.max_temperature, temperature + self.temperature_increase)
+
+            # Continue from the accepted candidate, or discard the whole batch
+            self.llm.select_candidate(accepted_idx)
+            if accepted_idx is not None:
+                return brick, rejection_reasons
+
     @staticmethod
     def _try_adding_brick(brick_str: str, bricks: BrickStructure, rejected_bricks: set[str]) -> str:
         """
@@ -258,11 +705,32 @@ class BrickGPT:
             return 'collision'
         return 'success'
 
-    def generate_brick(self, prompt: str | None = None, temperature: float | None = None) -> str:
+    def generate_brick(
+            self,
+            prompt: str | None = None,
+            temperature: float | None = None,
+            bricks: BrickStructure | None = None,
+            rejected_bricks_trie: RejectionTrie | None = None,
+    ) -> str:
+        brick_ids = self._generate_brick_ids(prompt, temperature, bricks, rejected_bricks_trie)
+        return self.llm.tokenizer.decode(brick_ids, skip_special_tokens=True)
+
+    def _generate_brick_ids(
+            self,
+            prompt: str | None = None,
+            temperature: float | None = None,
+            bricks: BrickStructure | None = None,
+            rejected_bricks_trie: RejectionTrie | None = None,
+            brick_masks: tuple[AllowedTokensMask, ...] | None = None,
+    ) -> list[int]:
+        """
+        Like generate_brick, but returns the sampled token IDs of the brick.
+        """
         if temperature is None:
             temperature = self.temperature
         if self.use_logit_masking:
-            return self._generate_brick_with_logit_masking(prompt, temperature)
+            return self._generate_brick_with_logit_masking(prompt, temperature, bricks, rejected_bricks_trie,
+                                                           brick_masks)
         else:
             return self._generate_brick_no_logit_masking(prompt, temperature)
 
@@ -270,11 +738,11 @@ class BrickGPT:
             self,
             prompt: str | None = None,
             temperature: float | None = None,
-    ) -> str:
+    ) -> list[int]:
         """
         Generates a brick in txt format without logit masking.
         :param prompt: The prompt to be given to the LLM preceding brick generation.
-        :return: A brick in txt format, or the empty string if generation is finished.
+        :return: The token IDs of a brick in txt format, which decode to the empty string if generation is finished.
         """
         if temperature is None:
             temperature = self.temperature
@@ -287,90 +755,180 @@ class BrickGPT:
             top_k=self.top_k,
             top_p=self.top_p,
         )
-        return self.llm.tokenizer.decode(result_ids, skip_special_tokens=True)
+        return result_ids.tolist()
 
     def _generate_brick_with_logit_masking(
             self,
             prompt: str | None = None,
             temperature: float | None = None,
-    ) -> str:
+            bricks: BrickStructure | None = None,
+            rejected_bricks_trie: RejectionTrie | None = None,
+            brick_masks: tuple[AllowedTokensMask, ...] | None = None,
+    ) -> list[int]:
         """
         Generates a brick in txt format, using logit masking to enforce compliance with the brick syntax.
         WARNING: Assumes each number in the brick dimensions and positions is represented by 1 token.
         :param prompt: The prompt to be given to the LLM preceding brick generation.
-        :return: A brick in txt format, or the empty string if generation is finished.
+        :param bricks: The brick structure to which the brick will be added. Used for occupancy masking.
+        :param rejected_bricks_trie: If given, bricks in this trie are masked out. Its masks are used instead of
+                                     building new ones.
+        :param brick_masks: If given, the allowed-token masks to use, instead of those built from the arguments above.
+        :return: The token IDs of a brick in txt format, which decode to the empty string if generation is finished.
         """
         if temperature is None:
             temperature = self.temperature
 
-        allowed_dims = tuple(str(i) for i in range(1, max_brick_dimension + 1))
-        allowed_posns = tuple(str(i) for i in range(self.world_dim))
+        if brick_masks is None:
+            brick_masks = self._build_brick_masks(bricks) if rejected_bricks_trie is None \
+                else rejected_bricks_trie.masks()
+        result_ids = self.llm.generate_constrained(
+            prompt,
+            brick_masks,
+            temperature=temperature,
+            stop_token_ids=(self.llm.tokenizer.eos_token_id,),
+        )
+        return result_ids
 
-        # Generate tokens one by one to fit the format "hxw (x,y,z)\n"
-        result_ids = []
-        for allowed_strs in [
-            allowed_dims + (self.llm.tokenizer.eos_token,), ('x',), allowed_dims,
-            (' (',), allowed_posns, (',',), allowed_posns, (',',), allowed_posns, (')\n',),
-        ]:
-            next_token_id = self.llm(
-                prompt,
-                return_as_ids=True,
-                max_new_tokens=1,
-                temperature=temperature,
-                top_k=None,
-                top_p=None,
-                logits_processor=self._build_allow_tokens_logits_processor(allowed_strs)
-            )[0]
-            result_ids.append(next_token_id)
+    def _build_brick_masks(self, bricks: BrickStructure | None) -> tuple[AllowedTokensMask, ...]:
+        """
+        Builds one allowed-token mask per token of the brick format "hxw (x,y,z)\n".
+        With occupancy masking, each number in the brick is masked by a function of the numbers before it,
+        which only allows bricks in the brick library that fit in the given brick structure.
+        """
+        syntax_masks = self._build_brick_syntax_masks()
+        if not self.use_occupancy_masking or bricks is None:
+            return syntax_masks
+
+        number_token_ids, token_id_to_number = self._build_number_token_ids()
+        feasible_positions = {dims: bricks.feasible_positions(*dims) for dims in _library_dimensions()}
+        feasible_positions = {dims: positions for dims, positions in feasible_positions.items() if positions.any()}
+
+        def build_mask(slot: int, result_ids: list[int]) -> torch.Tensor:
+            numbers = [token_id_to_number.get(token_id) for token_id in result_ids[:slot:2]]
+            if None in numbers:  # Only happens for batched candidates that have already generated EOS
+                return syntax_masks[slot]
+
+            allowed_numbers = np.zeros(len(number_token_ids), dtype=bool)
+            if slot == 0:  # h: Any dimensions with a feasible position
+                allowed_numbers[[h for h, _ in feasible_positions]] = True
+            elif slot == 2:  # w: Any dimensions with a feasible position, given h
+                allowed_numbers[[w for h, w in feasible_positions if h == numbers[0]]] = True
+            else:  # x, y, z: Any position that is feasible, given the dimensions and the position so far
+                positions = feasible_positions[numbers[0], numbers[1]][tuple(numbers[2:])]
+                positions = positions.reshape(len(positions), -1).any(axis=1)
+                allowed_numbers[:len(positions)] = positions
+
+            mask = syntax_masks[slot].clone()
+            mask[number_token_ids] = torch.from_numpy(allowed_numbers).to(self.device)
+            return mask
+
+        return tuple(functools.partial(build_mask, slot) if slot in (0, 2, 4, 6, 8) else mask
+                     for slot, mask in enumerate(syntax_masks))
 
-            if next_token_id == self.llm.tokenizer.eos_token_id:  # Generation is finished
-                break
-            if prompt is not None:
-                prompt = None  # Only use prompt on first iteration; continue generation thereafter
+    @functools.cache
+    def _build_number_token_ids(self) -> (torch.Tensor, dict[int, int]):
+        """
+        Returns the token IDs of the numbers that can appear in a brick, indexed by number,
+        and the inverse mapping from token ID to number.
+        """
+        numbers = [str(i) for i in range(max(self.world_dim, max_brick_dimension + 1))]
+        token_ids = self.llm.tokenizer.convert_tokens_to_ids([self.llm.tokenizer.tokenize(n)[0] for n in numbers])
+        return (torch.tensor(token_ids, device=self.device),
+                {token_id: number for number, token_id in enumerate(token_ids)})
 
-        return self.llm.tokenizer.decode(result_ids, skip_special_tokens=True)
+    def _build_rejected_bricks_trie(self, bricks: BrickStructure) -> RejectionTrie | None:
+        """
+        Builds an empty trie of rejected bricks for rejection sampling of the next brick,
+        or returns None if rejected bricks should not be masked out.
+        """
+        if not (self.ban_rejected_bricks and self.use_logit_masking and self.max_brick_rejections > 0):
+            return None
+        return RejectionTrie(self._build_brick_masks(bricks))
 
     @functools.cache
-    def _build_allow_tokens_logits_processor(self, allowed_strs: tuple[str]) -> LogitsProcessorList:
+    def _build_brick_syntax_masks(self) -> tuple[torch.Tensor, ...]:
         """
-        Builds a logits processor that constrains the next token to be one of the allowed strings.
+        Builds one allowed-token mask per token of the brick format "hxw (x,y,z)\n".
+        The first token may also be EOS, which ends generation.
         """
-        return LogitsProcessorList(
-            [PrefixConstrainedLogitsProcessor(self._build_allowed_token_ids_fn(allowed_strs), num_beams=1)]
-        )
+        allowed_dims = tuple(str(i) for i in range(1, max_brick_dimension + 1))
+        allowed_posns = tuple(str(i) for i in range(self.world_dim))
+        return tuple(self._build_allowed_tokens_mask(allowed_strs) for allowed_strs in [
+            allowed_dims + (self.llm.tokenizer.eos_token,), ('x',), allowed_dims,
+            (' (',), allowed_posns, (',',), allowed_posns, (',',), allowed_posns, (')\n',),
+        ])
 
     @functools.cache
-    def _build_allowed_token_ids_fn(self, allowed_strs: tuple[str]) -> Callable[[int, torch.Tensor], list[int]]:
+    def _build_allowed_tokens_mask(self, allowed_strs: tuple[str]) -> torch.Tensor:
         """
-        Builds a function that returns a set of allowed token IDs, to be used by PrefixConstrainedLogitsProcessor.
+        Builds a boolean mask over the vocabulary that is True only for the tokens of the allowed strings.
         """
         allowed_tokens = [self.llm.tokenizer.tokenize(s) for s in allowed_strs]
         if not all(len(tokens) == 1 for tokens in allowed_tokens):
             raise ValueError('Each allowed string must tokenize to exactly 1 token')
         allowed_ids = self.llm.tokenizer.convert_tokens_to_ids(tokens[0] for tokens in allowed_tokens)
 
-        def allowed_token_ids_fn(_: int, __: torch.Tensor) -> list[int]:
-            return allowed_ids
-
-        return allowed_token_ids_fn
+        mask = torch.zeros(self.llm.model.config.vocab_size, dtype=torch.bool, device=self.device)
+        mask[allowed_ids] = True
+        return mask
 
     def _is_stable(self, bricks: BrickStructure) -> bool:
-        return bricks.is_stable() if self.use_gurobi else bricks.is_connected()
+        with self.profiler.stage('stability'), self._count_stability_solves():
+            return self.stability_cache.is_stable(bricks, self._stability_method)
 
     def _stability_scores(self, bricks: BrickStructure) -> np.ndarray:
-        return bricks.stability_scores() if self.use_gurobi else bricks.connectivity_scores()
+        with self.profiler.stage('stability'), self._count_stability_solves():
+            return self.stability_cache.stability_scores(bricks, self._stability_method)
+
+    @contextlib.contextmanager
+    def _count_stability_solves(self):
+        n_solves, n_screened = self.stability_cache.solves, self.stability_cache.screened
+        try:
+            yield
+        finally:
+            self.profiler.count('stability_solves', self.stability_cache.solves - n_solves)
+            self.profiler.count('stability_screened', self.stability_cache.screened - n_screened)
+
+    @property
+    def _stability_method(self) -> str:
+        return self.stability_solver if self.use_gurobi else 'connectivity'
 
     def _remove_all_bricks_after_first_unstable_brick(self, bricks: BrickStructure) -> BrickStructure:
         """
         Removes all bricks starting from the first unstable brick. Repeats this process until the strucure is stable.
         """
+        bricks = bricks.copy()
+        if not self.use_gurobi and not bricks.has_collisions() and not bricks.has_out_of_bounds_bricks():
+            # The loop below always ends at the longest connected prefix, which is found in a single pass.
+            # Physics-based stability is not monotone in the prefix length, so there each prefix the loop visits
+            # is solved.
+            with self.profiler.stage('stability'):
+                bricks.truncate(bricks.longest_connected_prefix())
+            return bricks
         while True:
             if self._is_stable(bricks):
                 return bricks
             scores = self._stability_scores(bricks)
-            first_unstable_brick_idx = next((i for i, brick in enumerate(bricks.bricks)
-                                             if np.any(scores[brick.slice] >= 1)), -1)
-            bricks = BrickStructure(bricks.bricks[:first_unstable_brick_idx])
+            with self.profiler.stage('truncation'):  # Kept apart from the stability stage, so no time is counted twice
+                first_unstable_brick_idx = next((i for i, brick in enumerate(bricks.bricks)
+                                                 if np.any(scores[brick.slice] >= 1)), len(bricks) - 1)
+                bricks.truncate(first_unstable_brick_idx)
+
+
+@functools.cache
+def _library_dimensions() -> tuple[tuple[int, int], ...]:
+    """
+    Returns the dimensions (h, w) of all bricks in the brick library, in both orientations.
+    """
+    dimensions = []
+    for h in range(1, max_brick_dimension + 1):
+        for w in range(1, max_brick_dimension + 1):
+            try:
+                dimensions_to_brick_id(h, w)
+            except ValueError:
+                continue
+            dimensions.append((h, w))
+    return tuple(dimensions)
 
 
 def create_instruction(caption: str) -> str:
@@ -393,13 +951,17 @@ def create_instruction_zero_shot(caption: str) -> str:
 
 
 _few_shot_examples_filename = Path(__file__).parent / 'few_shot_examples.json'
-with open(_few_shot_examples_filename) as f:
-    _few_shot_examples = json.load(f)
+
+
+@functools.cache
+def _load_few_shot_examples() -> list[dict]:
+    with open(_few_shot_examples_filename) as f:
+        return json.load(f)
 
 
 def create_instruction_few_shot(caption: str) -> str:
     example_prompt = 'Here are some example LEGO models:'
-    example_instructions = '\n\n'.join(_create_example_instruction(x) for x in _few_shot_examples)
+    example_instructions = '\n\n'.join(_create_example_instruction(x) for x in _load_few_shot_examples())
     few_shot_instructions = (
         'Do NOT copy the examples, but create your own LEGO model for the following input.\n\n'
         '### Input:\n'
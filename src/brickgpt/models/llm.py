@@ -1,24 +1,66 @@
 import copy
+import functools
+from collections import OrderedDict
+from collections.abc import Callable, Collection, Hashable, Sequence
+from dataclasses import dataclass, field
+from typing import Literal
 
 import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer
 from transformers.cache_utils import DynamicCache
 
+from .profiler import Profiler, kv_cache_bytes
+
+# A boolean mask of shape (vocab_size,) over the tokens that may be generated next, or a function that builds the mask
+# from the token IDs generated so far
+AllowedTokensMask = torch.Tensor | Callable[[list[int]], torch.Tensor]
+
+
+def resolve_mask(allowed_tokens_mask: AllowedTokensMask, result_ids: list[int]) -> torch.Tensor:
+    """
+    Returns the allowed-token mask to use after the given generated token IDs.
+    """
+    return allowed_tokens_mask(result_ids) if callable(allowed_tokens_mask) else allowed_tokens_mask
+
 
 class LLM:
     """
     A small wrapper class for a language model.
     """
 
-    def __init__(self, model_name: str, device: str = 'cuda' if torch.cuda.is_available() else 'cpu'):
+    def __init__(
+            self,
+            model_name: str,
+            device: str = 'cuda' if torch.cuda.is_available() else 'cpu',
+            checkpoint_strategy: Literal['crop', 'deepcopy'] = 'crop',
+            prefix_cache_size: int = 0,
+    ):
+        """
+        :param model_name: The name or path of the model to load.
+        :param device: The device on which to run the model.
+        :param checkpoint_strategy: How save_state checkpoints the KV cache.
+                                    'crop' only records the sequence length and crops the cache on rollback,
+                                    which is O(1) in time and memory.
+                                    'deepcopy' copies the whole cache on every save.
+        :param prefix_cache_size: The maximum number of prompt prefixes whose KV cache is kept by cache_prefix.
+                                  The least recently used prefix is evicted first. Set to 0 to disable.
+        """
         self.device = device
         self.tokenizer = AutoTokenizer.from_pretrained(model_name)
         self.model = AutoModelForCausalLM.from_pretrained(model_name).to(device)
+        self.checkpoint_strategy = checkpoint_strategy
+        self.prefix_cache_size = prefix_cache_size
+        self.prefix_cache = OrderedDict()  # Maps prefix token IDs to their KV cache, in least recently used order
 
         self.kv_cache = None
         self.kv_cache_saved = None
+        self.kv_cache_saved_length = 0
         self.input_ids_cache = None
         self.input_ids_cache_saved = None
+        self.candidates_ids = None
+        self.candidates_lengths = []
+        self.candidates_prefix_length = 0
+        self.profiler = Profiler()
 
     def __call__(
             self,
@@ -34,8 +76,6 @@ class LLM:
         # If prompt is None, continue generation from previously generated tokens
         if prompt is None:
             prompt = self.input_ids_cache
-        else:
-            self.reset_cache()
 
         # If prompt is a string, encode it into token ids
         if isinstance(prompt, str):
@@ -45,34 +85,517 @@ class LLM:
         else:
             input_ids = prompt.to(self.device)
             attention_mask = torch.ones_like(input_ids)
+        if prompt is not self.input_ids_cache:
+            self.kv_cache = self.load_prefix_cache(input_ids)
 
         # Run generation
-        output_dict = self.model.generate(
-            input_ids,
-            attention_mask=attention_mask,
-            pad_token_id=self.tokenizer.pad_token_id,
-            do_sample=True,
-            num_return_sequences=1,
-            past_key_values=self.kv_cache,
-            return_dict_in_generate=True,
-            **kwargs,
-        )
+        with self.profiler.stage('generate'):
+            output_dict = self.model.generate(
+                input_ids,
+                attention_mask=attention_mask,
+                pad_token_id=self.tokenizer.pad_token_id,
+                do_sample=True,
+                num_return_sequences=1,
+                past_key_values=self.kv_cache,
+                return_dict_in_generate=True,
+                **kwargs,
+            )
         self.input_ids_cache = output_dict['sequences']
 
         # Return result as token ids or as a string
         input_length = input_ids.shape[1]
         result_ids = output_dict['sequences'][0][input_length:]
+        self.profiler.count('tokens_generated', len(result_ids))
+        self._record_kv_cache_size()
         result = result_ids if return_as_ids else self.tokenizer.decode(result_ids)
 
         return (result, output_dict) if return_dict else result
 
+    @torch.no_grad()
+    def generate_constrained(
+            self,
+            prompt: str | torch.Tensor | None,
+            allowed_tokens_masks: Sequence[AllowedTokensMask],
+            temperature: float = 1.0,
+            stop_token_ids: Collection[int] = (),
+    ) -> list[int]:
+        """
+        Generates tokens one at a time with model.forward, reusing the KV cache between steps.
+        The i-th generated token is sampled only from the tokens allowed by the i-th mask.
+        Much cheaper than calling model.generate once per token, since there is no per-call setup.
+        :param prompt: The prompt to generate from. If None, continues generation from previously generated tokens.
+        :param allowed_tokens_masks: A sequence of boolean masks of shape (vocab_size,), one per generated token.
+                                     A mask may also be a function that builds it from the tokens generated so far.
+        :param temperature: The sampling temperature.
+        :param stop_token_ids: Token IDs that end generation early. The stop token is included in the result.
+        :return: The generated token IDs.
+        """
+        input_ids = self._prepare_input_ids(prompt)
+
+        result_ids = []
+        for allowed_tokens_mask in allowed_tokens_masks:
+            # Only run the model on the tokens that are not yet in the KV cache
+            new_input_ids = input_ids[:, self.kv_cache.get_seq_length():]
+            with self.profiler.stage('prefill' if new_input_ids.shape[1] > 1 else 'decode'):
+                logits = self.model(new_input_ids, past_key_values=self.kv_cache, use_cache=True).logits[:, -1, :]
+                allowed_tokens_mask = resolve_mask(allowed_tokens_mask, result_ids)
+                logits = logits.float().masked_fill(~allowed_tokens_mask, -float('inf'))
+                probs = torch.softmax(logits / temperature, dim=-1)
+                next_token = torch.multinomial(probs, num_samples=1)
+
+            input_ids = torch.cat([input_ids, next_token], dim=-1)
+            result_ids.append(next_token.item())
+            if result_ids[-1] in stop_token_ids:
+                break
+
+        self.input_ids_cache = input_ids
+        self.profiler.count('tokens_generated', len(result_ids))
+        self._record_kv_cache_size()
+        return result_ids
+
+    @torch.no_grad()
+    def generate_constrained_candidates(
+            self,
+            prompt: str | torch.Tensor | None,
+            allowed_tokens_masks: Sequence[AllowedTokensMask],
+            num_candidates: int,
+            temperature: float = 1.0,
+            stop_token_ids: Collection[int] = (),
+    ) -> list[list[int]]:
+        """
+        Like generate_constrained, but samples several independent candidate continuations in one batched pass.
+        The uncached part of the prompt is processed once, after which the KV cache is expanded into a batch.
+        Afterwards, call select_candidate to keep one of the candidates, or to discard all of them.
+        :return: The token IDs of each candidate, in sampling order. Each candidate ends at its first stop token.
+        """
+        input_ids = self._prepare_input_ids(prompt)
+        self.candidates_prefix_length = input_ids.shape[1]
+
+        finished = torch.zeros(num_candidates, dtype=torch.bool, device=self.device)
+        stop_token_ids_tensor = torch.tensor(list(stop_token_ids), dtype=torch.long, device=self.device)
+        for step, allowed_tokens_mask in enumerate(allowed_tokens_masks):
+            new_input_ids = input_ids[:, self.kv_cache.get_seq_length():]
+            with self.profiler.stage('prefill' if new_input_ids.shape[1] > 1 else 'decode'):
+                logits = self.model(new_input_ids, past_key_values=self.kv_cache, use_cache=True).logits[:, -1, :]
+                if step == 0:  # The prefix is shared, so expand it into a batch only after it is in the KV cache
+                    self.kv_cache.batch_repeat_interleave(num_candidates)
+                    input_ids = input_ids.expand(num_candidates, -1)
+                    logits = logits.expand(num_candidates, -1)
+                if callable(allowed_tokens_mask):  # Build one mask per candidate from its own tokens
+                    allowed_tokens_mask = torch.stack([allowed_tokens_mask(candidate_ids) for candidate_ids
+                                                       in input_ids[:, self.candidates_prefix_length:].tolist()])
+                logits = logits.float().masked_fill(~allowed_tokens_mask, -float('inf'))
+                probs = torch.softmax(logits / temperature, dim=-1)
+                next_tokens = torch.multinomial(probs, num_samples=1)
+
+            input_ids = torch.cat([input_ids, next_tokens], dim=-1)
+            finished |= torch.isin(next_tokens[:, 0], stop_token_ids_tensor)
+            if finished.all():
+                break
+
+        candidates = []
+        for candidate_ids in input_ids[:, self.candidates_prefix_length:].tolist():
+            stop_idx = next((i for i, token_id in enumerate(candidate_ids) if token_id in stop_token_ids), None)
+            candidates.append(candidate_ids if stop_idx is None else candidate_ids[:stop_idx + 1])
+        self.candidates_ids = input_ids
+        self.candidates_lengths = [len(candidate_ids) for candidate_ids in candidates]
+        self.profiler.count('tokens_generated', sum(self.candidates_lengths))
+        self._record_kv_cache_size()
+        return candidates
+
+    def select_candidate(self, idx: int | None) -> None:
+        """
+        Continues generation from one of the candidates sampled by generate_constrained_candidates.
+        :param idx: The index of the candidate to keep, or None to discard all candidates
+                    and return to the state before sampling.
+        """
+        with self.profiler.stage('checkpoint'):
+            if idx is None:
+                idx, length = 0, self.candidates_prefix_length
+            else:
+                length = self.candidates_prefix_length + self.candidates_lengths[idx]
+
+            # Keep only the chosen row of the batch, minus any tokens sampled after its stop token
+            self.kv_cache.batch_select_indices(torch.tensor([idx], device=self.device))
+            self.crop_cache(length - 1)
+            self.input_ids_cache = self.candidates_ids[idx:idx + 1, :length]
+            self.candidates_ids = None
+
     def reset_cache(self) -> None:
         self.kv_cache = DynamicCache()
 
+    def _prepare_input_ids(self, prompt: str | torch.Tensor | None) -> torch.Tensor:
+        """
+        Returns the input IDs to continue generation from. A new prompt resets the KV cache.
+        """
+        if prompt is None:
+            return self.input_ids_cache
+        if isinstance(prompt, str):
+            prompt = self.tokenizer(prompt, return_tensors='pt')['input_ids']
+        prompt = prompt.to(self.device)
+        self.kv_cache = self.load_prefix_cache(prompt)
+        return prompt
+
+    @torch.no_grad()
+    def cache_prefix(self, prefix: str | torch.Tensor) -> None:
+        """
+        Runs prefill over a prompt prefix and keeps its KV cache, so that later prompts starting with the same tokens
+        only need prefill over the rest of the prompt. Does nothing if the prefix cache is disabled.
+        :param prefix: The prefix, as a string or as token IDs of shape (1, prefix length).
+        """
+        if self.prefix_cache_size <= 0:
+            return
+        if isinstance(prefix, str):
+            prefix = self.tokenizer(prefix, return_tensors='pt')['input_ids']
+        prefix = prefix.to(self.device)
+        key = tuple(prefix[0].tolist())
+        if key in self.prefix_cache:
+            self.prefix_cache.move_to_end(key)
+            return
+
+        kv_cache = self.load_prefix_cache(prefix)
+        with self.profiler.stage('prefill'):
+            self.model(prefix[:, kv_cache.get_seq_length():], past_key_values=kv_cache, use_cache=True)
+        self.prefix_cache[key] = kv_cache
+        if len(self.prefix_cache) > self.prefix_cache_size:
+            self.prefix_cache.popitem(last=False)
+
+    def load_prefix_cache(self, input_ids: torch.Tensor) -> DynamicCache:
+        """
+        Returns a copy of the KV cache of the longest cached prefix of the given input IDs, leaving at least one token
+        uncached. Returns an empty cache if no cached prefix matches.
+        :param input_ids: The input token IDs, of shape (1, input length).
+        """
+        input_ids = input_ids[0].tolist()
+        best_key = None
+        for key in self.prefix_cache:
+            if len(key) < len(input_ids) and (best_key is None or len(key) > len(best_key)) \
+                    and tuple(input_ids[:len(key)]) == key:
+                best_key = key
+        if best_key is None:
+            return DynamicCache()
+        self.prefix_cache.move_to_end(best_key)
+        with self.profiler.stage('prefix_cache'):
+            return copy.deepcopy(self.prefix_cache[best_key])
+
     def save_state(self) -> None:
-        self.kv_cache_saved = copy.deepcopy(self.kv_cache)
-        self.input_ids_cache_saved = self.input_ids_cache
+        with self.profiler.stage('checkpoint'):
+            if self.checkpoint_strategy == 'deepcopy':
+                self.kv_cache_saved = copy.deepcopy(self.kv_cache)
+            else:
+                self.kv_cache_saved_length = self.kv_cache.get_seq_length() if self.kv_cache is not None else 0
+            self.input_ids_cache_saved = self.input_ids_cache
 
     def rollback_to_saved_state(self) -> None:
-        self.kv_cache = self.kv_cache_saved
-        self.input_ids_cache = self.input_ids_cache_saved
+        with self.profiler.stage('checkpoint'):
+            if self.checkpoint_strategy == 'deepcopy':
+                self.kv_cache = self.kv_cache_saved
+            elif self.kv_cache is not None:
+                self.crop_cache(self.kv_cache_saved_length)
+            self.input_ids_cache = self.input_ids_cache_saved
+
+    def truncate(self, length: int) -> None:
+        """
+        Rolls generation back so that it continues from the first `length` tokens of the current sequence.
+        Costs no prefill, since the KV cache is cropped in place.
+        """
+        with self.profiler.stage('checkpoint'):
+            self.input_ids_cache = self.input_ids_cache[:, :length]
+            self.crop_cache(length - 1)
+
+    def _record_kv_cache_size(self) -> None:
+        if self.profiler.enabled:
+            self.profiler.record_max('peak_kv_cache_bytes', kv_cache_bytes(self.kv_cache))
+
+    def crop_cache(self, length: int) -> None:
+        """
+        Crops the KV cache in place so that it holds at most the first `length` tokens.
+        """
+        n_tokens_to_remove = self.kv_cache.get_seq_length() - length
+        if n_tokens_to_remove > 0:
+            self.kv_cache.crop(-n_tokens_to_remove)
+
+
+class RejectionTrie:
+    """
+    A prefix trie over rejected token sequences, used to mask out tokens during constrained generation
+    so that no rejected sequence is generated again.
+
+    A node is saturated if it ends a rejected sequence, or if every token allowed after it leads to a saturated node.
+    A token is banned if it leads to a saturated node, so generation can never get stuck with no allowed tokens.
+    """
+
+    def __init__(self, allowed_tokens_masks: Sequence[AllowedTokensMask]):
+        """
+        :param allowed_tokens_masks: The masks that generation is constrained by, one per generated token.
+        """
+        self.allowed_tokens_masks = allowed_tokens_masks
+        self.root = _TrieNode()
+
+    def add(self, token_ids: Sequence[int]) -> None:
+        """
+        Adds a rejected token sequence to the trie.
+        """
+        path = [self.root]
+        for token_id in token_ids:
+            path.append(path[-1].children.setdefault(token_id, _TrieNode()))
+        path[-1].saturated = True
+
+        # Propagate saturation up towards the root, stopping at the first node with an allowed unsaturated child
+        for depth in reversed(range(len(token_ids))):
+            node = path[depth]
+            if node.n_allowed is None:
+                prefix = list(token_ids[:depth])
+                node.n_allowed = int(resolve_mask(self.allowed_tokens_masks[depth], prefix).sum())
+            if sum(child.saturated for child in node.children.values()) < node.n_allowed:
+                break
+            node.saturated = True
+
+    def bans(self, token_ids: Sequence[int]) -> bool:
+        """
+        Returns whether generation constrained by the trie can no longer produce the given token sequence.
+        """
+        node = self.root
+        for token_id in token_ids:
+            node = node.children.get(token_id)
+            if node is None:
+                return False
+            if node.saturated:
+                return True
+        return False
+
+    def banned_token_ids(self, prefix: Sequence[int]) -> list[int]:
+        """
+        Returns the token IDs that must not follow the given prefix.
+        """
+        node = self.root
+        for token_id in prefix:
+            node = node.children.get(token_id)
+            if node is None:
+                return []
+        return [token_id for token_id, child in node.children.items() if child.saturated]
+
+    def masks(self) -> tuple[AllowedTokensMask, ...]:
+        """
+        Returns the allowed-token masks with the banned tokens masked out. The masks follow later additions to the trie.
+        """
+        return tuple(functools.partial(self._mask, allowed_tokens_mask)
+                     for allowed_tokens_mask in self.allowed_tokens_masks)
+
+    def _mask(self, allowed_tokens_mask: AllowedTokensMask, result_ids: list[int]) -> torch.Tensor:
+        allowed_tokens_mask = resolve_mask(allowed_tokens_mask, result_ids)
+        banned_token_ids = self.banned_token_ids(result_ids)
+        if banned_token_ids:
+            allowed_tokens_mask = allowed_tokens_mask.clone()
+            allowed_tokens_mask[banned_token_ids] = False
+        return allowed_tokens_mask
+
+
+@dataclass
+class _TrieNode:
+    children: dict[int, '_TrieNode'] = field(default_factory=dict)
+    saturated: bool = False
+    n_allowed: int | None = None  # The number of tokens allowed after this node; computed when first needed
+
+
+class LLMBatch:
+    """
+    A batch of independent sequences that are decoded together, one token per sequence per step.
+    Sequences can join and leave the batch at any time, and each one can be rolled back on its own.
+
+    All sequences share one left-padded KV cache. Each sequence always has exactly one pending token that is not yet
+    in the cache, which is fed to the model on the next step. Rolled-back tokens are masked out of the attention mask,
+    and are removed for good when the cache is compacted.
+    """
+
+    def __init__(self, llm: LLM, compaction_slack: int = 64):
+        """
+        :param llm: The language model used to decode the batch.
+        :param compaction_slack: The number of masked-out cache columns to tolerate before compacting the cache.
+        """
+        self.llm = llm
+        self.compaction_slack = compaction_slack
+
+        self.keys = []  # Row order of the sequences in the batch
+        self.kv_cache = None
+        self.attention_mask = None  # Shape (batch size, cache length); 0 for padding and rolled-back tokens
+        self.tokens = {}  # Maps each key to all token IDs of its sequence, including the pending token
+        self.columns = {}  # Maps each key to the cache column of each of its tokens, excluding the pending token
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __contains__(self, key) -> bool:
+        return key in self.tokens
+
+    def length(self, key) -> int:
+        """
+        Returns the number of tokens in the given sequence.
+        """
+        return len(self.tokens[key])
+
+    @torch.no_grad()
+    def add(self, key, prompt: torch.Tensor) -> None:
+        """
+        Adds a new sequence to the batch and runs prefill over its prompt.
+        :param key: A hashable key identifying the sequence.
+        :param prompt: The prompt token IDs, of shape (1, prompt length).
+        """
+        if key in self:
+            raise ValueError(f'Sequence {key} is already in the batch')
+        prompt = prompt.to(self.llm.device)
+        n_cached = prompt.shape[1] - 1
+
+        kv_cache = self.llm.load_prefix_cache(prompt)
+        if n_cached > kv_cache.get_seq_length():
+            with self.llm.profiler.stage('prefill'):
+                self.llm.model(prompt[:, kv_cache.get_seq_length():-1], past_key_values=kv_cache, use_cache=True)
+        new_key_cache, new_value_cache = kv_cache.key_cache, kv_cache.value_cache
+
+        if self.kv_cache is None:
+            self.kv_cache = kv_cache
+            self.attention_mask = torch.ones(1, n_cached, dtype=torch.long, device=self.llm.device)
+        else:
+            # Left-pad whichever of the batch and the new sequence is shorter, then stack them
+            cache_length = self.attention_mask.shape[1]
+            length = max(cache_length, n_cached)
+            if length > cache_length:
+                self._left_pad(length - cache_length)
+            for layer_idx in range(len(self.kv_cache)):
+                self.kv_cache.key_cache[layer_idx] = torch.cat(
+                    [self.kv_cache.key_cache[layer_idx], _left_pad(new_key_cache[layer_idx], length)])
+                self.kv_cache.value_cache[layer_idx] = torch.cat(
+                    [self.kv_cache.value_cache[layer_idx], _left_pad(new_value_cache[layer_idx], length)])
+            new_mask = torch.zeros(1, length, dtype=torch.long, device=self.llm.device)
+            new_mask[:, length - n_cached:] = 1
+            self.attention_mask = torch.cat([self.attention_mask, new_mask])
+
+        length = self.attention_mask.shape[1]
+        self.keys.append(key)
+        self.tokens[key] = prompt[0].tolist()
+        self.columns[key] = list(range(length - n_cached, length))
+
+    def remove(self, key) -> None:
+        """
+        Removes a sequence from the batch.
+        """
+        row = self.keys.index(key)
+        self.keys.pop(row)
+        self.tokens.pop(key)
+        self.columns.pop(key)
+        if not self.keys:
+            self.kv_cache = None
+            self.attention_mask = None
+            return
+
+        remaining_rows = torch.tensor([i for i in range(len(self.keys) + 1) if i != row], device=self.llm.device)
+        self.kv_cache.batch_select_indices(remaining_rows)
+        self.attention_mask = self.attention_mask[remaining_rows]
+        self._maybe_compact()
+
+    def rollback(self, key, length: int) -> None:
+        """
+        Rolls the given sequence back to its first `length` tokens.
+        """
+        if length < 1:
+            raise ValueError('Cannot roll back past the first token of a sequence')
+        with self.llm.profiler.stage('checkpoint'):
+            row = self.keys.index(key)
+            removed_columns = self.columns[key][length - 1:]
+            self.attention_mask[row, removed_columns] = 0
+            del self.columns[key][length - 1:]
+            del self.tokens[key][length:]
+
+    @torch.no_grad()
+    def step(
+            self,
+            allowed_tokens_masks: dict[Hashable, torch.Tensor],
+            temperatures: dict[Hashable, float],
+            generators: dict[Hashable, torch.Generator] | None = None,
+    ) -> dict[Hashable, int]:
+        """
+        Runs one decoding step for every sequence in the batch.
+        :param allowed_tokens_masks: Maps each key to a boolean mask of the tokens its sequence may sample next.
+        :param temperatures: Maps each key to the sampling temperature of its sequence.
+        :param generators: Maps each key to the random number generator of its sequence.
+        :return: Maps each key to the token sampled for its sequence.
+        """
+        pending_tokens = torch.tensor([[self.tokens[key][-1]] for key in self.keys], device=self.llm.device)
+        position_ids = torch.tensor([[len(self.columns[key])] for key in self.keys], device=self.llm.device)
+        attention_mask = torch.cat(
+            [self.attention_mask, torch.ones(len(self), 1, dtype=torch.long, device=self.llm.device)], dim=1)
+
+        with self.llm.profiler.stage('decode'):
+            logits = self.llm.model(
+                pending_tokens,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=self.kv_cache,
+                use_cache=True,
+            ).logits[:, -1, :]
+            self.attention_mask = attention_mask
+
+            allowed = torch.stack([allowed_tokens_masks[key] for key in self.keys])
+            temperature = torch.tensor([[temperatures[key]] for key in self.keys], device=self.llm.device)
+            logits = logits.float().masked_fill(~allowed, -float('inf'))
+            probs = torch.softmax(logits / temperature, dim=-1)
+
+            next_tokens = {}
+            column = self.attention_mask.shape[1] - 1
+            for row, key in enumerate(self.keys):
+                generator = generators[key] if generators is not None else None
+                next_token = torch.multinomial(probs[row], num_samples=1, generator=generator).item()
+                self.columns[key].append(column)
+                self.tokens[key].append(next_token)
+                next_tokens[key] = next_token
+
+        self.llm.profiler.count('tokens_generated', len(next_tokens))
+        if self.llm.profiler.enabled:
+            self.llm.profiler.record_max('peak_kv_cache_bytes', kv_cache_bytes(self.kv_cache))
+        self._maybe_compact()
+        return next_tokens
+
+    def _left_pad(self, n_columns: int) -> None:
+        for layer_idx in range(len(self.kv_cache)):
+            self.kv_cache.key_cache[layer_idx] = _left_pad(
+                self.kv_cache.key_cache[layer_idx], self.kv_cache.key_cache[layer_idx].shape[2] + n_columns)
+            self.kv_cache.value_cache[layer_idx] = _left_pad(
+                self.kv_cache.value_cache[layer_idx], self.kv_cache.value_cache[layer_idx].shape[2] + n_columns)
+        self.attention_mask = torch.nn.functional.pad(self.attention_mask, (n_columns, 0))
+        for columns in self.columns.values():
+            columns[:] = [column + n_columns for column in columns]
+
+    def _maybe_compact(self) -> None:
+        """
+        Removes masked-out columns from the cache once there are enough of them,
+        moving the remaining columns of each sequence to the right.
+        """
+        cache_length = self.attention_mask.shape[1]
+        length = max(len(columns) for columns in self.columns.values())
+        if cache_length - length <= self.compaction_slack:
+            return
+        with self.llm.profiler.stage('checkpoint'):
+            self._compact(length)
+
+    def _compact(self, length: int) -> None:
+        columns = torch.tensor([[0] * (length - len(self.columns[key])) + self.columns[key] for key in self.keys],
+                               device=self.llm.device)
+        rows = torch.arange(len(self), device=self.llm.device)[:, None]
+        for layer_idx in range(len(self.kv_cache)):
+            # Indexing (batch, heads, length, dim) with (rows, :, columns) gives (batch, length, heads, dim)
+            self.kv_cache.key_cache[layer_idx] = \
+                self.kv_cache.key_cache[layer_idx][rows, :, columns].transpose(1, 2).contiguous()
+            self.kv_cache.value_cache[layer_idx] = \
+                self.kv_cache.value_cache[layer_idx][rows, :, columns].transpose(1, 2).contiguous()
+        self.attention_mask = self.attention_mask[rows, columns]
+        for key in self.keys:
+            n_padding = length - len(self.columns[key])
+            self.attention_mask[self.keys.index(key), :n_padding] = 0
+            self.columns[key] = list(range(n_padding, length))
+
+
+def _left_pad(states: torch.Tensor, length: int) -> torch.Tensor:
+    """
+    Left-pads KV cache states of shape (batch, heads, length, dim) with zeros along the length dimension.
+    """
+    return torch.nn.functional.pad(states, (0, 0, length - states.shape[2], 0))
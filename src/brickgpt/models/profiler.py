@@ -0,0 +1,79 @@
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+_null_context = nullcontext()
+
+
+class Profiler:
+    """
+    Records the wall time and number of calls of each stage of generation, along with other counters.
+    When disabled, every method returns immediately, so profiling calls can stay in hot loops.
+    """
+
+    def __init__(self, enabled: bool = False, device: str = 'cpu'):
+        """
+        :param enabled: Whether to record anything.
+        :param device: The device on which the model runs. On CUDA devices, the device is synchronized at the start
+                       and end of each stage, so that asynchronous kernels are attributed to the right stage.
+        """
+        self.enabled = enabled
+        self.synchronize = enabled and str(device).startswith('cuda')
+        self.times = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+
+    def reset(self) -> None:
+        self.times.clear()
+        self.calls.clear()
+        self.counters.clear()
+
+    def stage(self, name: str):
+        """
+        Returns a context manager that adds the wall time of its body to the given stage. Stages may be nested.
+        """
+        return self._stage(name) if self.enabled else _null_context
+
+    @contextmanager
+    def _stage(self, name: str):
+        self._synchronize()
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._synchronize()
+            self.times[name] += time.perf_counter() - start_time
+            self.calls[name] += 1
+
+    def count(self, name: str, n: int = 1) -> None:
+        if self.enabled:
+            self.counters[name] += n
+
+    def record_max(self, name: str, value: int) -> None:
+        if self.enabled:
+            self.counters[name] = max(self.counters[name], value)
+
+    def results(self) -> dict:
+        """
+        Returns the wall time in seconds and the number of calls of each stage, and the value of each counter.
+        """
+        return {
+            'stages': {name: {'time': self.times[name], 'calls': self.calls[name]} for name in self.times},
+            **self.counters,
+        }
+
+    def _synchronize(self) -> None:
+        if self.synchronize:
+            torch.cuda.synchronize()
+
+
+def kv_cache_bytes(kv_cache) -> int:
+    """
+    Returns the total size in bytes of the key and value states in a DynamicCache.
+    """
+    if kv_cache is None:
+        return 0
+    return sum(states.numel() * states.element_size()
+               for states in [*kv_cache.key_cache, *kv_cache.value_cache] if isinstance(states, torch.Tensor))
@@ -1,2 +1,5 @@
 from .stability_analysis import StabilityConfig, stability_score
-from .connectivity_analysis import connectivity_score
+from .stability_model import StabilityModel, build_stability_model, split_contact_components
+from .incremental_stability import IncrementalStabilityModel
+from .static_screen import StaticScreen, static_stability_screen
+from .connectivity_analysis import connectivity_score, longest_connected_prefix, GroundConnectivity
@@ -1,6 +1,4 @@
-import networkx as nx
 import numpy as np
-from itertools import combinations
 
 
 def connectivity_score(bricks) -> np.ndarray:
@@ -9,47 +7,201 @@ def connectivity_score(bricks) -> np.ndarray:
     :return: An array of voxels containing 0 if the voxel is connected to the ground via a series of brick connections,
              and 1 if it is not connected.
     """
-    # Construct connectivity graph. Note that graph construction is O(N^2) in the number of bricks.
-    graph = nx.Graph()
-    graph.add_node('ground')
-    graph.add_nodes_from(bricks.bricks)
+    n_bricks = len(bricks)
+    array = bricks.array
+    world_dim = bricks.world_dim
 
-    for b in bricks.bricks:  # Add edges for bricks connected to the ground
-        if _connected_to_ground(b):
-            graph.add_edge('ground', b)
+    # Find pairs of connected bricks. Without collisions, two bricks are connected exactly when one occupies a voxel
+    # directly above a voxel of the other, so every contact can be read from the voxel grid in time linear
+    # in the number of voxels.
+    if bricks.has_collisions() or bricks.has_out_of_bounds_bricks():
+        pairs = _connected_pairs(array)
+        brick_indices = None
+    else:
+        brick_indices = bricks.voxel_brick_indices()
+        pairs = _contact_pairs(brick_indices)
 
-    for b1, b2 in combinations(bricks.bricks, 2):  # Add edges for bricks connected to each other
-        if _connected(b1, b2):
-            graph.add_edge(b1, b2)
+    # Merge connected bricks with a union-find over brick indices. Index n_bricks is the ground.
+    parent = list(range(n_bricks + 1))
 
-    # Find bricks connected to the ground
-    connected_bricks = set(nx.node_connected_component(graph, 'ground'))
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]  # Path halving
+            i = parent[i]
+        return i
 
-    result = np.zeros((bricks.world_dim, bricks.world_dim, bricks.world_dim))
-    for brick in bricks.bricks:
-        if brick not in connected_bricks:
-            result[brick.slice] = 1
+    for b in np.flatnonzero(array['z'] == 0).tolist():  # Bricks connected to the ground
+        parent[find(b)] = find(n_bricks)
+    for b1, b2 in pairs.tolist():  # Bricks connected to each other
+        parent[find(b1)] = find(b2)
 
+    ground = find(n_bricks)
+    connected = np.array([find(b) == ground for b in range(n_bricks)], dtype=bool)
+
+    if brick_indices is not None:
+        not_connected = np.append(~connected, False)  # Empty voxels have index -1
+        return not_connected[brick_indices].astype(float)
+
+    result = np.zeros((world_dim, world_dim, world_dim))
+    for b in np.flatnonzero(~connected).tolist():
+        h, w, x, y, z = array[b].tolist()
+        result[x:x + h, y:y + w, z] = 1
     return result
 
 
-def _connected(b1, b2) -> bool:
+def longest_connected_prefix(bricks) -> int:
     """
-    Check if two bricks are connected.
-    :param b1: First Brick object.
-    :param b2: Second Brick object.
-    :return: True if the bricks are connected (one on top of the other), False otherwise.
+    :param bricks: BrickStructure object without colliding or out-of-bounds bricks.
+    :return: The largest n such that each of the first n bricks is connected to the ground via bricks among the first n.
     """
-    if b1.z > b2.z:
-        b1, b2 = b2, b1
+    n_bricks = len(bricks)
+    array = bricks.array
+
+    # Each connection exists in every prefix that contains both of its bricks. Adding the connections in the order
+    # in which they appear gives the connectivity of every prefix in one pass. Index n_bricks is the ground.
+    pairs = _contact_pairs(bricks.voxel_brick_indices())
+    on_ground = np.flatnonzero(array['z'] == 0)
+    edges = np.concatenate([pairs, np.stack([on_ground, np.full_like(on_ground, n_bricks)], axis=1)])
+    prefix_lengths = np.concatenate([pairs.max(axis=1, initial=-1), on_ground]) + 1
+    order = np.argsort(prefix_lengths, kind='stable')
+    edges, prefix_lengths = edges[order].tolist(), prefix_lengths[order].tolist()
+
+    parent = list(range(n_bricks + 1))
+    size = [1] * (n_bricks + 1)
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]  # Path halving
+            i = parent[i]
+        return i
+
+    result = 0
+    edge_idx = 0
+    for prefix_length in range(1, n_bricks + 1):
+        while edge_idx < len(edges) and prefix_lengths[edge_idx] == prefix_length:
+            root1, root2 = find(edges[edge_idx][0]), find(edges[edge_idx][1])
+            if root1 != root2:
+                if size[root1] > size[root2]:
+                    root1, root2 = root2, root1
+                parent[root1] = root2
+                size[root2] += size[root1]
+            edge_idx += 1
+        if size[find(n_bricks)] == prefix_length + 1:  # All bricks of the prefix are connected to the ground
+            result = prefix_length
+    return result
+
+
+def _contact_pairs(brick_indices: np.ndarray) -> np.ndarray:
+    """
+    Returns the unique index pairs (lower brick, upper brick) of bricks that are directly on top of each other,
+    given the index of the brick occupying each voxel, or -1 for empty voxels.
+    """
+    below, above = brick_indices[:, :, :-1], brick_indices[:, :, 1:]
+    contacts = (below >= 0) & (above >= 0)
+    return np.unique(np.stack([below[contacts], above[contacts]], axis=1), axis=0)
+
+
+def _connected_pairs(array: np.ndarray) -> np.ndarray:
+    """
+    Returns the index pairs of all connected bricks in a brick array, by testing every pair of bricks.
+    Used for structures with colliding or out-of-bounds bricks, which cannot be read from the voxel grid.
+    """
+    h, w, x, y, z = (array[name].astype(int)[:, None] for name in array.dtype.names)
+    connected = ((np.abs(z - z.T) == 1)  # One on top of the other
+                 & (x < x.T + h.T) & (x + h > x.T) & (y < y.T + w.T) & (y + w > y.T))  # Overlap in the x-y plane
+    return np.argwhere(np.triu(connected))
+
+
+class GroundConnectivity:
+    """
+    Tracks which bricks of a brick structure are connected to the ground while bricks are added and removed,
+    with a union-find over brick indices. Unions are by size and without path compression, so that the last add can be
+    undone exactly, and finding the root of a brick takes O(log n) time.
+
+    Bricks that are out of bounds or collide with another brick are not connected to anything, and the structure is
+    not considered grounded while it has any of them.
+    """
+
+    def __init__(self, world_dim: int):
+        self.world_dim = world_dim
+        self.voxel_bricks = np.full((world_dim,) * 3, -1, dtype=np.int32)  # Index of the brick in each voxel
+        self.parent = [0]  # Node 0 is the ground and node i + 1 is brick i
+        self.size = [1]
+        self.n_invalid_bricks = 0
+        self._history = []  # For each added brick, its footprint if it is valid, and the unions it caused
+
+    def copy(self):
+        result = object.__new__(GroundConnectivity)
+        result.world_dim = self.world_dim
+        result.voxel_bricks = self.voxel_bricks.copy()
+        result.parent = self.parent.copy()
+        result.size = self.size.copy()
+        result.n_invalid_bricks = self.n_invalid_bricks
+        result._history = self._history.copy()
+        return result
+
+    def add(self, h: int, w: int, x: int, y: int, z: int) -> None:
+        """
+        Adds the next brick of the structure.
+        """
+        node = len(self.parent)
+        self.parent.append(node)
+        self.size.append(1)
+
+        world_dim = self.world_dim
+        in_bounds = 0 <= x and x + h <= world_dim and 0 <= y and y + w <= world_dim and 0 <= z < world_dim
+        if not in_bounds or np.any(self.voxel_bricks[x:x + h, y:y + w, z] >= 0):
+            self.n_invalid_bricks += 1
+            self._history.append((None, []))
+            return
+        self.voxel_bricks[x:x + h, y:y + w, z] = node - 1
+
+        # The brick is connected to the bricks directly below and above it, and to the ground if it is on the ground
+        neighbors = np.concatenate([self.voxel_bricks[x:x + h, y:y + w, z + dz].ravel()
+                                    for dz in (-1, 1) if 0 <= z + dz < world_dim])
+        neighbors = (np.unique(neighbors[neighbors >= 0]) + 1).tolist()
+        if z == 0:
+            neighbors.append(0)
+        unions = []
+        for neighbor in neighbors:
+            union = self._union(node, neighbor)
+            if union is not None:
+                unions.append(union)
+        self._history.append(((h, w, x, y, z), unions))
 
-    if b1.z != b2.z - 1:
-        return False
+    def undo_add(self) -> None:
+        """
+        Removes the last added brick.
+        """
+        footprint, unions = self._history.pop()
+        for child, root in reversed(unions):
+            self.parent[child] = child
+            self.size[root] -= self.size[child]
+        if footprint is None:
+            self.n_invalid_bricks -= 1
+        else:
+            h, w, x, y, z = footprint
+            self.voxel_bricks[x:x + h, y:y + w, z] = -1
+        self.parent.pop()
+        self.size.pop()
 
-    # Check rectangle overlap in the x-y plane
-    return (b1.x < b2.x + b2.h and b1.x + b1.h > b2.x and
-            b1.y < b2.y + b2.w and b1.y + b1.w > b2.y)
+    def is_grounded(self) -> bool:
+        """
+        Returns whether every brick is connected to the ground.
+        """
+        return self.n_invalid_bricks == 0 and self.size[self._find(0)] == len(self.parent)
 
+    def _find(self, node: int) -> int:
+        while self.parent[node] != node:
+            node = self.parent[node]
+        return node
 
-def _connected_to_ground(b) -> bool:
-    return b.z == 0
+    def _union(self, node1: int, node2: int) -> tuple[int, int] | None:
+        root1, root2 = self._find(node1), self._find(node2)
+        if root1 == root2:
+            return None
+        if self.size[root1] > self.size[root2]:
+            root1, root2 = root2, root1
+        self.parent[root1] = root2
+        self.size[root2] += self.size[root1]
+        return root1, root2
@@ -0,0 +1,349 @@
+import time
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from .stability_analysis import StabilityConfig
+from .stability_model import _ABS_VARIABLES, _BRICK_VARIABLES, _EQUILIBRIUM_TOLERANCE, _FOUR_PT_OFFSETS, \
+    _SIGNED_BRICK_VARIABLES, _THREE_PT_OFFSETS
+
+# The force sum and torque sum that each horizontal contact force of a voxel contributes to.
+# Forces on the top of a voxel turn the brick the other way than forces on its sides and bottom.
+_HORIZONTAL_TERMS = {
+    f'{kind}_{direction}': ('force_sum_' + direction, torque)
+    for kind in ['external', 'bottom']
+    for direction, torque in [('x_pos', 'torque_sum_2_neg'), ('x_neg', 'torque_sum_2_pos'),
+                              ('y_pos', 'torque_sum_1_pos'), ('y_neg', 'torque_sum_1_neg')]
+} | {
+    'top_x_pos': ('force_sum_x_pos', 'torque_sum_2_pos'), 'top_x_neg': ('force_sum_x_neg', 'torque_sum_2_neg'),
+    'top_y_pos': ('force_sum_y_pos', 'torque_sum_1_neg'), 'top_y_neg': ('force_sum_y_neg', 'torque_sum_1_pos'),
+}
+# The force sum and torque sums that each vertical contact force of a voxel contributes to
+_VERTICAL_TERMS = {
+    'f_up': ('force_sum_z_pos', 'torque_sum_1_pos', 'torque_sum_2_neg'),
+    'n_up': ('force_sum_z_pos', 'torque_sum_1_pos', 'torque_sum_2_neg'),
+    'n_down': ('force_sum_z_neg', 'torque_sum_1_neg', 'torque_sum_2_pos'),
+    'f_down': ('force_sum_z_neg', 'torque_sum_1_neg', 'torque_sum_2_pos'),
+}
+# The neighboring voxel of each side of a voxel, and the force of the neighbor that pushes back
+_SIDES = [((-1, 0), 'external_x_pos', 'external_x_neg'), ((1, 0), 'external_x_neg', 'external_x_pos'),
+          ((0, -1), 'external_y_pos', 'external_y_neg'), ((0, 1), 'external_y_neg', 'external_y_pos')]
+# The horizontal forces on the top of a voxel, and the opposite forces on the bottom of the voxel above
+_KNOB_FORCES = [('top_x_pos', 'bottom_x_neg'), ('top_x_neg', 'bottom_x_pos'),
+                ('top_y_pos', 'bottom_y_neg'), ('top_y_neg', 'bottom_y_pos')]
+
+
+@dataclass(kw_only=True)
+class _Brick:
+    key: tuple  # (brick_id, x, y, z, ori)
+    x: int
+    y: int
+    z: int
+    h: int
+    w: int
+    four_pt_connection: bool
+    vars: dict = field(default_factory=dict)  # Per-brick variables by name
+    rows: dict = field(default_factory=dict)  # Force and torque sum constraints by the name of their variable
+    max_constr: object = None  # The constraint brick_max_f_down == max(f_down), if the brick has any f_down
+    f_down: list = field(default_factory=list)  # The f_down variables of all voxels of the brick
+
+    def voxels(self):
+        for i in range(self.x, self.x + self.h):
+            for j in range(self.y, self.y + self.w):
+                yield i, j, self.z
+
+
+@dataclass
+class _AddRecord:
+    """Everything an add_brick call created, so that it can be undone."""
+    vars: list = field(default_factory=list)
+    constrs: list = field(default_factory=list)
+    voxel_vars: list = field(default_factory=list)  # (voxel, name) of every voxel variable created
+    changed_bricks: set = field(default_factory=set)  # Indices of bricks whose f_down variables changed
+
+
+class IncrementalStabilityModel:
+    """
+    A Gurobi stability model that is kept alive while bricks are added and removed, so that repeated stability checks
+    of a growing or shrinking structure only build the variables and constraints of the changed bricks and their
+    contacts, and each solve starts from the previous solution.
+
+    The model is the same as the one built by stability_score. Bricks are removed in the reverse order of adding them.
+    """
+
+    def __init__(self, brick_library, cfg: StabilityConfig = StabilityConfig()):
+        # Gurobi is imported on first use, so that the rest of the package does not need a Gurobi install
+        import gurobipy as gp
+        from brickgpt.data.brick_library import compile_brick_library
+
+        self._gp = gp
+        self.library_tables = compile_brick_library(brick_library)
+        self.cfg = cfg
+        self.max_force = cfg.T / 1000 * cfg.g
+        self.voxel_bricks = np.full(cfg.world_dimension, -1, dtype=np.int32)  # Index of the brick in each voxel
+        self.bricks: list[_Brick] = []
+        self._voxel_vars = {}  # Maps voxels to their contact force variables by name
+        self._history: list[_AddRecord] = []
+        self._big_num = 0  # The signed sums are at least -big_num, and the vertical contact forces at most big_num
+
+        self.model = gp.Model("stability_analysis")
+        self.model.setParam("OutputFlag", cfg.print_log)
+        self.model.Params.IterationLimit = 1000000
+        self.model.setParam("MIPFocus", 1)
+        self.eq_obj = self.model.addVar(name="eq_obj")
+        self.sum_f_up = self.model.addVar(name="sum_f_up")
+        self.sum_brick_max_f_down = self.model.addVar(name="sum_brick_max_f_down")
+        self.eq_obj_row = self.model.addConstr(self.eq_obj == 0)
+        self.sum_f_up_row = self.model.addConstr(self.sum_f_up == 0)
+        self.sum_brick_max_f_down_row = self.model.addConstr(self.sum_brick_max_f_down == 0)
+        self.model.setObjective(self.eq_obj + cfg.alpha * self.sum_brick_max_f_down + cfg.beta * self.sum_f_up,
+                                gp.GRB.MINIMIZE)
+
+    def __len__(self) -> int:
+        return len(self.bricks)
+
+    def close(self) -> None:
+        self.model.close()
+
+    def add_brick(self, brick: dict) -> None:
+        """
+        Adds a brick in JSON format to the structure, with its contacts to the bricks already in the structure.
+        :raises ValueError: If the brick is out of bounds or collides with a brick in the structure.
+        """
+        brick_id, ori = int(brick['brick_id']), brick['ori']
+        x, y, z = brick['x'], brick['y'], brick['z']
+        h, w = self.library_tables.oriented_dimensions[ori, brick_id].tolist()
+        world_dim = self.cfg.world_dimension
+        if not (0 <= x and x + h <= world_dim[0] and 0 <= y and y + w <= world_dim[1] and 0 <= z < world_dim[2]):
+            raise ValueError(f'Brick is out of bounds: {brick}')
+        if np.any(self.voxel_bricks[x:x + h, y:y + w, z] >= 0):
+            raise ValueError(f'Brick collides with the structure: {brick}')
+
+        model = self.model
+        record = _AddRecord()
+        idx = len(self.bricks)
+        new = _Brick(key=(brick_id, x, y, z, ori), x=x, y=y, z=z, h=h, w=w,
+                     four_pt_connection=bool(self.library_tables.four_pt_connection[brick_id]))
+        self.bricks.append(new)
+        self.voxel_bricks[x:x + h, y:y + w, z] = idx
+        self._history.append(record)
+
+        # Force and torque sums, which start out with only the torque of the weight of the brick
+        for name in _BRICK_VARIABLES:
+            new.vars[name] = model.addVar(lb=-self._big_num if name in _SIGNED_BRICK_VARIABLES else 0)
+        record.vars.extend(new.vars.values())
+        weight = self.library_tables.mass[brick_id] * self.cfg.g
+        center_x, center_y = x + (h - 1) / 2, y + (w - 1) / 2
+        weight_torque = weight / (h * w) * self.cfg.brick_unit_length
+        sum_rhs = {
+            'torque_sum_1_neg': sum((j - center_y) * weight_torque for i, j, _ in new.voxels()),
+            'torque_sum_2_pos': sum((i - center_x) * weight_torque for i, j, _ in new.voxels()),
+        }
+        for name in ['force_sum_x_pos', 'force_sum_x_neg', 'force_sum_y_pos', 'force_sum_y_neg', 'force_sum_z_pos',
+                     'force_sum_z_neg', 'torque_sum_1_pos', 'torque_sum_1_neg', 'torque_sum_2_pos', 'torque_sum_2_neg']:
+            new.rows[name] = model.addConstr(new.vars[name] == sum_rhs.get(name, 0))
+        v = new.vars
+        record.constrs.extend(new.rows.values())
+        record.constrs.extend([
+            model.addConstr(v['force_sum_x'] == v['force_sum_x_pos'] - v['force_sum_x_neg']),
+            model.addConstr(v['force_sum_y'] == v['force_sum_y_pos'] - v['force_sum_y_neg']),
+            model.addConstr(v['force_sum_z'] == v['force_sum_z_pos'] - v['force_sum_z_neg'] - weight),
+            model.addConstr(v['torque_sum_1'] == v['torque_sum_1_pos'] - v['torque_sum_1_neg']),
+            model.addConstr(v['torque_sum_2'] == v['torque_sum_2_pos'] - v['torque_sum_2_neg']),
+        ])
+        for result, argument in _ABS_VARIABLES:
+            record.constrs.append(model.addGenConstrAbs(v[result], v[argument]))
+            model.chgCoeff(self.eq_obj_row, v[result], -1)
+        model.chgCoeff(self.sum_brick_max_f_down_row, v['brick_max_f_down'], -1)
+
+        # Contacts with the bricks around and on the ground
+        for voxel in new.voxels():
+            i, j, k = voxel
+            for (di, dj), name, neighbor_name in _SIDES:
+                neighbor = (i + di, j + dj, k)
+                if (0 <= neighbor[0] < world_dim[0] and 0 <= neighbor[1] < world_dim[1]
+                        and self.voxel_bricks[neighbor] not in (-1, idx)):
+                    own = self._add_voxel_var(record, voxel, name)
+                    other = self._add_voxel_var(record, neighbor, neighbor_name)
+                    record.constrs.append(model.addConstr(own == other))
+                    record.constrs.append(model.addConstr(other == own))
+            if k == 0:
+                self._add_bottom(record, voxel)
+            elif self.voxel_bricks[i, j, k - 1] >= 0:
+                self._add_knob_connection(record, (i, j, k - 1), voxel)
+            if k + 1 < world_dim[2] and self.voxel_bricks[i, j, k + 1] >= 0:
+                self._add_knob_connection(record, voxel, (i, j, k + 1))
+
+        for changed_idx in record.changed_bricks:
+            self._update_max_constr(self.bricks[changed_idx])
+
+    def undo_add_brick(self) -> None:
+        """
+        Removes the last added brick and its contacts.
+        """
+        record = self._history.pop()
+        for changed_idx in record.changed_bricks:
+            brick = self.bricks[changed_idx]
+            if brick.max_constr is not None:
+                self.model.remove(brick.max_constr)
+                brick.max_constr = None
+        self.model.remove(record.constrs)
+        self.model.remove(record.vars)
+        for voxel, name in reversed(record.voxel_vars):
+            variable = self._voxel_vars[voxel].pop(name)
+            if name == 'f_down':
+                f_down = self.bricks[self.voxel_bricks[voxel]].f_down
+                del f_down[len(f_down) - len(variable):]
+        brick = self.bricks.pop()
+        self.voxel_bricks[brick.x:brick.x + brick.h, brick.y:brick.y + brick.w, brick.z] = -1
+        for changed_idx in record.changed_bricks:
+            if changed_idx < len(self.bricks):
+                self._update_max_constr(self.bricks[changed_idx])
+
+    def truncate(self, n: int) -> None:
+        """
+        Removes all bricks after the first n.
+        """
+        while len(self.bricks) > n:
+            self.undo_add_brick()
+
+    def sync(self, brick_structure: dict) -> None:
+        """
+        Updates the model to a brick structure in JSON format, by removing the bricks after the longest common prefix
+        with the current structure, and adding the rest.
+        """
+        bricks = list(brick_structure.values())
+        n_common = 0
+        for brick, current in zip(bricks, self.bricks):
+            if (int(brick['brick_id']), brick['x'], brick['y'], brick['z'], brick['ori']) != current.key:
+                break
+            n_common += 1
+        self.truncate(n_common)
+        for brick in bricks[n_common:]:
+            self.add_brick(brick)
+
+        # The bounds of the signed sums and vertical contact forces depend on the number of bricks
+        if self._big_num != 100 * len(self.bricks):
+            self._big_num = 100 * len(self.bricks)
+            signed_vars = [brick.vars[name] for brick in self.bricks for name in _SIGNED_BRICK_VARIABLES]
+            self.model.setAttr('LB', signed_vars, [-self._big_num] * len(signed_vars))
+            vertical_vars = [point for voxel_vars in self._voxel_vars.values()
+                             for name, variable in voxel_vars.items() if name in _VERTICAL_TERMS for point in variable]
+            self.model.setAttr('UB', vertical_vars, [self._big_num] * len(vertical_vars))
+        self.model.update()
+
+    def stability_score(self, brick_structure: dict):
+        """
+        Computes the stability scores of a brick structure, like stability_score, after updating the model with sync.
+        :param brick_structure: The brick structure in JSON format.
+        :return: The same as stability_score.
+        """
+        gp = self._gp
+        t_start = time.time()
+        self.sync(brick_structure)
+
+        t_solve_start = time.time()
+        self.model.optimize()
+        t_end = time.time()
+        solve_t = t_end - t_solve_start
+        total_t = t_end - t_start
+        num_vars, num_constr = self.model.NumVars, self.model.NumConstrs
+
+        if self.model.Status != gp.GRB.Status.OPTIMAL:
+            print('Model did not solve successfully. Check status code:', self.model.Status)
+            return np.ones(self.cfg.world_dimension), num_vars, num_constr, total_t, solve_t
+
+        # The next solve starts from this solution. Gurobi completes the values of the variables added until then.
+        variables = self.model.getVars()
+        self.model.setAttr('Start', variables, self.model.getAttr('X', variables))
+
+        scores = np.zeros(self.cfg.world_dimension)
+        for brick in self.bricks:
+            in_equilibrium = max(self.model.getAttr('X', [brick.vars[name] for name, _ in _ABS_VARIABLES]))
+            in_equilibrium = in_equilibrium <= _EQUILIBRIUM_TOLERANCE
+            min_c = min([self.max_force] + [self.max_force - f for f in self.model.getAttr('X', brick.f_down)])
+            score = 1 if not in_equilibrium or min_c <= 0 else 1 - min_c / self.max_force
+            scores[brick.x:brick.x + brick.h, brick.y:brick.y + brick.w, brick.z] = score
+        if self.cfg.print_log:
+            print("Obj Val:", self.model.objVal)
+            print("Eq obj Val:", self.eq_obj.X)
+            print("Num bricks: ", len(self.bricks))
+            print("Total solve time: ", total_t, " Model update time: ", total_t - solve_t,
+                  " Optimization Solve Time: ", solve_t)
+        return scores, num_vars, num_constr, total_t, solve_t
+
+    def _add_voxel_var(self, record: _AddRecord, voxel: tuple[int, int, int], name: str, n_points: int = 0,
+                       offsets: np.ndarray | None = None):
+        """
+        Adds a contact force variable of a voxel, or n_points of them at the given contact point offsets,
+        and adds them to the force and torque sums of the brick of the voxel.
+        """
+        brick = self.bricks[self.voxel_bricks[voxel]]
+        if n_points == 0:
+            variable = self.model.addVar()
+            record.vars.append(variable)
+            force_sum, torque_sum = _HORIZONTAL_TERMS[name]
+            self.model.chgCoeff(brick.rows[force_sum], variable, -1)
+            self.model.chgCoeff(brick.rows[torque_sum], variable, -self.cfg.brick_unit_height / 2)
+        else:
+            variable = [self.model.addVar(ub=self._big_num) for _ in range(n_points)]
+            record.vars.extend(variable)
+            force_sum, torque_1_sum, torque_2_sum = _VERTICAL_TERMS[name]
+            unit_length = self.cfg.brick_unit_length
+            dx = voxel[0] - (brick.x + (brick.h - 1) / 2)
+            dy = voxel[1] - (brick.y + (brick.w - 1) / 2)
+            for point, (offset_x, offset_y) in zip(variable, offsets.tolist()):
+                self.model.chgCoeff(brick.rows[force_sum], point, -1)
+                self.model.chgCoeff(brick.rows[torque_1_sum], point, -(dy + offset_y) * unit_length)
+                self.model.chgCoeff(brick.rows[torque_2_sum], point, -(dx + offset_x) * unit_length)
+            if name == 'f_down':
+                brick.f_down.extend(variable)
+                for point in variable:
+                    self.model.chgCoeff(self.sum_f_up_row, point, -1)
+                record.changed_bricks.add(int(self.voxel_bricks[voxel]))
+        self._voxel_vars.setdefault(voxel, {})[name] = variable
+        record.voxel_vars.append((voxel, name))
+        return variable
+
+    def _add_bottom(self, record: _AddRecord, voxel: tuple[int, int, int]) -> None:
+        """
+        Adds the forces on the bottom of a voxel, from the ground or the voxel below.
+        """
+        brick = self.bricks[self.voxel_bricks[voxel]]
+        offsets = _FOUR_PT_OFFSETS if brick.four_pt_connection else _THREE_PT_OFFSETS[:3]
+        for name in ['bottom_x_pos', 'bottom_x_neg', 'bottom_y_pos', 'bottom_y_neg']:
+            self._add_voxel_var(record, voxel, name)
+        f_down = self._add_voxel_var(record, voxel, 'f_down', len(offsets), offsets)
+        n_up = self._add_voxel_var(record, voxel, 'n_up', len(offsets), offsets)
+        for n, f in zip(n_up, f_down):
+            record.constrs.append(self.model.addConstr(n * f == 0))
+
+    def _add_knob_connection(self, record: _AddRecord, lower: tuple[int, int, int],
+                             upper: tuple[int, int, int]) -> None:
+        """
+        Adds the forces between a voxel and the voxel above it, which belong to different bricks.
+        """
+        model = self.model
+        upper_brick = self.bricks[self.voxel_bricks[upper]]
+        offsets = _FOUR_PT_OFFSETS if upper_brick.four_pt_connection else _THREE_PT_OFFSETS[:3]
+        for name, _ in _KNOB_FORCES:
+            self._add_voxel_var(record, lower, name)
+        f_up = self._add_voxel_var(record, lower, 'f_up', len(offsets), offsets)
+        n_down = self._add_voxel_var(record, lower, 'n_down', len(offsets), offsets)
+        self._add_bottom(record, upper)
+
+        lower_vars, upper_vars = self._voxel_vars[lower], self._voxel_vars[upper]
+        for top, bottom in _KNOB_FORCES:
+            record.constrs.append(model.addConstr(lower_vars[top] == upper_vars[bottom]))
+            record.constrs.append(model.addConstr(upper_vars[bottom] == lower_vars[top]))
+        for f, n, f_down, n_up in zip(f_up, n_down, upper_vars['f_down'], upper_vars['n_up']):
+            record.constrs.extend([model.addConstr(f == f_down), model.addConstr(n == n_up),
+                                   model.addConstr(n * f == 0),
+                                   model.addConstr(f_down == f), model.addConstr(n_up == n)])
+
+    def _update_max_constr(self, brick: _Brick) -> None:
+        if brick.max_constr is not None:
+            self.model.remove(brick.max_constr)
+            brick.max_constr = None
+        if brick.f_down:
+            brick.max_constr = self.model.addGenConstrMax(brick.vars['brick_max_f_down'], brick.f_down)
@@ -0,0 +1,375 @@
+from dataclasses import dataclass
+
+import numpy as np
+
+# Offsets (x, y) of the contact points of a knob connection from the center of the stud,
+# for connections to 1xX bricks (4 points) and 2xX bricks (3 points)
+_FOUR_PT_OFFSETS = np.array([(0, -0.25), (-0.25, 0), (0, 0.25), (0.25, 0)])
+_THREE_PT_OFFSETS = np.array([(0.125, -0.125), (-0.25, 0), (0.125, 0.125), (np.nan, np.nan)])
+
+# The per-brick variables, in order. Signed sums can be negative.
+_BRICK_VARIABLES = [
+    'force_sum_x_pos', 'force_sum_x_neg', 'force_sum_x',
+    'force_sum_y_pos', 'force_sum_y_neg', 'force_sum_y',
+    'force_sum_z_pos', 'force_sum_z_neg', 'force_sum_z',
+    'torque_sum_1_pos', 'torque_sum_1_neg', 'torque_sum_1',
+    'torque_sum_2_pos', 'torque_sum_2_neg', 'torque_sum_2',
+    'force_abs_sum_x', 'force_abs_sum_y', 'force_abs_sum_z', 'torque_abs_sum_1', 'torque_abs_sum_2',
+    'brick_max_f_down',
+]
+_SIGNED_BRICK_VARIABLES = _BRICK_VARIABLES[:15]
+_ABS_VARIABLES = [('force_abs_sum_x', 'force_sum_x'), ('force_abs_sum_y', 'force_sum_y'),
+                  ('force_abs_sum_z', 'force_sum_z'), ('torque_abs_sum_1', 'torque_sum_1'),
+                  ('torque_abs_sum_2', 'torque_sum_2')]
+
+# The equilibrium error below which a brick is in equilibrium. Solvers only meet the constraints up to their
+# feasibility tolerance, which is 1e-6 by default for both Gurobi and HiGHS.
+_EQUILIBRIUM_TOLERANCE = 1e-6
+
+
+@dataclass(kw_only=True)
+class StabilityModel:
+    """
+    The force equilibrium model of a brick structure, laid out as arrays so that it can be loaded into a solver in bulk.
+
+    Every force and sum is a variable x[i] with lb[i] <= x[i] <= ub[i]. The model minimizes objective @ x subject to:
+    - a_eq @ x == b_eq;
+    - x[a] * x[b] == 0 for each complementarity pair (a, b), so that a knob connection either pushes or pulls;
+    - x[r] == |x[a]| for each abs pair (r, a);
+    - x[max_results[k]] == max(x[max_args[k]]) for each max constraint k.
+    """
+    lb: np.ndarray
+    ub: np.ndarray
+    objective: np.ndarray
+    a_eq: 'scipy.sparse.csr_array'
+    b_eq: np.ndarray
+    complementarity: np.ndarray  # (n_pairs, 2)
+    abs_pairs: np.ndarray  # (n_pairs, 2)
+    max_results: np.ndarray  # (n_max,)
+    max_args: list[np.ndarray]
+
+    # Variable indices by name: per-brick variables have shape (n_bricks,), per-voxel variables (n_voxels,) and
+    # per-contact-point variables (n_voxels, 4). Entries for variables that do not exist are -1.
+    variables: dict[str, np.ndarray]
+    voxels: np.ndarray  # (n_voxels, 3) the (x, y, z) of every voxel occupied by a brick
+    voxel_bricks: np.ndarray  # (n_voxels,) the brick index of every voxel
+    world_dimension: tuple[int, int, int]
+    max_force: float  # The force at which a knob connection breaks
+
+    @property
+    def n_vars(self) -> int:
+        return len(self.lb)
+
+    def scores(self, x: np.ndarray) -> np.ndarray:
+        """
+        Computes the stability score of every voxel from a solution of the model.
+        A brick scores 1 if it is not in equilibrium or a connection below it breaks, and otherwise between 0 and 1
+        depending on how close to breaking its most loaded connection below is.
+        """
+        variables = self.variables
+        n_bricks = len(variables['force_sum_x'])
+        not_in_equilibrium = np.zeros(n_bricks, dtype=bool)
+        for name, _ in _ABS_VARIABLES:
+            not_in_equilibrium |= x[variables[name]] > _EQUILIBRIUM_TOLERANCE
+
+        f_down = variables['f_down']
+        exists = f_down >= 0
+        max_f_down = np.full(n_bricks, -np.inf)
+        np.maximum.at(max_f_down, np.broadcast_to(self.voxel_bricks[:, None], f_down.shape)[exists], x[f_down[exists]])
+        min_capacity = np.minimum(self.max_force, self.max_force - max_f_down)
+
+        brick_scores = np.where(not_in_equilibrium | (min_capacity <= 0), 1, 1 - min_capacity / self.max_force)
+        scores = np.zeros(self.world_dimension)
+        scores[tuple(self.voxels.T)] = brick_scores[self.voxel_bricks]
+        return scores
+
+
+def split_contact_components(brick_structure: dict, brick_library: dict,
+                             world_dimension: tuple[int, int, int]) -> list[dict]:
+    """
+    Splits a brick structure into groups of bricks that touch each other, directly or through other bricks.
+    No force acts between bricks of different groups, so the stability of each group can be analyzed separately.
+    :param brick_structure: The brick structure in JSON format. It must not have colliding or out-of-bounds bricks.
+    :param brick_library: The brick library.
+    :param world_dimension: The size of the world.
+    :return: The brick structure of each group in JSON format, with the bricks in the same order.
+    """
+    return _label_contact_components(brick_structure, brick_library, world_dimension)[1]
+
+
+def _label_contact_components(brick_structure: dict, brick_library: dict,
+                              world_dimension: tuple[int, int, int]) -> tuple[np.ndarray, list[dict]]:
+    """
+    Like split_contact_components, but also returns the voxel grid in which each voxel of the k-th group is labelled
+    k + 1, and empty voxels are labelled 0.
+    """
+    from scipy import ndimage
+    from brickgpt.data.brick_library import compile_brick_library
+
+    library_tables = compile_brick_library(brick_library)
+    occupancy = np.zeros(world_dimension, dtype=bool)
+    for brick in brick_structure.values():
+        h, w = library_tables.oriented_dimensions[brick['ori'], int(brick['brick_id'])].tolist()
+        occupancy[brick['x']:brick['x'] + h, brick['y']:brick['y'] + w, brick['z']] = True
+
+    # Bricks touch where two voxels share a face, which are the neighbors that ndimage.label connects by default
+    labels, n_components = ndimage.label(occupancy)
+    components = [{} for _ in range(n_components)]
+    for brick in brick_structure.values():
+        component = components[labels[brick['x'], brick['y'], brick['z']] - 1]
+        component[str(len(component) + 1)] = brick
+    return labels, components
+
+
+def build_stability_model(brick_structure: dict, brick_library: dict, cfg) -> StabilityModel:
+    """
+    Builds the force equilibrium model of a brick structure. The contact points between bricks are found with
+    vectorized lookups in a voxel grid, and the constraints are built as one sparse matrix.
+    :param brick_structure: The brick structure in JSON format. It must not have colliding or out-of-bounds bricks.
+    :param brick_library: The brick library.
+    :param cfg: The StabilityConfig.
+    """
+    from scipy import sparse
+    from brickgpt.data.brick_library import compile_brick_library
+
+    library_tables = compile_brick_library(brick_library)
+    g = cfg.g  # N/kg
+    max_force = cfg.T / 1000 * g  # N
+    half_height = cfg.brick_unit_height / 2
+    unit_length = cfg.brick_unit_length
+    world_dim = tuple(cfg.world_dimension)
+    n_bricks = len(brick_structure)
+
+    # Bricks, indexed by their position in brick_structure. Per-brick variables are indexed by their key instead.
+    bricks = list(brick_structure.values())
+    brick_keys = np.array([int(key) - 1 for key in brick_structure], dtype=int)
+    brick_ids = np.array([int(brick['brick_id']) for brick in bricks], dtype=int)
+    oris = np.array([brick['ori'] for brick in bricks], dtype=int)
+    brick_x, brick_y, brick_z = (np.array([brick[c] for brick in bricks], dtype=int) for c in 'xyz')
+    h, w = library_tables.oriented_dimensions[oris, brick_ids].reshape(-1, 2).T
+    brick_weight = library_tables.mass[brick_ids] * g
+    four_pt_connection = library_tables.four_pt_connection[brick_ids]
+
+    # Voxels of all bricks, in brick order and then by x and y
+    area = h * w
+    voxel_brick = np.repeat(np.arange(len(bricks)), area)
+    offset = np.arange(area.sum()) - np.repeat(np.cumsum(area) - area, area)
+    vx = brick_x[voxel_brick] + offset // w[voxel_brick]
+    vy = brick_y[voxel_brick] + offset % w[voxel_brick]
+    vz = brick_z[voxel_brick]
+    n_voxels = len(voxel_brick)
+    voxel_at = np.full(world_dim, -1)
+    voxel_at[vx, vy, vz] = np.arange(n_voxels)
+
+    def neighbors(dx: int, dy: int, dz: int) -> np.ndarray:
+        """Returns the voxel next to each voxel in the given direction, or -1 if it is empty or outside the world."""
+        nx, ny, nz = vx + dx, vy + dy, vz + dz
+        inside = (nx >= 0) & (nx < world_dim[0]) & (ny >= 0) & (ny < world_dim[1]) & (nz >= 0) & (nz < world_dim[2])
+        result = np.full(n_voxels, -1)
+        result[inside] = voxel_at[nx[inside], ny[inside], nz[inside]]
+        return result
+
+    def other_brick(neighbor: np.ndarray) -> np.ndarray:
+        return (neighbor >= 0) & (voxel_brick[neighbor] != voxel_brick)
+
+    left, right, front, back = neighbors(-1, 0, 0), neighbors(1, 0, 0), neighbors(0, -1, 0), neighbors(0, 1, 0)
+    above, below = neighbors(0, 0, 1), neighbors(0, 0, -1)
+    has_top = above >= 0
+    has_bottom = (vz == 0) | (below >= 0)
+    has_below = below >= 0
+
+    # Number of contact points of the knob connections above and below each voxel
+    four_pt_voxel = four_pt_connection[voxel_brick]
+    n_top_points = np.where(has_top, np.where(four_pt_voxel[above], 4, 3), 0)
+    n_bottom_points = np.where(has_bottom, np.where(four_pt_voxel, 4, 3), 0)
+
+    # Lay out the variables
+    n_vars = 0
+    variables = {}
+
+    def add_variables(name: str, mask: np.ndarray) -> None:
+        nonlocal n_vars
+        indices = np.full(mask.shape, -1)
+        indices[mask] = np.arange(n_vars, n_vars + np.count_nonzero(mask))
+        n_vars += np.count_nonzero(mask)
+        variables[name] = indices
+
+    for name in _BRICK_VARIABLES:
+        add_variables(name, np.ones(n_bricks, dtype=bool))
+    for name, mask in [('external_x_pos', other_brick(left)), ('external_x_neg', other_brick(right)),
+                       ('external_y_pos', other_brick(front)), ('external_y_neg', other_brick(back))]:
+        add_variables(name, mask)
+    for name in ['top_x_pos', 'top_x_neg', 'top_y_pos', 'top_y_neg']:
+        add_variables(name, has_top)
+    for name in ['f_up', 'n_down']:
+        add_variables(name, np.arange(4) < n_top_points[:, None])
+    for name in ['bottom_x_pos', 'bottom_x_neg', 'bottom_y_pos', 'bottom_y_neg']:
+        add_variables(name, has_bottom)
+    for name in ['f_down', 'n_up']:
+        add_variables(name, np.arange(4) < n_bottom_points[:, None])
+    add_variables('eq_obj', np.array(True))
+    for name in ['sum_f_up', 'sum_brick_max_f_down']:  # Only needed if some knob connections can pull
+        add_variables(name, np.array(n_bottom_points.any()))
+    v = variables
+
+    lb = np.zeros(n_vars)
+    ub = np.full(n_vars, np.inf)
+    big_num = 100 * n_bricks
+    for name in _SIGNED_BRICK_VARIABLES:
+        lb[v[name]] = -big_num
+    # Without bounds on the factors of the complementarity products, Gurobi can prove a wrong lower bound
+    for name in ['f_up', 'n_down', 'f_down', 'n_up']:
+        ub[v[name][v[name] >= 0]] = big_num
+
+    # Equality constraints, as blocks of rows (rows, columns, coefficients) and their right-hand sides
+    blocks = []
+    b_eq = []
+
+    def add_equalities(terms: list[tuple[np.ndarray, np.ndarray, np.ndarray | float]], rhs: np.ndarray) -> None:
+        """Adds the constraints sum(coefficient * x[column]) == rhs[row] over the terms of each row."""
+        n_rows = sum(len(r) for r in b_eq)
+        for rows, columns, coefficients in terms:
+            blocks.append((rows + n_rows, columns, np.broadcast_to(coefficients, rows.shape)))
+        b_eq.append(rhs)
+
+    def add_pairwise_equalities(mask: np.ndarray, columns1: np.ndarray, columns2: np.ndarray) -> None:
+        """Adds the constraints x[columns1] == x[columns2] where mask is True."""
+        rows = np.arange(np.count_nonzero(mask))
+        add_equalities([(rows, columns1[mask], 1.0), (rows, columns2[mask], -1.0)], np.zeros(len(rows)))
+
+    # Horizontal presses between adjacent bricks
+    add_pairwise_equalities(v['external_x_pos'] >= 0, v['external_x_pos'], v['external_x_neg'][left])
+    add_pairwise_equalities(v['external_x_neg'] >= 0, v['external_x_neg'], v['external_x_pos'][right])
+    add_pairwise_equalities(v['external_y_pos'] >= 0, v['external_y_pos'], v['external_y_neg'][front])
+    add_pairwise_equalities(v['external_y_neg'] >= 0, v['external_y_neg'], v['external_y_pos'][back])
+
+    # Knob connections: the forces on the top of a voxel are the opposite of those on the bottom of the voxel above
+    for top, bottom in [('top_x_pos', 'bottom_x_neg'), ('top_x_neg', 'bottom_x_pos'),
+                        ('top_y_pos', 'bottom_y_neg'), ('top_y_neg', 'bottom_y_pos')]:
+        add_pairwise_equalities(has_top, v[top], v[bottom][above])
+    points = np.arange(4) < n_top_points[:, None]
+    complementarity = [np.stack([v['n_down'][points], v['f_up'][points]], axis=1)]
+    add_pairwise_equalities(points, v['f_up'], v['f_down'][above])
+    add_pairwise_equalities(points, v['n_down'], v['n_up'][above])
+
+    for bottom, top in [('bottom_x_pos', 'top_x_neg'), ('bottom_x_neg', 'top_x_pos'),
+                        ('bottom_y_pos', 'top_y_neg'), ('bottom_y_neg', 'top_y_pos')]:
+        add_pairwise_equalities(has_below, v[bottom], v[top][below])
+    points = np.arange(4) < n_bottom_points[:, None]
+    complementarity.append(np.stack([v['n_up'][points], v['f_down'][points]], axis=1))
+    points_on_brick = points & has_below[:, None]
+    add_pairwise_equalities(points_on_brick, v['f_down'], v['f_up'][below])
+    add_pairwise_equalities(points_on_brick, v['n_up'], v['n_down'][below])
+
+    # Force and torque sums of each brick, as lists of terms (variables, coefficients) that are summed per brick
+    center_x = brick_x + (h - 1) / 2
+    center_y = brick_y + (w - 1) / 2
+    dx = vx - center_x[voxel_brick]
+    dy = vy - center_y[voxel_brick]
+    sum_terms = {name: [] for name in ['force_sum_x_pos', 'force_sum_x_neg', 'force_sum_y_pos', 'force_sum_y_neg',
+                                       'force_sum_z_pos', 'force_sum_z_neg', 'torque_sum_1_pos', 'torque_sum_1_neg',
+                                       'torque_sum_2_pos', 'torque_sum_2_neg']}
+
+    def add_terms(sum_name: str, variable_name: str, coefficients: np.ndarray | float = 1.0) -> None:
+        columns = v[variable_name]
+        voxels = np.broadcast_to(np.arange(n_voxels).reshape((-1,) + (1,) * (columns.ndim - 1)), columns.shape)
+        coefficients = np.broadcast_to(coefficients, columns.shape)
+        exists = columns >= 0
+        sum_terms[sum_name].append((voxels[exists], columns[exists], coefficients[exists]))
+
+    # Horizontal forces, which act at half the brick height
+    for direction in ['x', 'y']:
+        for side in ['pos', 'neg']:
+            for kind in ['external', 'top', 'bottom']:
+                add_terms(f'force_sum_{direction}_{side}', f'{kind}_{direction}_{side}')
+    for kind, (torque1_pos, torque1_neg, torque2_pos, torque2_neg) in [
+        ('external', ('y_pos', 'y_neg', 'x_neg', 'x_pos')),
+        ('top', ('y_neg', 'y_pos', 'x_pos', 'x_neg')),
+        ('bottom', ('y_pos', 'y_neg', 'x_neg', 'x_pos')),
+    ]:
+        add_terms('torque_sum_1_pos', f'{kind}_{torque1_pos}', half_height)
+        add_terms('torque_sum_1_neg', f'{kind}_{torque1_neg}', half_height)
+        add_terms('torque_sum_2_pos', f'{kind}_{torque2_pos}', half_height)
+        add_terms('torque_sum_2_neg', f'{kind}_{torque2_neg}', half_height)
+
+    # Vertical forces at the contact points of the knob connections. The contact points on top of a voxel depend on
+    # the brick above it, and those on the bottom on the brick itself.
+    top_offsets = np.where(four_pt_voxel[above][:, None, None], _FOUR_PT_OFFSETS, _THREE_PT_OFFSETS)
+    bottom_offsets = np.where(four_pt_voxel[:, None, None], _FOUR_PT_OFFSETS, _THREE_PT_OFFSETS)
+    for up, down, offsets in [('f_up', 'n_down', top_offsets), ('n_up', 'f_down', bottom_offsets)]:
+        arm_x = (dx[:, None] + offsets[:, :, 0]) * unit_length
+        arm_y = (dy[:, None] + offsets[:, :, 1]) * unit_length
+        add_terms('force_sum_z_pos', up)
+        add_terms('force_sum_z_neg', down)
+        add_terms('torque_sum_1_pos', up, arm_y)
+        add_terms('torque_sum_1_neg', down, arm_y)
+        add_terms('torque_sum_2_pos', down, arm_x)
+        add_terms('torque_sum_2_neg', up, arm_x)
+
+    # Each sum variable equals the sum of its terms, plus the torque of the weight of the brick spread over its voxels
+    voxel_keys = brick_keys[voxel_brick]
+    weight_per_voxel = brick_weight[voxel_brick] / area[voxel_brick]
+    weight_torques = {
+        'torque_sum_1_neg': dy * unit_length * weight_per_voxel,
+        'torque_sum_2_pos': dx * unit_length * weight_per_voxel,
+    }
+    brick_rows = np.arange(n_bricks)
+    for name, terms in sum_terms.items():
+        rhs = np.zeros(n_bricks)
+        if name in weight_torques:
+            rhs = np.bincount(voxel_keys, weights=weight_torques[name], minlength=n_bricks)
+        add_equalities([(brick_rows, v[name], 1.0)]
+                       + [(voxel_keys[voxels], columns, -coefficients) for voxels, columns, coefficients in terms],
+                       rhs)
+    brick_weights = np.zeros(n_bricks)
+    brick_weights[brick_keys] = brick_weight
+    for total, rhs in [('force_sum_x', 0.0), ('force_sum_y', 0.0), ('force_sum_z', -brick_weights),
+                       ('torque_sum_1', 0.0), ('torque_sum_2', 0.0)]:
+        add_equalities([(brick_rows, v[total], 1.0), (brick_rows, v[f'{total}_pos'], -1.0),
+                        (brick_rows, v[f'{total}_neg'], 1.0)], np.broadcast_to(rhs, n_bricks))
+
+    # Equilibrium error, and the forces pulling knobs out of their sockets
+    abs_pairs = np.stack([np.concatenate([v[result] for result, _ in _ABS_VARIABLES]),
+                          np.concatenate([v[argument] for _, argument in _ABS_VARIABLES])], axis=1)
+    add_equalities([(np.zeros(1, dtype=int), v['eq_obj'].reshape(1), 1.0),
+                    (np.zeros(len(abs_pairs), dtype=int), abs_pairs[:, 0], -1.0)], np.zeros(1))
+
+    f_down = v['f_down']
+    f_down_exists = f_down >= 0
+    f_down_keys = np.broadcast_to(voxel_keys[:, None], f_down.shape)[f_down_exists]
+    f_down_vars = f_down[f_down_exists]
+    order = np.argsort(f_down_keys, kind='stable')
+    max_results = np.unique(f_down_keys)
+    max_args = np.split(f_down_vars[order], np.searchsorted(f_down_keys[order], max_results[1:]))
+    max_results = v['brick_max_f_down'][max_results]
+
+    objective = np.zeros(n_vars)
+    objective[v['eq_obj']] = 1
+    if len(f_down_vars) > 0:
+        add_equalities([(np.zeros(1, dtype=int), v['sum_f_up'].reshape(1), 1.0),
+                        (np.zeros(len(f_down_vars), dtype=int), f_down_vars, -1.0)], np.zeros(1))
+        add_equalities([(np.zeros(1, dtype=int), v['sum_brick_max_f_down'].reshape(1), 1.0),
+                        (np.zeros(n_bricks, dtype=int), v['brick_max_f_down'], -1.0)], np.zeros(1))
+        objective[v['sum_brick_max_f_down']] = cfg.alpha
+        objective[v['sum_f_up']] = cfg.beta
+
+    rows, columns, coefficients = (np.concatenate(parts) for parts in zip(*blocks))
+    b_eq = np.concatenate(b_eq)
+    a_eq = sparse.csr_array((coefficients, (rows, columns)), shape=(len(b_eq), n_vars))
+
+    return StabilityModel(
+        lb=lb,
+        ub=ub,
+        objective=objective,
+        a_eq=a_eq,
+        b_eq=b_eq,
+        complementarity=np.concatenate(complementarity),
+        abs_pairs=abs_pairs,
+        max_results=max_results,
+        max_args=max_args,
+        variables=variables,
+        voxels=np.stack([vx, vy, vz], axis=1),
+        voxel_bricks=voxel_keys,
+        world_dimension=world_dim,
+        max_force=max_force,
+    )
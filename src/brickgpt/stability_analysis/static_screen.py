@@ -0,0 +1,224 @@
+from dataclasses import dataclass
+
+import numpy as np
+
+from .stability_model import _FOUR_PT_OFFSETS, _THREE_PT_OFFSETS
+
+
+@dataclass
+class StaticScreen:
+    """
+    The outcome of the static stability screen of a brick structure. Each check is sufficient but not necessary,
+    so a brick can be neither supported nor failing, and then only the stability analysis can decide.
+    """
+    # (n_bricks,) whether the weight of the brick and of everything resting on it can be carried down to the ground
+    # by knob connections that only push. If every brick is supported, the stability analysis scores every voxel 0.
+    supported: np.ndarray
+    # (n_bricks,) whether the brick does not reach the ground, or the part of the structure that hangs from one knob
+    # connection below the brick is so heavy and far from that knob that the connection must pull harder than it can.
+    # If any brick is failing, the stability analysis scores 1 for the brick or a brick of that part.
+    failing: np.ndarray
+
+    @property
+    def is_stable(self) -> bool | None:
+        """
+        Whether the structure is certainly stable or certainly unstable, or None if the screen cannot decide.
+        """
+        if self.failing.any():
+            return False
+        if self.supported.all():
+            return True
+        return None
+
+
+def static_stability_screen(brick_structure: dict, brick_library: dict, cfg) -> StaticScreen:
+    """
+    Decides the stability of the obvious cases of a brick structure without solving the stability model.
+
+    Bricks are supported if the loads can be passed down layer by layer from the top, with every voxel pushing down on
+    the voxel below it. Each brick passes the load on its supported voxels straight down, and spreads the load on its
+    other voxels over its supported voxels with a linear pressure distribution that has the same resultant and moment.
+    The brick is supported if that distribution pushes everywhere, and everything resting on it is supported.
+
+    Bricks are failing if they do not reach the ground through other bricks, or if the part of the structure above them
+    touches the rest only at a single voxel below the brick. For that part to be in equilibrium, the contact points of
+    that knob connection alone must carry its weight and balance the moment of its weight about the stud, which takes
+    some contact point to pull. See _min_pull.
+    :param brick_structure: The brick structure in JSON format. It must not have colliding or out-of-bounds bricks.
+    :param brick_library: The brick library.
+    :param cfg: The StabilityConfig.
+    """
+    from brickgpt.data.brick_library import compile_brick_library
+
+    library_tables = compile_brick_library(brick_library)
+    world_dim = tuple(cfg.world_dimension)
+    max_force = cfg.T / 1000 * cfg.g
+    n_bricks = len(brick_structure)
+
+    bricks = list(brick_structure.values())
+    brick_ids = np.array([int(brick['brick_id']) for brick in bricks], dtype=int)
+    oris = np.array([brick['ori'] for brick in bricks], dtype=int)
+    brick_x, brick_y, brick_z = (np.array([brick[c] for brick in bricks], dtype=int) for c in 'xyz')
+    h, w = library_tables.oriented_dimensions[oris, brick_ids].reshape(-1, 2).T
+    brick_weight = library_tables.mass[brick_ids] * cfg.g
+    four_pt = library_tables.four_pt_connection[brick_ids]
+    center = np.stack([brick_x + (h - 1) / 2, brick_y + (w - 1) / 2], axis=1)
+
+    # Voxels of all bricks, as in build_stability_model
+    area = h * w
+    voxel_brick = np.repeat(np.arange(n_bricks), area)
+    offset = np.arange(area.sum()) - np.repeat(np.cumsum(area) - area, area)
+    vx = brick_x[voxel_brick] + offset // w[voxel_brick]
+    vy = brick_y[voxel_brick] + offset % w[voxel_brick]
+    vz = brick_z[voxel_brick]
+    position = np.stack([vx, vy], axis=1).astype(float)
+    n_voxels = len(voxel_brick)
+    voxel_at = np.full(world_dim, -1)
+    voxel_at[vx, vy, vz] = np.arange(n_voxels)
+
+    def neighbors(dx: int, dy: int, dz: int) -> np.ndarray:
+        """Returns the voxel next to each voxel in the given direction, or -1 if it is empty or outside the world."""
+        nx, ny, nz = vx + dx, vy + dy, vz + dz
+        inside = (nx >= 0) & (nx < world_dim[0]) & (ny >= 0) & (ny < world_dim[1]) & (nz >= 0) & (nz < world_dim[2])
+        result = np.full(n_voxels, -1)
+        result[inside] = voxel_at[nx[inside], ny[inside], nz[inside]]
+        return result
+
+    above, below = neighbors(0, 0, 1), neighbors(0, 0, -1)
+    on_support = (vz == 0) | (below >= 0)
+
+    # Supported bricks: pass the loads down from the top layer, with load[v] the push of voxel v on what is below it
+    supported = np.zeros(n_bricks, dtype=bool)
+    load = np.zeros(n_voxels)
+    for z in range(int(vz.max(initial=-1)), -1, -1):
+        layer = np.flatnonzero(vz == z)
+        layer_bricks = voxel_brick[layer]
+        layer_above = above[layer]
+
+        def per_brick(values: np.ndarray) -> np.ndarray:
+            return np.bincount(layer_bricks, weights=values, minlength=n_bricks)
+
+        incoming = np.where(layer_above >= 0, load[layer_above], 0)
+        # Whether the loads from above are known
+        certain = per_brick((layer_above >= 0) & ~supported[voxel_brick[layer_above]]) == 0
+
+        # Each voxel carries its share of the brick weight and its load from above. The loads on unsupported voxels,
+        # with total r_force and moment r_moment about the origin, are spread over the supported voxels.
+        straight = brick_weight[layer_bricks] / area[layer_bricks] + incoming
+        layer_support = on_support[layer]
+        moved = np.where(layer_support, 0, straight)
+        n_support = per_brick(layer_support.astype(float))
+        r_force = per_brick(moved)
+        r_moment = np.stack([per_brick(moved * position[layer, 0]), per_brick(moved * position[layer, 1])], axis=1)
+        mean = np.stack([per_brick(layer_support * position[layer, 0]), per_brick(layer_support * position[layer, 1])],
+                        axis=1) / np.maximum(n_support, 1)[:, None]
+
+        # The linear distribution r_force / n_support + lam @ (p - mean) over the supported voxels p has the moment
+        # r_moment if second_moment @ lam == r_moment - r_force * mean
+        deviation = np.where(layer_support[:, None], position[layer] - mean[layer_bricks], 0)
+        second_moment = np.zeros((n_bricks, 2, 2))
+        np.add.at(second_moment, layer_bricks, deviation[:, :, None] * deviation[:, None, :])
+        target = r_moment - r_force[:, None] * mean
+        lam = (np.linalg.pinv(second_moment) @ target[:, :, None])[:, :, 0]
+        tolerance = 1e-9 * (per_brick(straight) + max_force)
+        moment_error = np.abs((second_moment @ lam[:, :, None])[:, :, 0] - target)
+        exact = (moment_error <= tolerance[:, None] * max(world_dim)).all(axis=1)  # Not if the supports are in a line
+
+        spread = (r_force / np.maximum(n_support, 1))[layer_bricks] + (lam[layer_bricks] * deviation).sum(axis=1)
+        pushes = np.where(layer_support, straight + spread, 0)
+        pushes_everywhere = per_brick((pushes < -tolerance[layer_bricks]).astype(float)) == 0
+
+        in_layer = np.zeros(n_bricks, dtype=bool)
+        in_layer[layer_bricks] = True
+        supported |= in_layer & certain & (n_support > 0) & exact & pushes_everywhere
+        load[layer] = np.maximum(pushes, 0)
+
+    # Failing bricks: search the graph of bricks in contact from the ground, node n_bricks, for the knob connections
+    # through which a part of the structure hangs on a single voxel
+    vertical_voxels = np.flatnonzero(on_support)
+    lower_bricks = np.where(vz[vertical_voxels] == 0, n_bricks, voxel_brick[below[vertical_voxels]])
+    vertical = np.stack([voxel_brick[vertical_voxels], lower_bricks], axis=1)  # (upper, lower)
+    pairs = [vertical]
+    for side in [neighbors(1, 0, 0), neighbors(0, 1, 0)]:
+        touching = (side >= 0) & (voxel_brick[side] != voxel_brick)
+        pairs.append(np.stack([voxel_brick[touching], voxel_brick[side[touching]]], axis=1))
+    edges = np.unique(np.sort(np.concatenate(pairs), axis=1), axis=0)
+    discovered, finished, bridges = _search_bridges(n_bricks + 1, edges.tolist(), n_bricks)
+
+    failing = discovered[:n_bricks] < 0  # Nothing balances the weight of bricks that do not reach the ground
+    contacts, first, n_contacts = np.unique(vertical, axis=0, return_index=True, return_counts=True)
+    single = n_contacts == 1
+    single_contacts = {(upper, lower): vertical_voxels[i] for (upper, lower), i in zip(contacts[single].tolist(),
+                                                                                       first[single].tolist())}
+    for lower, upper in bridges:
+        voxel = single_contacts.get((upper, lower))
+        if voxel is None:
+            continue
+        part = (discovered[:n_bricks] >= discovered[upper]) & (discovered[:n_bricks] < finished[upper])
+        part_weight = brick_weight[part].sum()
+        part_center = brick_weight[part] @ center[part] / part_weight
+        dx, dy = (part_center - position[voxel]).tolist()
+        failing[upper] |= _min_pull(part_weight, dx, dy, four_pt[upper]) >= max_force
+
+    return StaticScreen(supported=supported, failing=failing)
+
+
+def _search_bridges(n_nodes: int, edges: list[list[int]], root: int) -> (np.ndarray, np.ndarray, list[tuple[int, int]]):
+    """
+    Searches an undirected graph depth-first from a root node, and finds its bridges, the edges whose removal
+    disconnects the graph.
+    :return: The discovery time of each node, or -1 if it is not reachable from the root, the discovery time after the
+             subtree of each node was searched, and the bridges as (parent, child) pairs of the search tree.
+             Removing a bridge separates the subtree of the child, the nodes discovered between the two times.
+    """
+    adjacency = [[] for _ in range(n_nodes)]
+    for edge_index, (node1, node2) in enumerate(edges):
+        adjacency[node1].append((node2, edge_index))
+        adjacency[node2].append((node1, edge_index))
+
+    discovered = [-1] * n_nodes
+    finished = [-1] * n_nodes
+    low = [0] * n_nodes  # The earliest discovery time reachable from the subtree of each node with one back edge
+    bridges = []
+    discovered[root] = low[root] = 0
+    time = 1
+    stack = [(root, -1, iter(adjacency[root]))]
+    while stack:
+        node, parent_edge, neighbors = stack[-1]
+        for neighbor, edge_index in neighbors:
+            if edge_index == parent_edge:
+                continue
+            if discovered[neighbor] >= 0:
+                low[node] = min(low[node], discovered[neighbor])
+            else:
+                discovered[neighbor] = low[neighbor] = time
+                time += 1
+                stack.append((neighbor, edge_index, iter(adjacency[neighbor])))
+                break
+        else:
+            stack.pop()
+            finished[node] = time
+            if stack:
+                parent = stack[-1][0]
+                low[parent] = min(low[parent], low[node])
+                if low[node] > discovered[parent]:
+                    bridges.append((parent, node))
+    return np.array(discovered), np.array(finished), bridges
+
+
+def _min_pull(weight: float, dx: float, dy: float, four_pt: bool) -> float:
+    """
+    Returns a lower bound on the largest pull at a contact point of a knob connection that alone holds up a weight,
+    whose center of mass is at (dx, dy) studs from the center of the knob.
+
+    Only the net upward force u of each contact point enters the equilibrium, which needs sum(u) == weight and
+    sum(u * offset) == weight * (dx, dy). A contact point with u < 0 pulls with at least -u. With three contact points,
+    this fixes u. With four, u can move along (1, -1, 1, -1), and the largest pull is smallest when the pulls on the
+    two axes are equal.
+    """
+    if four_pt:
+        r = _FOUR_PT_OFFSETS[:, 1].max()
+        return max(0.0, weight * ((abs(dx) + abs(dy)) / r - 1) / 4)
+    offsets = _THREE_PT_OFFSETS[:3]
+    u = np.linalg.solve(np.vstack([np.ones(3), offsets.T]), weight * np.array([1, dx, dy]))
+    return max(0.0, -u.min())
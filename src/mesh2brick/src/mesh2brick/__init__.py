@@ -1 +1,10 @@
-from .mesh2brick import Mesh2Brick
+def __getattr__(name: str):
+    # Mesh2Brick pulls in open3d and trimesh, so it is imported on first use to keep submodules such as
+    # mesh2brick.data fast to import
+    if name == 'Mesh2Brick':
+        from .mesh2brick import Mesh2Brick
+        return Mesh2Brick
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+__all__ = ['Mesh2Brick']
@@ -1,49 +1,128 @@
 import json
+from dataclasses import dataclass
 from pathlib import Path
 
+import numpy as np
+
 with open(Path(__file__).parent / 'brick_library.json') as f:
     brick_library = json.load(f)  # Maps brick ID to brick properties
 
-max_brick_dimension = max(max(properties['length'], properties['width']) for properties in brick_library.values())
 
+@dataclass(frozen=True, kw_only=True)
+class BrickLibraryTables:
+    """
+    The brick library compiled into dense lookup tables indexed by brick ID or brick dimensions.
+    Entries for brick IDs and dimensions that are not in the library are -1 (or NaN, None and False).
+    """
+    oriented_dimensions: np.ndarray  # [ori, brick_id] -> (l, w) of the brick placed with the given orientation
+    heights: np.ndarray  # [brick_id] -> h
+    mass: np.ndarray  # [brick_id] -> mass
+    four_pt_connection: np.ndarray  # [brick_id] -> whether the brick is one stud wide
+    part_ids: np.ndarray  # [brick_id] -> LDraw part ID
+    dimensions_to_brick_id: np.ndarray  # [l, w, h] -> brick ID, with l and w in either order
+    part_id_to_brick_id: dict[str, int]
+
+    @property
+    def dimensions(self) -> np.ndarray:
+        """
+        [brick_id] -> (l, w, h) of the brick in orientation 0.
+        """
+        return np.column_stack([self.oriented_dimensions[0], self.heights])
+
+
+def compile_brick_library(library: dict) -> BrickLibraryTables:
+    """
+    Compiles a brick library, mapping brick ID strings to brick properties, into lookup tables.
+    The tables of the default brick library are compiled once, at import time.
+    """
+    if library is brick_library:
+        return brick_library_tables
+    return _compile_brick_library(library)
+
+
+def _compile_brick_library(library: dict) -> BrickLibraryTables:
+    brick_ids = [int(brick_id) for brick_id in library]
+    n_ids = max(brick_ids, default=-1) + 1
+    max_dimension = max((max(properties['length'], properties['width']) for properties in library.values()),
+                        default=0)
+    max_height = max((properties['height'] for properties in library.values()), default=0)
+
+    dimensions = np.full((n_ids, 2), -1, dtype=int)
+    heights = np.full(n_ids, -1, dtype=int)
+    mass = np.full(n_ids, np.nan)
+    part_ids = np.full(n_ids, None, dtype=object)
+    dimensions_to_brick_id = np.full((max_dimension + 1, max_dimension + 1, max_height + 1), -1, dtype=int)
+    part_id_to_brick_id = {}
+    for brick_id, properties in zip(brick_ids, library.values()):
+        l, w, h = properties['length'], properties['width'], properties['height']
+        dimensions[brick_id] = l, w
+        heights[brick_id] = h
+        mass[brick_id] = properties['mass']
+        part_ids[brick_id] = properties['partID']
+        for key in [(l, w, h), (w, l, h)]:  # The first brick ID with the given dimensions wins
+            if dimensions_to_brick_id[key] == -1:
+                dimensions_to_brick_id[key] = brick_id
+        part_id_to_brick_id.setdefault(properties['partID'], brick_id)
 
-def _make_dimensions_to_brick_id_dict() -> dict:
-    result = {}
-    for brick_id, properties in brick_library.items():
-        key = (properties['length'], properties['width'], properties['height'])
-        if key not in result.keys():
-            result[key] = int(brick_id)
-    return result
+    return BrickLibraryTables(
+        oriented_dimensions=np.stack([dimensions, dimensions[:, ::-1]]),
+        heights=heights,
+        mass=mass,
+        four_pt_connection=(dimensions.min(axis=1) < 2) & (dimensions.min(axis=1) >= 0),
+        part_ids=part_ids,
+        dimensions_to_brick_id=dimensions_to_brick_id,
+        part_id_to_brick_id=part_id_to_brick_id,
+    )
 
 
-_dimensions_to_brick_id_dict = _make_dimensions_to_brick_id_dict()
+brick_library_tables = _compile_brick_library(brick_library)
+
+max_brick_dimension = brick_library_tables.dimensions_to_brick_id.shape[0] - 1
 
 
 def dimensions_to_brick_id(l: int, w: int, h: int):
     if l > w:
         l, w = w, l
-    try:
-        return _dimensions_to_brick_id_dict[(l, w, h)]
-    except KeyError:
+    table = brick_library_tables.dimensions_to_brick_id
+    brick_id = table[l, w, h] if 0 <= l and w < table.shape[1] and 0 <= h < table.shape[2] else -1
+    if brick_id == -1:
         raise ValueError(f'No brick ID for brick of dimensions: {l}x{w}x{h}')
+    return int(brick_id)
 
 
 def brick_id_to_dimensions(brick_id: int) -> (int, int, int):
-    return brick_library[str(brick_id)]['length'], brick_library[str(brick_id)]['width'], brick_library[str(brick_id)]['height']
+    brick_id = _check_brick_id(brick_id)
+    l, w = brick_library_tables.oriented_dimensions[0, brick_id].tolist()
+    return l, w, brick_library_tables.heights[brick_id].item()
 
 
 def brick_id_to_part_id(brick_id: int) -> str:
     """
     Returns the part ID of the given brick, which is the ID of the brick model used in LDraw files.
     """
-    return brick_library[str(brick_id)]['partID']
+    return brick_library_tables.part_ids[_check_brick_id(brick_id)]
 
 
 def part_id_to_brick_id(part_id: str) -> int:
     """
     Returns the brick ID of the given part ID, which is the ID of the brick used in the brick library.
     """
-    for brick_id, properties in brick_library.items():
-        if properties['partID'] == part_id:
-            return int(brick_id)
-    raise ValueError(f'No brick ID for part ID: {part_id}')
+    try:
+        return brick_library_tables.part_id_to_brick_id[part_id]
+    except KeyError:
+        raise ValueError(f'No brick ID for part ID: {part_id}')
+
+
+def _check_brick_id(brick_id: int) -> int:
+    """
+    Returns the brick ID as an index into the lookup tables. Raises a KeyError for brick IDs that are not in the library,
+    like a lookup in the brick library dict.
+    """
+    heights = brick_library_tables.heights
+    try:
+        index = int(brick_id)
+    except (TypeError, ValueError):
+        raise KeyError(str(brick_id))
+    if not (0 <= index < len(heights) and heights[index] >= 0):
+        raise KeyError(str(brick_id))
+    return index
@@ -2,7 +2,6 @@ import re
 import warnings
 from dataclasses import dataclass
 
-import networkx as nx
 import numpy as np
 
 from mesh2brick.data.brick_library import (brick_library, dimensions_to_brick_id, brick_id_to_dimensions,
@@ -201,13 +200,18 @@ class BrickStructure:
             return False
         return self.stability_scores().max() < 1
 
-    def stability_scores(self) -> np.ndarray:
+    def stability_scores(self, component_workers: int = 0) -> np.ndarray:
+        """
+        :param component_workers: If positive, each group of bricks in contact is analyzed with a separate model,
+                                  on this many threads.
+        """
         if self.has_collisions():
             raise ValueError('Cannot compute stability scores - structure has colliding bricks.')
         if self.has_out_of_bounds_bricks():
             raise ValueError('Cannot compute stability scores - structure has out of bounds bricks.')
         scores, _, _, _, _ = stability_score(self.to_json(), brick_library,
-                                             StabilityConfig(world_dimension=self.world_dim))
+                                             StabilityConfig(world_dimension=self.world_dim,
+                                                             component_workers=component_workers))
         return scores
 
     @classmethod
@@ -240,6 +244,8 @@ class ConnectivityBrickStructure:
         self.bricks = {}  # Dictionary node_id -> brick
         self.node_id_counter = 0
 
+        import networkx as nx  # Imported on first use, since it is slow to import
+
         self.connection_graph = nx.Graph()
         self.neighbor_graph = nx.Graph()
 
@@ -273,6 +279,8 @@ class ConnectivityBrickStructure:
 
     def connected_components(self):
         if self._connected_components is None:
+            import networkx as nx
+
             self._connected_components = list(nx.connected_components(self.connection_graph))
         return self._connected_components
 
@@ -292,9 +300,9 @@ class ConnectivityBrickStructure:
                                     for node in component}
         return self._node2component
 
-    def stability_score(self) -> np.ndarray:
+    def stability_score(self, component_workers: int = 0) -> np.ndarray:
         bricks = BrickStructure(list(self.bricks.values()), self.voxel_bricks.shape)
-        return bricks.stability_scores()
+        return bricks.stability_scores(component_workers)
 
     def node_exists(self, node_id: int):
         return node_id in self.bricks
@@ -0,0 +1,80 @@
+"""
+Thread pools and Gurobi environments shared by every stability analysis in the process, including brickgpt's.
+"""
+import atexit
+import contextlib
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# One thread pool per number of workers. Pools live as long as the process, and are never shut down while in use.
+_component_pools: dict[int, ThreadPoolExecutor] = {}
+_component_pools_lock = threading.Lock()
+
+# Creating a Gurobi environment checks the licence, so environments are reused by later models on any thread.
+# An environment must not be used by two threads at once, so each one is taken out of the pool while in use.
+_gurobi_envs = []
+_idle_gurobi_envs = queue.SimpleQueue()
+
+
+def component_executor(max_workers: int) -> ThreadPoolExecutor:
+    """
+    Returns the thread pool with the given number of workers, and creates it on first use.
+    """
+    with _component_pools_lock:
+        if max_workers not in _component_pools:
+            _component_pools[max_workers] = ThreadPoolExecutor(max_workers=max_workers,
+                                                               thread_name_prefix='stability')
+        return _component_pools[max_workers]
+
+
+def score_components(score_fn, components: list[dict], labels: np.ndarray, max_workers: int):
+    """
+    Computes the stability scores of each group of bricks in contact on a thread pool, and merges them.
+    :param score_fn: Computes the stability scores of the brick structure of one group, as stability_score does.
+    :param components: The brick structure of each group in JSON format.
+    :param labels: The voxel grid in which each voxel of the k-th group is labelled k + 1.
+    :param max_workers: The number of threads.
+    :return: The merged result, in the same format as the result of stability_score.
+    """
+    t_start = time.time()
+    results = list(component_executor(max_workers).map(score_fn, components))
+    # Each component only scores its own voxels, as an unsolved component scores 1 on the whole world
+    analysis_score = np.zeros(labels.shape)
+    for label, result in enumerate(results, start=1):
+        in_component = labels == label
+        analysis_score[in_component] = result[0][in_component]
+    num_vars = sum(result[1] for result in results)
+    num_constr = sum(result[2] for result in results)
+    solve_t = sum(result[4] for result in results)
+    return analysis_score, num_vars, num_constr, time.time() - t_start, solve_t
+
+
+@contextlib.contextmanager
+def gurobi_env():
+    """
+    Lends an idle Gurobi environment, and creates one if there is none.
+    """
+    import gurobipy as gp
+
+    try:
+        env = _idle_gurobi_envs.get_nowait()
+    except queue.Empty:
+        env = gp.Env()
+        _gurobi_envs.append(env)
+    try:
+        yield env
+    finally:
+        _idle_gurobi_envs.put(env)
+
+
+@atexit.register
+def _close_solver_resources():
+    with _component_pools_lock:
+        for pool in _component_pools.values():
+            pool.shutdown()
+    for env in _gurobi_envs:
+        env.dispose()
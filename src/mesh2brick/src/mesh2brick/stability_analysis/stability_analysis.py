@@ -1,9 +1,8 @@
+import dataclasses
 import time
 from dataclasses import dataclass
 
-import gurobipy as gp
-from gurobipy import GRB
-
+from .solver_resources import gurobi_env, score_components
 from .utils import *
 
 
@@ -18,11 +17,24 @@ class StabilityConfig:
     world_dimension: tuple[int, int, int] = (20, 20, 20) #change
     alpha: float = 0.001
     beta: float = 0.000001
+    component_workers: int = 0  # If positive, each group of bricks in contact is solved separately on this many threads
 
 
 def stability_score(brick_structure, brick_library, cfg=StabilityConfig()):
+    if cfg.component_workers > 0:
+        return _stability_score_by_component(brick_structure, brick_library, cfg)
+    with gurobi_env() as env:
+        return _stability_score_in_env(brick_structure, brick_library, cfg, env)
+
+
+def _stability_score_in_env(brick_structure, brick_library, cfg, env):
+    # Gurobi is imported on first use, so that the rest of the package does not need a Gurobi install
+    import gurobipy as gp
+    from gurobipy import GRB
+    from mesh2brick.data.brick_library import compile_brick_library
+
     ############### Setup ###############
-    brick_library = brick_library
+    library_tables = compile_brick_library(brick_library)
     g_ = cfg.g  # N/kg
     T_ = cfg.T / 1000 * g_  # N
     brick_unit_height = cfg.brick_unit_height  # mm
@@ -32,12 +44,12 @@ def stability_score(brick_structure, brick_library, cfg=StabilityConfig()):
     alpha = cfg.alpha
     beta = cfg.beta
 
-    world_grid = construct_world_grid(brick_structure, world_dim, brick_library)
+    world_grid = construct_world_grid(brick_structure, world_dim, library_tables)
     n_bricks = len(brick_structure)
     t_start = time.time()
 
     ############### Setup Optimization ###############
-    model = gp.Model("stability_analysis")
+    model = gp.Model("stability_analysis", env=env)
     model.setParam("OutputFlag", print_log)
     model.Params.IterationLimit = 1000000
     model.setParam("MIPFocus", 1)
@@ -71,21 +83,13 @@ def stability_score(brick_structure, brick_library, cfg=StabilityConfig()):
     for key in brick_structure.keys():
         brick = brick_structure[key]
         brick_id = str(brick["brick_id"])
-        h = brick_library[brick_id]["height"]
-
-        if brick["ori"] == 0:
-            l = brick_library[brick_id]["length"]
-            w = brick_library[brick_id]["width"]
-        else:
-            w = brick_library[brick_id]["length"]
-            l = brick_library[brick_id]["width"]
+        h = library_tables.heights[int(brick_id)].item()
+
+        l, w = oriented_dimensions(brick, library_tables)
         brick_x = brick["x"]
         brick_y = brick["y"]
         brick_z = brick["z"]
-        if min(w, l) < 2:
-            four_pt_connections = 1
-        else:
-            four_pt_connections = 0
+        four_pt_connections = int(library_tables.four_pt_connection[int(brick_id)])
             
         for x in range(brick_x, brick_x + l):
             for y in range(brick_y, brick_y + w):
@@ -123,14 +127,9 @@ def stability_score(brick_structure, brick_library, cfg=StabilityConfig()):
         brick = brick_structure[key]
         brick_id = str(brick["brick_id"])
         
-        h = brick_library[brick_id]["height"]
+        h = library_tables.heights[int(brick_id)].item()
 
-        if brick["ori"] == 0:
-            l = brick_library[brick_id]["length"]
-            w = brick_library[brick_id]["width"]
-        else:
-            w = brick_library[brick_id]["length"]
-            l = brick_library[brick_id]["width"]
+        l, w = oriented_dimensions(brick, library_tables)
 
         brick_x = brick["x"]
         brick_y = brick["y"]
@@ -203,16 +202,11 @@ def stability_score(brick_structure, brick_library, cfg=StabilityConfig()):
         brick = brick_structure[key]
         brick_id = str(brick["brick_id"])
         
-        h = brick_library[brick_id]["height"]
+        h = library_tables.heights[int(brick_id)].item()
 
-        if brick["ori"] == 0:
-            l = brick_library[brick_id]["length"]
-            w = brick_library[brick_id]["width"]
-        else:
-            w = brick_library[brick_id]["length"]
-            l = brick_library[brick_id]["width"]
+        l, w = oriented_dimensions(brick, library_tables)
 
-        brick_weight = brick_library[brick_id]["mass"] * g_
+        brick_weight = library_tables.mass[int(brick_id)].item() * g_
         brick_x = brick["x"]
         brick_y = brick["y"]
         brick_z = brick["z"]
@@ -491,21 +485,19 @@ def stability_score(brick_structure, brick_library, cfg=StabilityConfig()):
 
     if model.Status != gp.GRB.Status.OPTIMAL:
         print('Model did not solve successfully. Check status code:', model.Status)
-        return np.ones(world_dim), model.NumVars, model.NumConstrs, total_t, solve_t
+        num_vars = model.NumVars
+        num_constr = model.NumConstrs
+        model.close()
+        return np.ones(world_dim), num_vars, num_constr, total_t, solve_t
 
     heatmap_color = np.zeros((world_dim[0], world_dim[1], world_dim[2], 3))
     for key in brick_structure.keys():
         brick = brick_structure[key]
         brick_id = str(brick["brick_id"])
         
-        h = brick_library[brick_id]["height"]
-
-        if brick["ori"] == 0:
-            l = brick_library[brick_id]["length"]
-            w = brick_library[brick_id]["width"]
-        else:
-            w = brick_library[brick_id]["length"]
-            l = brick_library[brick_id]["width"]
+        h = library_tables.heights[int(brick_id)].item()
+
+        l, w = oriented_dimensions(brick, library_tables)
         brick_x = brick["x"]
         brick_y = brick["y"]
         brick_z = brick["z"]
@@ -548,3 +540,18 @@ def stability_score(brick_structure, brick_library, cfg=StabilityConfig()):
     analysis_score = heatmap_color[:, :, :, 0]
     return analysis_score, num_vars, num_constr, total_t, solve_t
 
+
+def _stability_score_by_component(brick_structure, brick_library, cfg):
+    """
+    Computes the stability scores of each group of bricks in contact with a separate model, and merges them.
+    The models share no variables, and the objective is a sum over bricks, so this gives the same optimum.
+    """
+    from mesh2brick.data.brick_library import compile_brick_library
+
+    labels, components = label_contact_components(brick_structure, cfg.world_dimension,
+                                                  compile_brick_library(brick_library))
+    component_cfg = dataclasses.replace(cfg, component_workers=0)
+    if len(components) <= 1:
+        return stability_score(brick_structure, brick_library, component_cfg)
+    return score_components(lambda component: stability_score(component, brick_library, component_cfg),
+                            components, labels, cfg.component_workers)
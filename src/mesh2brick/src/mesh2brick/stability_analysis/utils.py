@@ -1,18 +1,12 @@
 import numpy as np
 
 
-def construct_world_grid(bricks, world_dimension, brick_library):
+def construct_world_grid(bricks, world_dimension, library_tables):
     world_grid = np.zeros(world_dimension)
     for key in bricks.keys():
         brick = bricks[key]
-        brick_id = str(brick["brick_id"])
-        if brick["ori"] == 0:
-            l = brick_library[brick_id]["length"]
-            w = brick_library[brick_id]["width"]
-        else:
-            w = brick_library[brick_id]["length"]
-            l = brick_library[brick_id]["width"]
-        brick_h = brick_library[brick_id]['height']
+        l, w = oriented_dimensions(brick, library_tables)
+        brick_h = library_tables.heights[int(brick["brick_id"])].item()
         brick_x = brick["x"]
         brick_y = brick["y"]
         brick_z = brick["z"]
@@ -23,6 +17,31 @@ def construct_world_grid(bricks, world_dimension, brick_library):
     return world_grid
 
 
+def label_contact_components(bricks, world_dimension, library_tables):
+    """
+    Splits a brick structure in JSON format into groups of bricks that touch each other, directly or through other
+    bricks. Returns the voxel grid in which each voxel of the k-th group is labelled k + 1 and empty voxels are
+    labelled 0, and the brick structure of each group, with the bricks renumbered in the same order.
+    """
+    from scipy import ndimage
+
+    # Bricks touch where two voxels share a face, which are the neighbors that ndimage.label connects by default
+    labels, n_components = ndimage.label(construct_world_grid(bricks, world_dimension, library_tables) > 0)
+    components = [{} for _ in range(n_components)]
+    for brick in bricks.values():
+        component = components[labels[brick["x"], brick["y"], brick["z"]] - 1]
+        component[str(len(component) + 1)] = brick
+    return labels, components
+
+
+def oriented_dimensions(brick, library_tables):
+    """
+    Returns the dimensions (l, w) of a brick in JSON format, as placed with its orientation.
+    """
+    l, w = library_tables.oriented_dimensions[brick["ori"], int(brick["brick_id"])].tolist()
+    return l, w
+
+
 def gen_key(x, y, z):
     return "X: " + str(x) + ", Y: " + str(y) + ", Z: " + str(z)
 
@@ -55,8 +55,13 @@ def get_merged_brick(b1: Brick, b2: Brick) -> Brick | None:
 
 
 class Voxel2Brick:
-    def __init__(self, voxels: np.ndarray, max_failures: int = 10, seed: int = 42):
+    def __init__(self, voxels: np.ndarray, max_failures: int = 10, seed: int = 42, stability_workers: int = 0):
+        """
+        :param stability_workers: If positive, the stability of each group of bricks in contact is analyzed with a
+                                  separate model, on this many threads.
+        """
         self.voxels = voxels.astype(bool)
+        self.stability_workers = stability_workers
         self.bricks = ConnectivityBrickStructure(voxels.shape)
 
         self.n_failures = 0
@@ -106,7 +111,7 @@ class Voxel2Brick:
                 self.n_failures += 1
 
         # Split and re-merge critical stability areas
-        stability = self.bricks.stability_score()
+        stability = self.bricks.stability_score(self.stability_workers)
         n_components = self.bricks.n_components()
         self.n_failures = 0
         while self.n_failures < self.max_failures:
@@ -117,7 +122,7 @@ class Voxel2Brick:
             self._brickify_voxels_merge(critical_voxels)
 
             # Are the results better?
-            new_stability = self.bricks.stability_score()
+            new_stability = self.bricks.stability_score(self.stability_workers)
             new_n_components = self.bricks.n_components()
             if new_stability.mean() < stability.mean() and new_n_components <= n_components:
                 stability = new_stability
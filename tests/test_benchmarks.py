@@ -0,0 +1,25 @@
+from brickgpt.benchmarks import build_tiny_llama, run_generation_benchmark, random_bricks_txts, run_codec_benchmark
+from brickgpt.models import BrickGPT, BrickGPTConfig
+
+
+def test_generation_benchmark(tmp_path):
+    """
+    Tests running the generation benchmark offline, with a tiny randomly initialized model.
+    """
+    build_tiny_llama(tmp_path)
+    brickgpt = BrickGPT(BrickGPTConfig(str(tmp_path), device='cpu', use_gurobi=False, max_bricks=3, max_regenerations=1,
+                                       profile=True))
+    results = run_generation_benchmark(brickgpt, ['A basic chair with four legs.'], seeds=[0, 1])
+
+    assert results['n_generations'] == 2
+    assert results['bricks_per_sec'] > 0
+    assert results['tokens_per_sec'] > 0
+    assert results['peak_rss_mb'] > 0
+
+
+def test_codec_benchmark():
+    """
+    Tests that the bulk and per-brick codecs give identical results, which the benchmark checks.
+    """
+    results = run_codec_benchmark(random_bricks_txts(n_structures=10, n_bricks=20))
+    assert results['n_bricks'] == 210
@@ -0,0 +1,28 @@
+import pickle
+
+import numpy as np
+
+from brickgpt.data import BrickDataset, BrickStructure
+
+
+def test_brick_dataset(tmp_path):
+    bricks_txts = ['2x6 (0,0,0)\n2x6 (2,0,0)\n', '', '1x1 (3,4,0)\n2x4 (3,4,1)\n1x8 (0,0,2)\n']
+    captions = [['A wall.', 'Two bricks.'], [], ['A small tower é.']]
+    dataset = BrickDataset.from_txts(tmp_path / 'test.bricks', bricks_txts, captions)
+
+    assert len(dataset) == 3
+    assert dataset.n_bricks == 5
+    assert dataset.to_txts() == bricks_txts
+    assert [dataset.captions(i) for i in range(len(dataset))] == captions
+    assert [len(bricks) for bricks in dataset] == [2, 0, 3]
+    assert dataset.structure(2) == BrickStructure.from_txt(bricks_txts[2])
+
+    # Structures are read-only views of the memory map
+    assert np.shares_memory(dataset[2], dataset[0:3][2])
+    assert not dataset[0].flags.writeable
+
+    subset = pickle.loads(pickle.dumps(dataset[1:]))
+    assert len(subset) == 2
+    assert subset.n_bricks == 3
+    assert subset.captions(-1) == captions[2]
+    assert BrickDataset.from_ldrs(tmp_path / 'test_ldr.bricks', subset.to_ldrs()).to_txts() == bricks_txts[1:]
@@ -1,6 +1,15 @@
+import json
+from pathlib import Path
+
+import numpy as np
 import pytest
 
-from brickgpt.data import Brick, BrickStructure
+import brickgpt
+
+from brickgpt.data import Brick, BrickStructure, brick_library
+from brickgpt.data.brick_library import brick_id_to_part_id, brick_library_tables, compile_brick_library
+from brickgpt.stability_analysis import (IncrementalStabilityModel, StabilityConfig, build_stability_model,
+                                         split_contact_components)
 
 
 def test_brick():
@@ -37,6 +46,18 @@ def test_brick_structure():
     assert BrickStructure.from_txt(bricks_txt) != BrickStructure([])
 
 
+def test_brick_structure_out_of_range():
+    bricks = BrickStructure([])
+    with pytest.raises(ValueError):
+        bricks.add_brick(Brick.from_txt('2x4 (40000,0,0)'))
+    assert len(bricks) == 0
+    for bricks_txt in ['2x4 (40000,0,0)\n', '2x4 (-40000,0,0)\n2x4 (0,0,0)\n']:
+        with pytest.raises(ValueError):
+            BrickStructure.from_txt(bricks_txt)
+    with pytest.raises(ValueError):
+        BrickStructure.from_json({'1': {'brick_id': 3, 'x': 0, 'y': 0, 'z': 40000, 'ori': 0}})
+
+
 @pytest.mark.parametrize(
     'brick_txt,has_collisions', [
         ('2x6 (0,0,0)\n2x6 (2,0,0)\n', False),
@@ -67,10 +88,49 @@ def test_stability_check(brick_txt: str, is_stable: bool):
     assert bricks.is_stable() == is_stable
 
 
+@pytest.mark.parametrize(
+    'brick_txt,is_stable', [
+        ('2x6 (0,0,0)\n2x6 (2,0,0)\n', True),
+        ('2x6 (0,0,0)\n2x6 (2,0,1)\n', False),
+        ('1x1 (0,0,0)\n1x8 (0,0,1)\n1x8 (0,7,2)\n1x4 (0,14,3)\n', True),
+    ])
+def test_stability_check_highs(brick_txt: str, is_stable: bool):
+    bricks = BrickStructure.from_txt(brick_txt)
+    assert bricks.is_stable(solver='highs') == is_stable
+
+
+def _few_shot_prefixes() -> list[str]:
+    with open(Path(brickgpt.__file__).parent / 'models' / 'few_shot_examples.json') as f:
+        examples = json.load(f)
+    prefixes = []
+    for example in examples:
+        bricks = BrickStructure.from_txt(example['bricks'])
+        for n_bricks in [2, 3, 4, len(bricks)]:
+            prefix = bricks.copy()
+            prefix.truncate(n_bricks)
+            prefixes.append(prefix.to_txt())
+    return prefixes
+
+
+@pytest.mark.parametrize('brick_txt', _few_shot_prefixes())
+def test_stability_solver_parity(brick_txt: str):
+    gp = pytest.importorskip('gurobipy')
+    bricks = BrickStructure.from_txt(brick_txt)
+    try:
+        gurobi_scores = bricks.stability_scores('gurobi')
+    except gp.GurobiError as e:  # No licence, or a size-limited licence and a large structure
+        pytest.skip(f'Gurobi could not solve the structure: {e}')
+    highs_scores = bricks.stability_scores('highs')
+    assert (gurobi_scores.max() < 1) == (highs_scores.max() < 1)
+    assert np.allclose(gurobi_scores, highs_scores, atol=1e-6)
+
+
 @pytest.mark.parametrize(
     'brick_txt,is_connected', [
         ('2x6 (0,0,0)\n2x6 (2,0,0)\n', True),
         ('2x6 (0,0,1)\n2x6 (0,0,2)\n', False),
+        ('2x6 (0,0,0)\n2x6 (1,5,1)\n1x1 (2,10,2)\n', True),
+        ('2x6 (0,0,0)\n2x6 (1,6,1)\n', False),
     ])
 def test_connectivity_check(brick_txt: str, is_connected: bool):
     bricks = BrickStructure.from_txt(brick_txt)
@@ -87,3 +147,162 @@ def test_in_bounds(brick_txt: str, is_in_bounds: bool):
     bricks = BrickStructure([], world_dim=20)
     brick = Brick.from_txt(brick_txt)
     assert bricks.brick_in_bounds(brick) == is_in_bounds
+
+
+def test_feasible_positions():
+    bricks = BrickStructure.from_txt('2x6 (0,0,0)\n2x4 (4,6,0)\n1x1 (10,10,1)\n')
+    for h, w in [(1, 1), (2, 4), (6, 1)]:
+        feasible = bricks.feasible_positions(h, w)
+        for x, y, z in [(0, 0, 0), (1, 5, 0), (2, 6, 0), (3, 7, 0), (10, 10, 1), (9, 9, 1), (0, 0, 1), (18, 16, 19)]:
+            brick = Brick(h=h, w=w, x=x, y=y, z=z)
+            assert feasible[x, y, z] == (bricks.brick_in_bounds(brick) and not bricks.brick_collides(brick))
+        for z in range(bricks.world_dim):
+            assert (bricks.free_positions(h, w, z) == feasible[:, :, z]).all()
+
+
+def test_truncate_and_copy():
+    bricks_txt = '2x6 (0,0,0)\n2x4 (4,6,0)\n1x1 (0,0,1)\n4x2 (1,2,2)\n'
+    bricks = BrickStructure.from_txt(bricks_txt)
+    bricks_copy = bricks.copy()
+    bricks_copy.truncate(2)
+    assert bricks_copy.to_txt() == '2x6 (0,0,0)\n2x4 (4,6,0)\n'
+    assert (bricks_copy.voxel_occupancy == BrickStructure(bricks_copy.bricks).voxel_occupancy).all()
+    assert bricks == BrickStructure.from_txt(bricks_txt)  # The original is unchanged
+    with pytest.raises(ValueError):
+        bricks_copy.truncate(3)
+
+
+def test_is_grounded():
+    bricks = BrickStructure.from_txt('2x6 (0,0,0)\n')
+    assert bricks.is_grounded()
+    bricks.add_brick(Brick.from_txt('2x2 (4,4,1)\n'))  # Floating
+    assert not bricks.is_grounded()
+    bricks.add_brick(Brick.from_txt('2x2 (0,4,1)\n'))
+    assert not bricks.is_grounded()
+    bricks.add_brick(Brick.from_txt('6x2 (0,4,2)\n'))  # Connects the floating brick to the others
+    assert bricks.is_grounded() and bricks.is_connected()
+    bricks_copy = bricks.copy()
+    bricks_copy.undo_add_brick()
+    assert not bricks_copy.is_grounded()
+    bricks_copy.truncate(1)
+    assert bricks_copy.is_grounded()
+    bricks.add_brick(Brick.from_txt('1x1 (0,0,0)\n'))  # Collides
+    assert not bricks.is_grounded()
+    bricks.undo_add_brick()
+    assert bricks.is_grounded()
+
+
+@pytest.mark.parametrize(
+    'brick_txt,n_connected', [
+        ('', 0),
+        ('2x6 (0,0,0)\n2x6 (1,5,1)\n1x1 (2,10,2)\n', 3),
+        ('2x6 (0,0,0)\n2x2 (4,4,1)\n2x2 (0,4,1)\n6x2 (0,4,2)\n', 4),
+        ('2x6 (0,0,0)\n2x2 (4,4,1)\n2x2 (0,4,1)\n', 1),
+        ('2x2 (0,0,2)\n2x2 (2,2,2)\n2x2 (2,2,1)\n2x2 (2,2,0)\n2x2 (0,0,1)\n', 0),
+    ])
+def test_longest_connected_prefix(brick_txt: str, n_connected: int):
+    bricks = BrickStructure.from_txt(brick_txt)
+    assert bricks.longest_connected_prefix() == n_connected
+    bricks.truncate(n_connected)
+    assert bricks.is_connected()
+
+
+def test_stability_model():
+    bricks = BrickStructure.from_txt('2x6 (0,0,0)\n2x6 (2,0,0)\n1x2 (1,0,1)\n')
+    model = build_stability_model(bricks.to_json(), brick_library, StabilityConfig())
+    assert model.a_eq.shape == (len(model.b_eq), model.n_vars)
+    assert (model.variables['f_down'] >= 0).sum(axis=1).tolist() == [3] * 24 + [4] * 2  # 2xX and 1xX connections
+    assert (model.variables['f_up'] >= 0).sum() == 2 * 4
+    assert (model.variables['external_x_pos'] >= 0).sum() == 6  # Where the two bottom bricks touch
+    scores = model.scores(np.zeros(model.n_vars))  # No knob connection is loaded
+    assert (scores == 0).all()
+
+
+def test_split_contact_components():
+    bricks = BrickStructure.from_txt('2x6 (0,0,0)\n2x2 (5,5,0)\n2x2 (0,0,1)\n1x1 (2,0,0)\n2x2 (5,5,2)\n')
+    components = split_contact_components(bricks.to_json(), brick_library, (bricks.world_dim,) * 3)
+    assert [BrickStructure.from_json(component).to_txt() for component in components] == [
+        '2x6 (0,0,0)\n2x2 (0,0,1)\n1x1 (2,0,0)\n', '2x2 (5,5,0)\n', '2x2 (5,5,2)\n']
+    assert np.allclose(bricks.stability_scores('highs', component_workers=2), bricks.stability_scores('highs'))
+
+
+def test_component_workers_in_parallel():
+    from concurrent.futures import ThreadPoolExecutor
+    from mesh2brick.stability_analysis.solver_resources import component_executor
+
+    # A pool stays usable while a pool with another number of workers is requested
+    pool = component_executor(2)
+    assert component_executor(3) is not pool
+    assert list(pool.map(abs, [-1, -2])) == [1, 2]
+
+    bricks = BrickStructure.from_txt('2x6 (0,0,0)\n2x2 (5,5,0)\n2x2 (0,0,1)\n1x1 (2,0,0)\n2x2 (5,5,2)\n')
+    expected = bricks.stability_scores('highs')
+    with ThreadPoolExecutor(max_workers=4) as callers:
+        results = list(callers.map(lambda workers: bricks.stability_scores('highs', component_workers=workers),
+                                   [1, 2, 3, 1, 2, 3]))
+    assert all(np.allclose(scores, expected) for scores in results)
+
+
+def test_unsolved_contact_components(monkeypatch):
+    from brickgpt.stability_analysis import stability_analysis
+
+    # Only the single-brick component is not solved, and its bricks alone score 1
+    solve = stability_analysis._SOLVERS['highs']
+    monkeypatch.setitem(stability_analysis._SOLVERS, 'highs', lambda model, cfg: (
+        (None, 0, 0, 0.0) if len(model.variables['force_sum_x']) == 1 else solve(model, cfg)))
+    bricks = BrickStructure.from_txt('2x6 (0,0,0)\n2x2 (0,0,1)\n2x2 (5,5,0)\n')
+    scores = bricks.stability_scores('highs', component_workers=2)
+    assert (scores[5:7, 5:7, 0] == 1).all()
+    assert (scores[bricks.voxel_occupancy == 0] == 0).all()
+    assert (scores[bricks.voxel_occupancy > 0] < 1).sum() == 12 + 4  # The solved component is stable
+
+
+@pytest.mark.parametrize(
+    'brick_txt,is_stable', [
+        ('2x6 (0,0,0)\n2x6 (2,0,0)\n2x2 (1,2,1)\n', True),  # Every brick rests on bricks below
+        ('2x6 (0,0,0)\n2x4 (0,3,1)\n', True),  # The center of mass is above the supported voxels
+        ('2x4 (0,0,0)\n1x8 (0,0,1)\n', None),  # Held up by the knob connections
+        ('2x2 (5,5,2)\n2x2 (5,5,3)\n', False),  # Not connected to the ground
+        ('1x1 (0,0,0)\n1x8 (0,0,1)\n' + ''.join(f'2x2 (0,6,{z})\n' for z in range(2, 19)), False),
+    ])
+def test_static_screen(brick_txt: str, is_stable: bool | None):
+    bricks = BrickStructure.from_txt(brick_txt)
+    assert bricks.static_screen().is_stable == is_stable
+    if is_stable is not None:
+        assert bricks.is_stable(solver='highs') == is_stable
+        assert bricks.is_stable(solver='highs', static_screen=True) == is_stable
+
+
+@pytest.mark.parametrize('brick_txt', _few_shot_prefixes())
+def test_static_screen_agrees_with_solver(brick_txt: str):
+    bricks = BrickStructure.from_txt(brick_txt)
+    assert bricks.is_stable(solver='highs', static_screen=True) == bricks.is_stable(solver='highs')
+
+
+def test_incremental_stability_model():
+    bricks = BrickStructure.from_txt('1x1 (0,0,0)\n1x8 (0,0,1)\n1x8 (0,7,2)\n1x4 (0,14,3)\n')
+    model = IncrementalStabilityModel(brick_library, StabilityConfig(world_dimension=(bricks.world_dim,) * 3))
+    for n in [4, 2, 3]:  # Add bricks, remove them and add them back
+        prefix = bricks.copy()
+        prefix.truncate(n)
+        assert np.allclose(prefix.stability_scores(incremental_model=model), prefix.stability_scores())
+        assert len(model) == n
+
+
+def test_brick_library_tables():
+    assert compile_brick_library(brick_library) is brick_library_tables
+    tables = compile_brick_library(dict(brick_library))
+    for brick_id, properties in brick_library.items():
+        h, w = properties['height'], properties['width']
+        brick_id = int(brick_id)
+        assert tables.dimensions[brick_id].tolist() == [h, w]
+        assert tables.oriented_dimensions[1, brick_id].tolist() == [w, h]
+        assert tables.dimensions_to_brick_id[h, w] == tables.dimensions_to_brick_id[w, h] == brick_id
+        assert tables.part_id_to_brick_id[properties['partID']] == brick_id
+        assert tables.mass[brick_id] == properties['mass']
+        assert tables.four_pt_connection[brick_id] == (min(h, w) < 2)
+    for brick_id in brick_library:
+        assert brick_id_to_part_id(int(brick_id)) == brick_library[brick_id]['partID']
+    for brick_id in [-1, len(tables.dimensions)]:
+        with pytest.raises(KeyError):
+            brick_id_to_part_id(brick_id)
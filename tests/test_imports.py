@@ -0,0 +1,30 @@
+import subprocess
+import sys
+
+import pytest
+
+# Generous enough for slow CI machines, but far below the cost of importing torch or a solver backend
+IMPORT_TIME_BUDGET = 1.0
+HEAVY_MODULES = ['gurobipy', 'networkx', 'torch', 'transformers', 'open3d']
+
+
+@pytest.mark.parametrize('import_statement', [
+    'import brickgpt.data',
+    'import brickgpt.stability_analysis',
+    'from brickgpt.data import BrickStructure',  # As in src/texture/scripts/generate_color.py
+])
+def test_import_time(import_statement: str):
+    """
+    Tests that the data and analysis utilities import quickly, without pulling in heavy dependencies.
+    """
+    code = (
+        'import sys, time\n'
+        'start_time = time.perf_counter()\n'
+        f'{import_statement}\n'
+        'print(time.perf_counter() - start_time)\n'
+        f'print(",".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))\n'
+    )
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+    import_time, loaded_modules = output.splitlines()
+    assert float(import_time) < IMPORT_TIME_BUDGET
+    assert loaded_modules == ''
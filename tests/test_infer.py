@@ -1,16 +1,21 @@
 import time
 
-from brickgpt.data import BrickStructure
+import pytest
+import torch
+
+from brickgpt.data import Brick, BrickStructure
 from brickgpt.models import LLM, BrickGPT, BrickGPTConfig, create_instruction
+from brickgpt.models.llm import RejectionTrie
 
 BRICKGPT_PATH = 'AvaLovelace/BrickGPT'
 
 
-def test_llm():
+@pytest.mark.parametrize('checkpoint_strategy', ['crop', 'deepcopy'])
+def test_llm(checkpoint_strategy: str):
     """
     Tests the LLM model by generating two different continuations from a prompt.
     """
-    llm = LLM('meta-llama/Llama-3.2-1B-Instruct')
+    llm = LLM('meta-llama/Llama-3.2-1B-Instruct', checkpoint_strategy=checkpoint_strategy)
     prompt = 'A fun fact about llamas is:'
     output = llm(prompt, max_new_tokens=10)
 
@@ -21,10 +26,69 @@ def test_llm():
 
     # Second continuation
     llm.rollback_to_saved_state()
+    assert llm.kv_cache.get_seq_length() == llm.input_ids_cache.shape[1] - 1
     output_continuation = llm(max_new_tokens=10)
     print(prompt + '|' + output + '|' + output_continuation)
 
 
+def test_generate_constrained():
+    """
+    Tests that constrained generation only samples allowed tokens.
+    """
+    llm = LLM('meta-llama/Llama-3.2-1B-Instruct')
+    allowed_ids = llm.tokenizer.convert_tokens_to_ids(['1', '2', '3'])
+    mask = torch.zeros(llm.model.config.vocab_size, dtype=torch.bool, device=llm.device)
+    mask[allowed_ids] = True
+
+    result_ids = llm.generate_constrained('Count to three:', [mask] * 5)
+    assert len(result_ids) == 5
+    assert all(token_id in allowed_ids for token_id in result_ids)
+    assert llm.kv_cache.get_seq_length() == llm.input_ids_cache.shape[1] - 1
+
+
+def test_prefix_cache():
+    """
+    Tests that prompts reuse the KV cache of the longest cached prefix, and that the prefix cache evicts LRU prefixes.
+    """
+    llm = LLM('meta-llama/Llama-3.2-1B-Instruct', prefix_cache_size=2)
+    prompt = llm.tokenizer('A fun fact about llamas is:', return_tensors='pt')['input_ids']
+    llm.cache_prefix(prompt[:, :2])
+    llm.cache_prefix(prompt[:, :4])
+    assert llm.load_prefix_cache(prompt).get_seq_length() == 4
+    assert llm.load_prefix_cache(prompt[:, :4]).get_seq_length() == 2  # At least one token must be left uncached
+
+    # The KV cache loaded from a prefix gives the same logits as a full prefill
+    kv_cache = llm.load_prefix_cache(prompt)
+    logits = llm.model(prompt[:, 4:].to(llm.device), past_key_values=kv_cache).logits[0, -1]
+    logits_full = llm.model(prompt.to(llm.device)).logits[0, -1]
+    assert torch.allclose(logits, logits_full, atol=1e-4)
+
+    # Caching a new prefix reuses its longest cached prefix, then evicts the least recently used prefix
+    llm.cache_prefix(prompt[:, :3])
+    assert list(llm.prefix_cache) == [tuple(prompt[0, :2].tolist()), tuple(prompt[0, :3].tolist())]
+
+
+def test_rejection_trie():
+    """
+    Tests that constrained generation with a rejection trie never generates a rejected sequence.
+    """
+    llm = LLM('meta-llama/Llama-3.2-1B-Instruct')
+    allowed_ids = llm.tokenizer.convert_tokens_to_ids(['1', '2'])
+    mask = torch.zeros(llm.model.config.vocab_size, dtype=torch.bool, device=llm.device)
+    mask[allowed_ids] = True
+
+    # Reject every sequence but one; the last token of each rejected sequence saturates its parent in turn
+    trie = RejectionTrie([mask] * 3)
+    sequences = [[a, b, c] for a in allowed_ids for b in allowed_ids for c in allowed_ids]
+    for sequence in sequences[:-1]:
+        trie.add(sequence)
+    assert trie.banned_token_ids([]) == [allowed_ids[0]]
+    assert trie.bans(sequences[0]) and trie.bans(sequences[1][:1]) and not trie.bans(sequences[-1])
+
+    for _ in range(3):
+        assert llm.generate_constrained('Count to three:', trie.masks()) == sequences[-1]
+
+
 def test_finetuned_llm():
     """
     Tests running the finetuned BrickGPT model with no other guidance (e.g. rejection sampling).
@@ -72,3 +136,123 @@ def test_finish_partial_structure():
     print(bricks)
     print('# of bricks:', len(bricks))
     print('Brick rejection reasons:', rejections)
+
+
+def test_regeneration_from_kv_cache(monkeypatch):
+    """
+    Tests that regenerating an unstable structure continues from the KV cache of the bricks that were kept,
+    without running prefill again.
+    """
+    brickgpt = BrickGPT(BrickGPTConfig(BRICKGPT_PATH, max_bricks=10, max_regenerations=1, profile=True))
+
+    # Find the first structure unstable, and keep the first half of its bricks
+    stability_checks = iter([False, True])
+    monkeypatch.setattr(brickgpt, '_is_stable', lambda bricks: next(stability_checks))
+
+    def remove_unstable_bricks(bricks):
+        bricks = bricks.copy()
+        bricks.truncate(len(bricks) // 2)
+        return bricks
+
+    monkeypatch.setattr(brickgpt, '_remove_all_bricks_after_first_unstable_brick', remove_unstable_bricks)
+
+    # Count the prefill calls made while continuing the structure
+    continuation_prefills = []
+    continue_structure = brickgpt._continue_structure
+
+    def count_prefills(*args, **kwargs):
+        n_prefills = brickgpt.profiler.calls.get('prefill', 0)
+        result = continue_structure(*args, **kwargs)
+        continuation_prefills.append(brickgpt.profiler.calls.get('prefill', 0) - n_prefills)
+        return result
+
+    monkeypatch.setattr(brickgpt, '_continue_structure', count_prefills)
+
+    output = brickgpt('A tall, narrow tower.')
+
+    assert output['n_regenerations'] == 1
+    assert continuation_prefills == [0]
+    llm = brickgpt.llm
+    assert llm.kv_cache.get_seq_length() == llm.input_ids_cache.shape[1] - 1
+    print(output['bricks'])
+
+
+def test_occupancy_masking():
+    """
+    Tests that occupancy masking prevents generating colliding and out-of-bounds bricks.
+    """
+    brickgpt = BrickGPT(BrickGPTConfig(BRICKGPT_PATH, use_occupancy_masking=True, max_regenerations=0))
+    output = brickgpt('A basic chair with four legs.')
+
+    for reason in ['collision', 'out_of_bounds', 'not_in_library']:
+        assert output['rejection_reasons'][reason] == 0
+    assert not output['bricks'].has_collisions()
+    print(output['bricks'])
+    print('Brick rejection reasons:', output['rejection_reasons'])
+
+
+def test_batched_rejection_sampling():
+    """
+    Tests generating bricks with batched rejection sampling, where candidate bricks are sampled in parallel.
+    """
+    brickgpt = BrickGPT(BrickGPTConfig(BRICKGPT_PATH, rejection_sampling_batch_size=8, max_regenerations=0))
+    output = brickgpt('A basic chair with four legs.')
+
+    assert not output['bricks'].has_collisions()
+    assert not output['bricks'].has_out_of_bounds_bricks()
+    print(output['bricks'])
+    print('Brick rejection reasons:', output['rejection_reasons'])
+
+
+def test_batched_rejection_sampling_skips_banned_candidates(monkeypatch):
+    """
+    Tests that candidates repeating a brick rejected earlier in the same batch do not use up attempts.
+    """
+    brickgpt = BrickGPT(BrickGPTConfig(BRICKGPT_PATH, rejection_sampling_batch_size=4, max_brick_rejections=2,
+                                       max_regenerations=0))
+    out_of_bounds, valid = Brick.from_txt('2x4 (19,0,0)'), Brick.from_txt('2x4 (0,0,0)')
+    tokenizer = brickgpt.llm.tokenizer
+    candidates = [  # The tokens that logit masking generates, one for each part of the brick format
+        tokenizer.convert_tokens_to_ids([tokenizer.tokenize(part)[0] for part in [
+            str(brick.h), 'x', str(brick.w), ' (', str(brick.x), ',', str(brick.y), ',', str(brick.z), ')\n']])
+        for brick in [out_of_bounds] * 3 + [valid]
+    ]
+    monkeypatch.setattr(brickgpt.llm, 'generate_constrained_candidates', lambda *args, **kwargs: candidates)
+    monkeypatch.setattr(brickgpt.llm, 'select_candidate', lambda idx: None)
+
+    brick, rejection_reasons = brickgpt._generate_brick_with_batched_rejection_sampling(None, BrickStructure([]))
+    assert brick == valid.to_txt()
+    assert rejection_reasons == {'out_of_bounds': 1}
+
+
+def test_generate_batch():
+    """
+    Tests generating several brick structures at once, and that each result only depends on its own seed.
+    """
+    brickgpt = BrickGPT(BrickGPTConfig(BRICKGPT_PATH, max_bricks=20, max_regenerations=0))
+    captions = ['A basic chair with four legs.', 'A small table.', 'A tall tower.']
+    outputs = brickgpt.generate_batch(captions, seeds=[0, 1, 2], batch_size=2)
+    outputs_unbatched = brickgpt.generate_batch(captions, seeds=[0, 1, 2], batch_size=1)
+
+    assert len(outputs) == len(captions)
+    for output, output_unbatched in zip(outputs, outputs_unbatched):
+        assert not output['bricks'].has_collisions()
+        assert not output['bricks'].has_out_of_bounds_bricks()
+        assert output['bricks'].to_txt() == output_unbatched['bricks'].to_txt()
+
+
+def test_profiling():
+    """
+    Tests that profiling returns the time spent in each stage of generation.
+    """
+    brickgpt = BrickGPT(BrickGPTConfig(BRICKGPT_PATH, max_bricks=10, max_regenerations=0, profile=True))
+    output = brickgpt('A basic chair with four legs.')
+
+    timings = output['timings']
+    assert timings['tokens_generated'] > 0
+    assert timings['peak_kv_cache_bytes'] > 0
+    assert timings['stages']['decode']['calls'] > 0
+    assert timings['stages']['validation']['calls'] >= len(output['bricks'])
+    assert sum(stage['time'] for name, stage in timings['stages'].items() if name != 'total') \
+           <= timings['stages']['total']['time']
+    print(timings)
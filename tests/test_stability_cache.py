@@ -0,0 +1,35 @@
+from brickgpt.data import BrickStructure, StabilityCache
+
+
+def test_stability_cache(tmp_path):
+    bricks = BrickStructure.from_txt('2x6 (0,0,0)\n2x6 (1,5,1)\n2x2 (0,0,2)\n')
+    reordered = BrickStructure.from_txt('2x2 (0,0,2)\n2x6 (0,0,0)\n2x6 (1,5,1)\n')
+    cache = StabilityCache(cache_dir=tmp_path)
+
+    assert not cache.is_stable(bricks, 'connectivity')
+    assert (cache.stability_scores(bricks, 'connectivity') == bricks.connectivity_scores()).all()
+    assert not cache.is_stable(reordered, 'connectivity')
+    assert cache.stats() == {'hits': 1, 'disk_hits': 0, 'misses': 2, 'solves': 1, 'screened': 0, 'size': 1}  # Floating bricks need no scores
+
+    bricks.truncate(2)
+    assert cache.is_stable(bricks, 'connectivity')
+    assert cache.stats() == {'hits': 1, 'disk_hits': 0, 'misses': 3, 'solves': 2, 'screened': 0, 'size': 2}
+
+    # A new cache loads the saved entries
+    cache = StabilityCache(max_size=1, cache_dir=tmp_path)
+    assert not cache.is_stable(reordered, 'connectivity')
+    assert cache.is_stable(bricks, 'connectivity')
+    assert cache.stats() == {'hits': 2, 'disk_hits': 2, 'misses': 0, 'solves': 0, 'screened': 0, 'size': 1}
+
+
+def test_stability_cache_static_screen():
+    column = BrickStructure.from_txt('2x4 (0,0,0)\n2x4 (0,0,1)\n1x1 (0,0,2)\n')
+    assert StabilityCache().is_stable(column, 'highs')
+    cache = StabilityCache(static_screen=True)
+    assert cache.is_stable(column, 'highs')
+    assert (cache.stability_scores(column, 'highs') == 0).all()
+    assert cache.stats() == {'hits': 1, 'disk_hits': 0, 'misses': 1, 'solves': 0, 'screened': 1, 'size': 1}
+
+    cantilever = BrickStructure.from_txt('1x1 (0,0,0)\n1x2 (0,0,1)\n')
+    assert cache.is_stable(cantilever, 'highs')
+    assert cache.stats()['solves'] == 1  # Undecided by the screen